@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+import os
+# CPU only, so numbers are comparable across machines and commits
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+import sys
+import time
+import json
+import collections
+import resource
+import argparse
+import platform
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+from input_velodyne import *
+
+
+def synthetic_pc(num_points=120000, seed=0):
+    """Random scan with roughly the extent and intensity range of a KiTTI velodyne frame"""
+    rng = np.random.RandomState(seed)
+    pc = np.empty((num_points, 4), dtype=np.float32)
+    pc[:, 0] = rng.uniform(-80, 80, num_points)
+    pc[:, 1] = rng.uniform(-80, 80, num_points)
+    pc[:, 2] = rng.uniform(-3, 3, num_points)
+    pc[:, 3] = rng.uniform(0, 1, num_points)
+    return pc
+
+def synthetic_boxes(num_boxes=10, seed=0, x=(0, 90), y=(-50, 50)):
+    """Car sized labels (places, rotates, size) spread over the ROI, as read_labels returns them"""
+    rng = np.random.RandomState(seed)
+    places = np.empty((num_boxes, 3))
+    places[:, 0] = rng.uniform(x[0] + 5, x[1] - 5, num_boxes)
+    places[:, 1] = rng.uniform(y[0] + 5, y[1] - 5, num_boxes)
+    places[:, 2] = rng.uniform(-2, -1.5, num_boxes)
+    rotates = rng.uniform(-np.pi, np.pi, num_boxes)
+    size = np.column_stack((rng.uniform(1.4, 1.7, num_boxes), rng.uniform(1.5, 1.9, num_boxes), rng.uniform(3.5, 4.8, num_boxes)))
+    return places, rotates, size
+
+def time_function(func, repeat=20):
+    """Run func repeat times and return (last result, per call seconds)"""
+    func()
+    durations = []
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        durations.append(time.time() - start)
+    return result, np.array(durations)
+
+def benchmark_preprocess(pc, repeat=20, resolution=0.25, x=(0, 90), y=(-50, 50), z=(-5.5, 4.5)):
+    """Compare filter_camera_angle + raw_to_voxel against the fused voxel_index kernel"""
+    shape = voxel_grid_shape(resolution=resolution, x=x, y=y, z=z)
+    out = (np.empty((len(pc), 3), dtype=np.int32), np.empty(len(pc), dtype=np.int64))
+
+    def chain():
+        return raw_to_voxel(filter_camera_angle(pc), resolution=resolution, x=x, y=y, z=z)
+
+    def fused():
+        index, _ = voxel_index(pc, resolution=resolution, x=x, y=y, z=z, camera_angle=True, out=out)
+        return sparse_to_voxel(index, shape)
+
+    def fused_index():
+        return voxel_index(pc, resolution=resolution, x=x, y=y, z=z, camera_angle=True, out=out)
+
+    chain_voxel, chain_time = time_function(chain, repeat)
+    fused_voxel, fused_time = time_function(fused, repeat)
+    _, index_time = time_function(fused_index, repeat)
+    assert (chain_voxel == fused_voxel).all(), "fused kernel differs from filter_camera_angle + raw_to_voxel"
+    print("points: %d  numba: %s" % (len(pc), numba is not None))
+    print("filter_camera_angle + raw_to_voxel: %.3f ms" % (np.median(chain_time) * 1000))
+    print("voxel_index + sparse_to_voxel:      %.3f ms" % (np.median(fused_time) * 1000))
+    print("voxel_index only:                   %.3f ms" % (np.median(index_time) * 1000))
+
+def summarize(durations, frames=1):
+    """Latency percentiles in ms and throughput of per call durations, frames processed per call"""
+    ms = durations * 1000
+    return dict(repeat=len(durations), mean_ms=float(ms.mean()), p50_ms=float(np.percentile(ms, 50)), \
+        p90_ms=float(np.percentile(ms, 90)), p99_ms=float(np.percentile(ms, 99)), max_ms=float(ms.max()), \
+        frames_per_s=float(frames / max(durations.mean(), 1e-12)))
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far (ru_maxrss is KB on Linux, bytes on macOS)
+
+    The peak is over the whole process, so each stage reports the maximum of
+    itself and every stage that ran before it.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024. * 1024.) if sys.platform == "darwin" else rss / 1024.
+
+def benchmark_stages(pc, bin_path, places, rotates, size, repeat=20, resolution=0.25, scale=8, x=(0, 90), y=(-50, 50), z=(-5.5, 4.5)):
+    """Time every preprocessing stage of one frame, each fed with the output of the previous one"""
+    shape = voxel_grid_shape(resolution=resolution, x=x, y=y, z=z)
+    min_value = np.array([x[0], y[0], z[0]])
+    results = collections.OrderedDict()
+
+    def run(name, func):
+        result, durations = time_function(func, repeat)
+        results[name] = summarize(durations)
+        results[name]["cumulative_peak_rss_mb"] = peak_rss_mb()
+        return result
+
+    loaded = run("load_pc_from_bin", lambda: load_pc_from_bin(bin_path))
+    filtered = run("filter_camera_angle", lambda: filter_camera_angle(loaded))
+    run("raw_to_voxel", lambda: raw_to_voxel(filtered, resolution=resolution, x=x, y=y, z=z))
+    run("voxel_index", lambda: voxel_index(loaded, resolution=resolution, x=x, y=y, z=z, camera_angle=True))
+    corners = run("get_boxcorners", lambda: get_boxcorners(places, rotates, size))
+    center_sphere, corner_label = run("create_label", lambda: create_label(places, size, corners, resolution=resolution, x=x, y=y, z=z, \
+        scale=scale, min_value=min_value))
+    g_cord = corner_label.reshape(len(corner_label), -1)
+    run("corner_to_voxel", lambda: corner_to_voxel(shape, g_cord, center_sphere, scale=scale))
+    run("preprocess_frame", lambda: preprocess_frame(pc, places, rotates, size, resolution=resolution, scale=scale, x=x, y=y, z=z))
+    return results
+
+def benchmark_model(pc, places, rotates, size, repeat=5, batch_num=1, resolution=0.25, scale=8, x=(0, 90), y=(-50, 50), z=(-5.5, 4.5)):
+    """Time a BNBLayer forward pass and one training step (loss_func3 + Adam) on a batch of the same frame
+
+    The forward pass runs on the inference graph (is_training=None, the batch
+    norm population statistics) as Detector builds it, not on the training graph.
+    """
+    import tensorflow as tf
+    from model_01_deconv import ssd_model, loss_func3, create_optimizer
+    shape = voxel_grid_shape(resolution=resolution, x=x, y=y, z=z)
+    frame = preprocess_frame(pc, places, rotates, size, resolution=resolution, scale=scale, x=x, y=y, z=z)
+    batch_x, batch_g_map, batch_g_cord = batch_to_train([frame] * batch_num, resolution=resolution, scale=scale, x=x, y=y, z=z)
+    results = collections.OrderedDict()
+    config = tf.ConfigProto(device_count={"GPU": 0})
+    with tf.Graph().as_default(), tf.Session(config=config) as sess:
+        model, voxel, _ = ssd_model(sess, voxel_shape=shape, activation=tf.nn.relu, is_training=None)
+        sess.run(tf.global_variables_initializer())
+        _, durations = time_function(lambda: sess.run([model.objectness, model.cordinate, model.y], feed_dict={voxel: batch_x}), repeat)
+        results["forward"] = summarize(durations, frames=batch_num)
+        results["forward"]["cumulative_peak_rss_mb"] = peak_rss_mb()
+
+    with tf.Graph().as_default(), tf.Session(config=config) as sess:
+        model, voxel, phase_train = ssd_model(sess, voxel_shape=shape, activation=tf.nn.relu, is_training=True)
+        total_loss, _, _, _, _, g_map, g_cord, _ = loss_func3(model)
+        optimizer = create_optimizer(total_loss)
+        sess.run(tf.global_variables_initializer())
+        step = {voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train: True}
+        _, durations = time_function(lambda: sess.run(optimizer, feed_dict=step), repeat)
+        results["train_step"] = summarize(durations, frames=batch_num)
+        results["train_step"]["cumulative_peak_rss_mb"] = peak_rss_mb()
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), \
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results):
+    print("%-20s %6s %9s %9s %9s %9s %10s %9s" % ("stage", "repeat", "mean ms", "p50 ms", "p90 ms", "p99 ms", "frames/s", "peak MB*"))
+    for name, stats in results.items():
+        print("%-20s %6d %9.2f %9.2f %9.2f %9.2f %10.1f %9.0f" % (name, stats["repeat"], stats["mean_ms"], stats["p50_ms"], \
+            stats["p90_ms"], stats["p99_ms"], stats["frames_per_s"], stats["cumulative_peak_rss_mb"]))
+    print("* peak RSS of the process up to the end of the stage, including every earlier stage")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU benchmark of the preprocessing stages, the forward pass and a training step")
+    parser.add_argument("--bin", default="data/velodyne/002397.bin", help="scan to time, a synthetic one of --points points when missing")
+    parser.add_argument("--points", type=int, default=120000)
+    parser.add_argument("--boxes", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--model-repeat", type=int, default=5)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--resolution", type=float, default=0.25)
+    parser.add_argument("--scale", type=int, default=8)
+    parser.add_argument("--x", type=float, nargs=2, default=(0, 90))
+    parser.add_argument("--y", type=float, nargs=2, default=(-50, 50))
+    parser.add_argument("--z", type=float, nargs=2, default=(-5.5, 4.5))
+    parser.add_argument("--skip-model", action="store_true")
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    args = parser.parse_args()
+    x, y, z = tuple(args.x), tuple(args.y), tuple(args.z)
+
+    bin_path = args.bin
+    tmp_dir = None
+    if os.path.exists(bin_path):
+        pc = load_pc_from_bin(bin_path)
+    else:
+        pc = synthetic_pc(args.points)
+        tmp_dir = tempfile.mkdtemp()
+        bin_path = os.path.join(tmp_dir, "synthetic.bin")
+        pc.tofile(bin_path)
+    places, rotates, size = synthetic_boxes(args.boxes, x=x, y=y)
+
+    try:
+        benchmark_preprocess(pc, repeat=args.repeat, resolution=args.resolution, x=x, y=y, z=z)
+        results = benchmark_stages(pc, bin_path, places, rotates, size, repeat=args.repeat, resolution=args.resolution, \
+            scale=args.scale, x=x, y=y, z=z)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    if not args.skip_model:
+        results.update(benchmark_model(pc, places, rotates, size, repeat=args.model_repeat, batch_num=args.batch, \
+            resolution=args.resolution, scale=args.scale, x=x, y=y, z=z))
+    print_results(results)
+
+    if args.json:
+        report = dict(commit=git_commit(), time=time.strftime("%Y-%m-%dT%H:%M:%S"), python=platform.python_version(), \
+            numpy=np.__version__, numba=numba is not None, machine=platform.machine(), processor=platform.processor(), \
+            config=dict(bin=args.bin if os.path.exists(args.bin) else None, points=len(pc), boxes=args.boxes, batch=args.batch, \
+                resolution=args.resolution, scale=args.scale, x=x, y=y, z=z, voxel_shape=voxel_grid_shape(args.resolution, x, y, z)), \
+            peak_rss_mb=peak_rss_mb(), results=results)
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+import os
+import glob
+import time
+import shutil
+import tempfile
+import threading
+import tensorflow as tf
+import tracing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# extra checkpoint variables of the training counters, ignored by a Saver of the model variables
+EPOCH_NAME = "checkpoint/epoch"
+BATCH_NAME = "checkpoint/batch"
+STEP_NAME = "checkpoint/step"
+
+
+class AsyncCheckpointer(object):
+    """Checkpoints written on a background thread, so the training loop only waits for a snapshot
+
+    save() copies the variable values to numpy with one sess.run and hands
+    them to a writer thread, which owns a graph of its own with a Saver over
+    a copy of every variable. While a write is in progress newer snapshots
+    replace the pending one. Each checkpoint is written into a temporary
+    directory and renamed into directory (index file last), then the
+    checkpoint state file is updated atomically, so a preempted job never
+    sees a partial checkpoint. Only checkpoints named prefix-<step> are
+    tracked, and only the max_to_keep latest of them are kept; other
+    checkpoints in directory are never deleted.
+
+    maybe_save() saves every every_steps steps or every_secs seconds.
+    restore() resumes from the latest checkpoint and returns the saved
+    (epoch, batch, step): the epoch in progress and the batches of it already
+    trained on (0 at an epoch end), so the caller skips those batches.
+
+        checkpointer = AsyncCheckpointer(sess, "./checkpoints", every_secs=600)
+        start_epoch, start_batch, step = checkpointer.restore(sess)
+        ...
+        checkpointer.maybe_save(epoch, batch, step)
+        checkpointer.close()
+    """
+
+    def __init__(self, sess, directory, prefix="model.ckpt", var_list=None, max_to_keep=5, every_steps=None, every_secs=None):
+        self.sess = sess
+        self.directory = directory
+        self.prefix = prefix
+        self.var_list = var_list if var_list is not None else tf.global_variables()
+        self.max_to_keep = max_to_keep
+        self.every_steps = every_steps
+        self.every_secs = every_secs
+        self.last_save = time.time()
+        self.last_saved = None
+        self.skipped = 0
+        self.error = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        state = tf.train.get_checkpoint_state(directory)
+        self.kept = [path for path in (state.all_model_checkpoint_paths if state is not None else []) \
+            if os.path.basename(path).startswith(prefix + "-") and os.path.exists(path + ".index")]
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.feeds = []
+            saved = {}
+            for v in self.var_list:
+                value = tf.placeholder(v.dtype.base_dtype, v.get_shape())
+                saved[v.op.name] = tf.Variable(value, trainable=False)
+                self.feeds.append(value)
+            self.counters = [tf.placeholder(tf.int64, []) for _ in range(3)]
+            for name, value in zip((EPOCH_NAME, BATCH_NAME, STEP_NAME), self.counters):
+                saved[name] = tf.Variable(value, trainable=False)
+            self.assign = tf.variables_initializer(list(saved.values()))
+            self.saver = tf.train.Saver(saved, max_to_keep=None, write_version=tf.train.SaverDef.V2)
+        self.writer_sess = tf.Session(graph=self.graph)
+
+        self.pending = queue.Queue(maxsize=1)
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def latest(self):
+        return self.kept[-1] if self.kept else None
+
+    def restore(self, sess, var_list=None):
+        """Restore the latest checkpoint into sess, (0, 0, 0) when there is none"""
+        path = self.latest()
+        if path is None:
+            return 0, 0, 0
+        tf.train.Saver(var_list if var_list is not None else self.var_list).restore(sess, path)
+        return tuple(int(tf.train.load_variable(path, name)) for name in (EPOCH_NAME, BATCH_NAME, STEP_NAME))
+
+    def maybe_save(self, epoch, batch, step):
+        if (self.every_steps and step % self.every_steps == 0) or \
+                (self.every_secs and time.time() - self.last_save >= self.every_secs):
+            self.save(epoch, batch, step)
+            return True
+        return False
+
+    def save(self, epoch, batch, step):
+        """Snapshot the variables now and write them in the background"""
+        if self.error is not None:
+            raise self.error
+        if self.last_saved == step:
+            return
+        with tracing.span("checkpoint"):
+            values = self.sess.run(self.var_list)
+        snapshot = (values, epoch, batch, step)
+        while True:
+            try:
+                self.pending.put_nowait(snapshot)
+                break
+            except queue.Full:
+                try:
+                    self.pending.get_nowait()
+                    self.skipped += 1
+                except queue.Empty:
+                    pass
+        self.last_save = time.time()
+        self.last_saved = step
+
+    def _write_loop(self):
+        while True:
+            snapshot = self.pending.get()
+            if snapshot is None:
+                return
+            try:
+                self._write(*snapshot)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, values, epoch, batch, step):
+        feed_dict = dict(zip(self.feeds + self.counters, list(values) + [epoch, batch, step]))
+        self.writer_sess.run(self.assign, feed_dict=feed_dict)
+        name = "%s-%d" % (self.prefix, step)
+        path = os.path.join(self.directory, name)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+        try:
+            self.saver.save(self.writer_sess, os.path.join(tmp_dir, name), write_meta_graph=False, write_state=False)
+            files = sorted(os.listdir(tmp_dir), key=lambda f: f.endswith(".index"))
+            for f in files:
+                os.rename(os.path.join(tmp_dir, f), os.path.join(self.directory, f))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.kept = [p for p in self.kept if os.path.basename(p) != name] + [path]
+        if self.max_to_keep:
+            for old in self.kept[:-self.max_to_keep]:
+                for f in glob.glob(old + ".*"):
+                    os.remove(f)
+            self.kept = self.kept[-self.max_to_keep:]
+        tf.train.update_checkpoint_state(self.directory, path, all_model_checkpoint_paths=self.kept)
+
+    def close(self):
+        """Write the pending snapshot and stop the writer"""
+        self.pending.put(None)
+        self.writer.join()
+        self.writer_sess.close()
+        if self.error is not None:
+            raise self.error
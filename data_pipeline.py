@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+import glob
+import time
+import threading
+import collections
+import multiprocessing
+import numpy as np
+from input_velodyne import *
+from voxel_cache import VoxelCache
+from packed_dataset import open_packed
+from label_index import open_labels
+import tracing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class FrameLoader(object):
+    """Load, voxelize and label one frame, going through the VoxelCache when one is set
+
+    Instances are picklable so the same loader runs in the pool workers.
+    With a label_index the txt labels and calibrations parsed once for the
+    split are looked up by frame id instead of being read for every frame.
+    """
+
+    def __init__(self, resolution=0.2, dataformat="pcd", label_type="txt", is_velo_cam=False, \
+                 scale=4, x=(0, 80), y=(-40, 40), z=(-2.5, 1.5), cache_dir=None, packed_path=None, label_index=None, \
+                 input_type="voxel", slices=4):
+        self.resolution = resolution
+        self.dataformat = dataformat
+        self.label_type = label_type
+        self.is_velo_cam = is_velo_cam
+        self.scale = scale
+        self.x = x
+        self.y = y
+        self.z = z
+        self.cache_dir = cache_dir
+        self.packed_path = packed_path
+        self.label_index = label_index
+        self.input_type = input_type
+        self.slices = slices
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self.cache_dir and self._cache is None:
+            params = dict(resolution=self.resolution, scale=self.scale, x=self.x, y=self.y, z=self.z, \
+                label_type=self.label_type, is_velo_cam=self.is_velo_cam)
+            if self.input_type != "voxel":
+                params.update(input_type=self.input_type, slices=self.slices)
+            self._cache = VoxelCache(self.cache_dir, **params)
+        return self._cache
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_cache"] = None
+        return state
+
+    def __call__(self, source):
+        velodynes, labels, calibs = source
+        frame = None
+        cache = self.cache
+        if cache:
+            if self.dataformat == "packed":
+                key = cache.digest_key(open_packed(self.packed_path).digests[velodynes])
+            else:
+                key = cache.key(velodynes, labels, calibs)
+            with tracing.span("cache_load"):
+                frame = cache.load(key)
+
+        if frame is None:
+            with tracing.span("load"):
+                if self.dataformat == "packed":
+                    pc, places, rotates, size = open_packed(self.packed_path).frame(velodynes, is_velo_cam=self.is_velo_cam)
+                else:
+                    pc, places, rotates, size = load_frame(velodynes, label_path=labels, calib_path=calibs, \
+                        dataformat=self.dataformat, label_type=self.label_type, is_velo_cam=self.is_velo_cam, label_index=self.label_index)
+            frame = preprocess_frame(pc, places, rotates, size, resolution=self.resolution, scale=self.scale, x=self.x, y=self.y, z=self.z, \
+                input_type=self.input_type, slices=self.slices)
+            if cache:
+                with tracing.span("cache_save"):
+                    cache.save(key, frame)
+        return frame
+
+
+def frame_sources(velodyne_path, label_path=None, calib_path=None, dataformat="pcd"):
+    """Sorted (velodyne, label, calib) triples of a split, frame positions for a pack
+
+    A single tracklet xml (a raw drive) labels every scan, frames are then
+    picked by the scan file name; a single calib file likewise calibrates
+    every scan. Otherwise there must be one label and calib per scan.
+    """
+    if dataformat == "packed":
+        return [(i, None, None) for i in range(len(open_packed(velodyne_path)))]
+    velodynes_path = sorted(glob.glob(velodyne_path))
+    labels_path = sorted(glob.glob(label_path)) if label_path else [None] * len(velodynes_path)
+    calibs_path = sorted(glob.glob(calib_path)) if calib_path else [None] * len(velodynes_path)
+    if len(labels_path) == 1 and labels_path[0].endswith(".xml"):
+        labels_path = labels_path * len(velodynes_path)
+    if len(calibs_path) == 1:
+        calibs_path = calibs_path * len(velodynes_path)
+    for name, paths in (("label", labels_path), ("calib", calibs_path)):
+        if len(paths) != len(velodynes_path):
+            raise ValueError("%d %s files for %d scans of %s" % (len(paths), name, len(velodynes_path), velodyne_path))
+    return list(zip(velodynes_path, labels_path, calibs_path))
+
+
+_worker_loader = None
+
+def _init_worker(loader, trace=False):
+    global _worker_loader
+    _worker_loader = loader
+    if trace:
+        tracing.enable()
+
+def _load_in_worker(source):
+    """The frame and the trace events it produced, for the parent to merge"""
+    frame = _worker_loader(source)
+    return frame, tracing.drain()
+
+
+class BatchPipeline(object):
+    """Training batches of one epoch per iteration, prepared ahead of the training step
+
+    With num_workers > 0 frames are preprocessed by a process pool with at
+    most prefetch * batch_num frames in flight, and a background thread
+    densifies them into a bounded queue of prefetch batches. Frames are
+    consumed in submission order, so batches are identical to the serial
+    path whatever the pool size.
+
+    wait_time is the time the training loop spent waiting for a batch (the
+    model idle), block_time the time the producer spent waiting for a free
+    slot (the input workers idle).
+    """
+
+    def __init__(self, batch_num, velodyne_path, label_path=None, calib_path=None, resolution=0.2, dataformat="pcd", label_type="txt", \
+                 is_velo_cam=False, scale=4, x=(0, 80), y=(-40, 40), z=(-2.5, 1.5), cache_dir=None, num_workers=0, prefetch=2, sparse_cord=False, \
+                 input_type="voxel", slices=4):
+        self.batch_num = batch_num
+        self.resolution = resolution
+        self.scale = scale
+        self.x = x
+        self.y = y
+        self.z = z
+        self.prefetch = max(prefetch, 1)
+        self.sparse_cord = sparse_cord
+        self.input_type = input_type
+        self.sources = frame_sources(velodyne_path, label_path, calib_path, dataformat)
+        label_index = None
+        if dataformat != "packed" and label_type == "txt" and label_path:
+            label_index = open_labels(label_path, calib_path)
+        self.loader = FrameLoader(resolution=resolution, dataformat=dataformat, label_type=label_type, is_velo_cam=is_velo_cam, \
+            scale=scale, x=x, y=y, z=z, cache_dir=cache_dir, packed_path=velodyne_path if dataformat == "packed" else None, \
+            label_index=label_index, input_type=input_type, slices=slices)
+        self.pool = None
+        self.producer = None
+        if num_workers > 0:
+            self.pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(self.loader, tracing.enabled()))
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.sources) // self.batch_num
+
+    def reset_stats(self):
+        self.steps = 0
+        self.wait_time = 0.
+        self.block_time = 0.
+        self.last_wait = 0.
+
+    def close(self):
+        """Stop the producer thread of an unfinished epoch and the input workers"""
+        if self.producer is not None:
+            stop, producer = self.producer
+            stop.set()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.producer is not None:
+            # a producer waiting on a terminated worker never returns, it is a daemon thread
+            producer.join(1.)
+            self.producer = None
+
+    def _frames(self):
+        sources = self.sources[:len(self) * self.batch_num]
+        if self.pool is None:
+            for source in sources:
+                yield self.loader(source)
+            return
+        pending = collections.deque()
+        sources = iter(sources)
+        for source in sources:
+            pending.append(self.pool.apply_async(_load_in_worker, (source,)))
+            if len(pending) >= self.prefetch * self.batch_num:
+                break
+        while pending:
+            tracing.counter("frames_in_flight", len(pending))
+            frame, events = pending.popleft().get()
+            tracing.merge(events)
+            for source in sources:
+                pending.append(self.pool.apply_async(_load_in_worker, (source,)))
+                break
+            yield frame
+
+    def _batches(self):
+        frames = self._frames()
+        for itn in range(len(self)):
+            batch = []
+            for _ in range(self.batch_num):
+                frame = next(frames)
+                if frame[1].shape[0]:
+                    batch.append(frame)
+            with tracing.span("batch"):
+                batch = batch_to_train(batch, resolution=self.resolution, scale=self.scale, x=self.x, y=self.y, z=self.z, \
+                    sparse_cord=self.sparse_cord, input_type=self.input_type)
+            yield batch
+
+    def __iter__(self):
+        if self.pool is None:
+            batches = self._batches()
+            while True:
+                start = time.time()
+                with tracing.span("wait"):
+                    batch = next(batches, None)
+                self.last_wait = time.time() - start
+                self.wait_time += self.last_wait
+                if batch is None:
+                    return
+                self.steps += 1
+                yield batch
+
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self._batches():
+                    start = time.time()
+                    queued = put(batch)
+                    self.block_time += time.time() - start
+                    tracing.counter("batch_queue", batches.qsize())
+                    if not queued:
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        self.producer = (stop, producer)
+        try:
+            while True:
+                start = time.time()
+                with tracing.span("wait"):
+                    batch = batches.get()
+                self.last_wait = time.time() - start
+                self.wait_time += self.last_wait
+                if batch is done:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                self.steps += 1
+                yield batch
+        finally:
+            stop.set()
+            producer.join()
+            self.producer = None
+
+    def summary(self):
+        steps = max(self.steps, 1)
+        return "input wait %.1f ms/step, workers blocked %.1f ms/step" % (self.wait_time / steps * 1000, self.block_time / steps * 1000)
+
+
+def lidar_generator(batch_num, velodyne_path, label_path=None, calib_path=None, resolution=0.2, dataformat="pcd", label_type="txt", is_velo_cam=False, \
+                        scale=4, x=(0, 80), y=(-40, 40), z=(-2.5, 1.5), cache_dir=None, num_workers=0, prefetch=2, sparse_cord=False, \
+                        input_type="voxel", slices=4):
+    pipeline = BatchPipeline(batch_num, velodyne_path, label_path=label_path, calib_path=calib_path, resolution=resolution, \
+        dataformat=dataformat, label_type=label_type, is_velo_cam=is_velo_cam, scale=scale, x=x, y=y, z=z, \
+        cache_dir=cache_dir, num_workers=num_workers, prefetch=prefetch, sparse_cord=sparse_cord, \
+        input_type=input_type, slices=slices)
+    try:
+        for batch in pipeline:
+            yield batch
+    finally:
+        pipeline.close()
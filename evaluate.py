@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+import glob
+import time
+import argparse
+import numpy as np
+from input_velodyne import *
+from label_index import LabelIndex, frame_id_of
+from postprocess import BEV_CORNERS, rectify_boxes, iou_matrix
+
+# KiTTI difficulties: min 2D box height (px), max occlusion level, max truncation
+DIFFICULTIES = (
+    ("easy", 40, 0, 0.15),
+    ("moderate", 25, 1, 0.30),
+    ("hard", 25, 2, 0.50),
+)
+# Recall positions of the KiTTI 40 point interpolated AP
+RECALL_POSITIONS = np.linspace(1. / 40, 1., 40)
+
+
+def ground_truth(label_index, i, is_velo_cam=False):
+    """Car and Van boxes of frame i in velodyne coordinate with what difficulty needs
+
+    # Returns:
+        footprint (np.ndarray): (G, 4, 2) bird's eye view corners.
+        bottom, top (np.ndarray): (G,) z extent.
+        is_car (np.ndarray): (G,) False for Van, which KiTTI ignores for Car.
+        height, occluded, truncated (np.ndarray): (G,) 2D box height, occlusion and truncation.
+    """
+    types, rows = label_index.frame_rows(i)
+    keep = (types == "Car") | (types == "Van")
+    types, rows = types[keep], rows[keep]
+    proj_velo = label_index.proj_velo[i]
+    places, rotates = label_to_velo(rows[:, 10:13], rows[:, 13], proj_velo=None if np.isnan(proj_velo).any() else proj_velo, \
+        is_velo_cam=is_velo_cam)
+    size = rows[:, 7:10]
+    corners = get_boxcorners(places, rotates, np.hstack((size[:, :2], np.minimum(size[:, 2:], 10))))
+    return corners[:, BEV_CORNERS, :2], places[:, 2], places[:, 2] + size[:, 0], types == "Car", \
+        rows[:, 6] - rows[:, 4], rows[:, 1], rows[:, 0]
+
+def frame_iou(corners, gt, use_3d=False):
+    """(N, G) IoU of the detections of one frame against its ground truth, one batched kernel call"""
+    footprint, bottom, top = gt[:3]
+    if not len(corners) or not len(footprint):
+        return np.zeros((len(corners), len(footprint)))
+    det_footprint, det_bottom, det_top = rectify_boxes(corners)
+    if use_3d:
+        return iou_matrix(det_footprint, footprint, det_bottom, det_top, bottom, top)
+    return iou_matrix(det_footprint, footprint)
+
+def match_frame(iou, scores, gt, difficulty, iou_threshold=0.7):
+    """Greedy score ordered matching of the detections of one frame
+
+    Ground truth outside the difficulty (or a Van) is ignored: a detection
+    matching it is neither a true nor a false positive.
+    # Returns:
+        scores (np.ndarray): scores of the detections that count.
+        tp (np.ndarray): bool, whether each of them is a true positive.
+        num_gt (int): ground truth boxes to recall.
+    """
+    is_car, height, occluded, truncated = gt[3:]
+    _, min_height, max_occlusion, max_truncation = difficulty
+    valid = is_car & (height >= min_height) & (occluded <= max_occlusion) & (truncated <= max_truncation)
+
+    order = np.argsort(-scores, kind="mergesort")
+    matches = iou[order] >= iou_threshold
+    taken = np.zeros(len(valid), dtype=bool)
+    counted = np.ones(len(order), dtype=bool)
+    tp = np.zeros(len(order), dtype=bool)
+    for d in np.where(matches.any(axis=1))[0]:
+        candidates = matches[d] & ~taken
+        if (candidates & valid).any():
+            taken[np.argmax(np.where(candidates & valid, iou[order[d]], -1.))] = True
+            tp[d] = True
+        elif candidates.any():
+            taken[np.argmax(np.where(candidates, iou[order[d]], -1.))] = True
+            counted[d] = False
+    return scores[order][counted], tp[counted], int(valid.sum())
+
+def average_precision(scores, tp, num_gt):
+    """40 point interpolated AP of detections pooled over a split"""
+    if num_gt == 0:
+        return 0.
+    order = np.argsort(-scores, kind="mergesort")
+    tp = tp[order]
+    tp_sum = np.cumsum(tp)
+    recall = tp_sum / float(num_gt)
+    precision = tp_sum / np.arange(1., len(tp) + 1)
+    # precision envelope, max precision at any recall >= r
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    index = np.searchsorted(recall, RECALL_POSITIONS, side="left")
+    return float(np.where(index < len(precision), precision[np.minimum(index, len(precision) - 1)], 0.).mean())
+
+def evaluate(detections, label_index, is_velo_cam=False, iou_threshold=0.7, use_3d=False):
+    """AP per difficulty of {frame_id: (corners, scores)} against a LabelIndex"""
+    pooled = dict((difficulty[0], ([], [], 0)) for difficulty in DIFFICULTIES)
+    for frame_id, (corners, scores) in detections.items():
+        gt = ground_truth(label_index, label_index.index(frame_id), is_velo_cam=is_velo_cam)
+        iou = frame_iou(corners, gt, use_3d=use_3d)
+        for difficulty in DIFFICULTIES:
+            frame_scores, frame_tp, num_gt = match_frame(iou, scores, gt, difficulty, iou_threshold=iou_threshold)
+            all_scores, all_tp, total = pooled[difficulty[0]]
+            all_scores.append(frame_scores)
+            all_tp.append(frame_tp)
+            pooled[difficulty[0]] = (all_scores, all_tp, total + num_gt)
+    result = {}
+    for name, (all_scores, all_tp, total) in pooled.items():
+        scores = np.concatenate(all_scores) if all_scores else np.zeros(0)
+        tp = np.concatenate(all_tp) if all_tp else np.zeros(0, dtype=bool)
+        result[name] = average_precision(scores, tp, total)
+    return result
+
+def run_detector(detector, velodyne_path, batch_num=1, dataformat="bin"):
+    """{frame_id: (corners, scores)} of every scan of a split"""
+    velodynes_path = sorted(glob.glob(velodyne_path))
+    detections = {}
+    for start in range(0, len(velodynes_path), batch_num):
+        paths = velodynes_path[start:start + batch_num]
+        pcs = [load_pc_from_bin(path) if dataformat == "bin" else load_pc_from_pcd(path) for path in paths]
+        for path, detection in zip(paths, detector.detect(pcs)):
+            detections[frame_id_of(path)] = detection
+    return detections
+
+def save_detections(path, detections):
+    frame_ids = sorted(detections)
+    counts = [len(detections[frame_id][1]) for frame_id in frame_ids]
+    np.savez(path, frame_ids=np.array(frame_ids), offsets=np.concatenate(([0], np.cumsum(counts))).astype(np.int64), \
+        corners=np.concatenate([detections[frame_id][0] for frame_id in frame_ids] + [np.zeros((0, 8, 3))]), \
+        scores=np.concatenate([detections[frame_id][1] for frame_id in frame_ids] + [np.zeros(0)]))
+
+def load_detections(path):
+    with np.load(path) as data:
+        offsets = data["offsets"]
+        return dict((str(frame_id), (data["corners"][offsets[i]:offsets[i + 1]], data["scores"][offsets[i]:offsets[i + 1]])) \
+            for i, frame_id in enumerate(data["frame_ids"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KiTTI Car AP (bird's eye view and 3D, IoU 0.7) of the detector over a split")
+    parser.add_argument("--velodyne", default="../data/training/velodyne/*.bin")
+    parser.add_argument("--label", default="../data/training/label_2/*.txt")
+    parser.add_argument("--calib", default="../data/training/calib/*.txt")
+    parser.add_argument("--checkpoint", default="./velodyne_025_deconv_norm_valid40.ckpt")
+    parser.add_argument("--detections", default=None, help="npz of saved detections: read when it exists, written after running the detector otherwise")
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--resolution", type=float, default=0.25)
+    parser.add_argument("--scale", type=int, default=8)
+    parser.add_argument("--threshold", type=float, default=0.995)
+    parser.add_argument("--iou", type=float, default=0.7)
+    parser.add_argument("--is-velo-cam", action="store_true")
+    args = parser.parse_args()
+
+    label_index = LabelIndex(args.label, args.calib)
+    if args.detections and os.path.exists(args.detections):
+        detections = load_detections(args.detections)
+    else:
+        from model_01_deconv import Detector
+        x, y, z = (0, 90), (-50, 50), (-5.5, 4.5)
+        with Detector(args.checkpoint, resolution=args.resolution, scale=args.scale, voxel_shape=voxel_grid_shape(args.resolution, x, y, z), \
+                      x=x, y=y, z=z, threshold=args.threshold) as detector:
+            detections = run_detector(detector, args.velodyne, batch_num=args.batch)
+            print(detector.latency_summary())
+        if args.detections:
+            save_detections(args.detections, detections)
+
+    start = time.time()
+    for metric, use_3d in (("bev", False), ("3d", True)):
+        ap = evaluate(detections, label_index, is_velo_cam=args.is_velo_cam, iou_threshold=args.iou, use_3d=use_3d)
+        print("Car %s AP@%.2f: easy %.2f moderate %.2f hard %.2f" % (metric, args.iou, ap["easy"] * 100, ap["moderate"] * 100, ap["hard"] * 100))
+    print("evaluated %d frames in %.1f s" % (len(detections), time.time() - start))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+import os
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from input_velodyne import *
+from model_01_deconv import ssd_model, Detector
+
+MODEL_SCOPE = "3D_CNN_model"
+OUTPUT_NAMES = ("objectness", "cordinate", "y")
+BN_EPS = 1e-5
+
+
+def _layer_scope(name):
+    """conv layer scope of an op name, e.g. "3D_CNN_model/conv3Dlayer2" """
+    parts = name.split("/")
+    for i, part in enumerate(parts):
+        if part.startswith("conv3D"):
+            return "/".join(parts[:i + 1])
+    return None
+
+def read_layers(graph, values):
+    """Conv3D layers of an inference graph in build order, with their restored variables
+
+    # Returns:
+        layers (list): dicts of scope, input scope (None for the voxel input),
+            strides, padding, relu and the weights, bias, gamma, beta,
+            pop_mean, pop_var arrays of the scope (None when it has none).
+    """
+    ops = graph.get_operations()
+    relu_scopes = set(_layer_scope(op.name) for op in ops if op.type == "Relu")
+    layers = []
+    for op in ops:
+        if op.type in ("Conv2D", "Conv3DBackpropInputV2"):
+            raise ValueError("only the 3D voxel graph can be exported, found %s" % op.name)
+        if op.type != "Conv3D":
+            continue
+        scope = _layer_scope(op.name)
+        padding = op.get_attr("padding")
+        layer = dict(scope=scope, input=_layer_scope(op.inputs[0].op.name), strides=list(op.get_attr("strides")), \
+            padding=padding.decode() if isinstance(padding, bytes) else padding, relu=scope in relu_scopes)
+        for name in ("weights", "bias", "gamma", "beta", "pop_mean", "pop_var"):
+            layer[name] = values.get(scope + "/" + name)
+        layers.append(layer)
+    return layers
+
+def fold_batch_norm(layer, eps=BN_EPS):
+    """Fold the inference batch norm that follows the ReLU into the conv
+
+    bn(relu(z)) = s * relu(z) + t with s = gamma / sqrt(pop_var + eps) and
+    t = beta - pop_mean * s, and s * relu(z) = sign(s) * relu(|s| * z), so
+    |s| scales the weights and bias, and sign(s) (only when some s < 0) and
+    t remain as a per channel multiply and add after the ReLU.
+    # Returns:
+        weights, bias, sign (None when all positive), shift
+    """
+    weights, bias = layer["weights"], layer["bias"]
+    if bias is None:
+        bias = np.zeros(weights.shape[-1], dtype=np.float32)
+    if layer["gamma"] is None:
+        return weights, bias, None, None
+    s = layer["gamma"] / np.sqrt(layer["pop_var"] + eps)
+    shift = layer["beta"] - layer["pop_mean"] * s
+    sign = np.where(s < 0, -1., 1.).astype(np.float32)
+    return (weights * np.abs(s)).astype(np.float32), (bias * np.abs(s)).astype(np.float32), \
+        sign if (sign < 0).any() else None, shift.astype(np.float32)
+
+def quantize_weights(weights):
+    """Symmetric int8 per output channel: (int8 weights, float32 scale) with weights ~ q * scale"""
+    scale = np.abs(weights).reshape(-1, weights.shape[-1]).max(axis=0) / 127.
+    scale = np.where(scale > 0, scale, 1.).astype(np.float32)
+    return np.clip(np.round(weights / scale), -127, 127).astype(np.int8), scale
+
+def build_folded_graph(layers, voxel_shape, precision="float32", ranges=None, input_dtype=tf.float32):
+    """Constant only inference graph of the folded layers, input "voxel", outputs OUTPUT_NAMES
+
+    precision "float16" computes in half precision. "int8_weights" stores
+    int8 per channel weights, "int8" also rounds the activations another
+    layer reads to 8 bits within their calibrated per channel (min, max)
+    ranges (simulated, TensorFlow has no int8 Conv3D kernel). Layer outputs
+    are named "layer<i>/output".
+    """
+    dtype = tf.float16 if precision == "float16" else tf.float32
+    graph = tf.Graph()
+    with graph.as_default():
+        voxel = tf.placeholder(input_dtype, [None, voxel_shape[0], voxel_shape[1], voxel_shape[2], 1], name="voxel")
+        outputs = {None: tf.cast(voxel, dtype) if input_dtype != dtype else voxel}
+        consumed = set(layer["input"] for layer in layers)
+        for i, layer in enumerate(layers):
+            weights, bias, sign, shift = fold_batch_norm(layer)
+            with tf.name_scope("layer%d" % i):
+                if precision.startswith("int8"):
+                    q, scale = quantize_weights(weights)
+                    kernel = tf.cast(tf.constant(q), tf.float32) * tf.constant(scale)
+                else:
+                    kernel = tf.constant(weights.astype(dtype.as_numpy_dtype))
+                out = tf.nn.conv3d(outputs[layer["input"]], kernel, layer["strides"], padding=layer["padding"])
+                if layer["bias"] is not None or shift is not None:
+                    out = tf.nn.bias_add(out, tf.constant(bias.astype(dtype.as_numpy_dtype)))
+                if layer["relu"]:
+                    out = tf.nn.relu(out)
+                if sign is not None:
+                    out = tf.multiply(out, tf.constant(sign.astype(dtype.as_numpy_dtype)))
+                if shift is not None:
+                    out = tf.nn.bias_add(out, tf.constant(shift.astype(dtype.as_numpy_dtype)))
+                if precision == "int8" and ranges is not None and layer["scope"] in consumed:
+                    lower, upper = np.minimum(ranges[i][0], 0), np.maximum(ranges[i][1], 0)
+                    out = tf.quantization.fake_quant_with_min_max_vars_per_channel(out, lower.astype(np.float32), \
+                        upper.astype(np.float32), num_bits=8)
+                out = tf.identity(out, name="output")
+            outputs[layer["scope"]] = out
+        objectness = tf.identity(tf.cast(outputs[MODEL_SCOPE + "/conv3Dobjectness"], tf.float32), name="objectness")
+        tf.identity(tf.cast(outputs[MODEL_SCOPE + "/conv3Dcordinate"], tf.float32), name="cordinate")
+        tf.nn.softmax(objectness, axis=-1, name="y")
+    return graph
+
+def load_layers(checkpoint, voxel_shape=(360, 400, 40)):
+    """read_layers of a voxel model checkpoint restored into the inference graph"""
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph) as sess:
+        ssd_model(sess, voxel_shape=voxel_shape, activation=tf.nn.relu, is_training=None)
+        variables = tf.global_variables()
+        tf.train.Saver(variables).restore(sess, checkpoint)
+        values = dict(zip([v.op.name for v in variables], sess.run(variables)))
+        return read_layers(graph, values)
+
+def write_graph(graph, output_path):
+    """Serialize the OUTPUT_NAMES subgraph of graph to output_path"""
+    graph_def = tf.graph_util.extract_sub_graph(graph.as_graph_def(), list(OUTPUT_NAMES))
+    with open(output_path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    return graph_def
+
+def export(checkpoint, output_path, voxel_shape=(360, 400, 40)):
+    """Freeze a voxel model checkpoint into a batch norm folded GraphDef at output_path"""
+    return write_graph(build_folded_graph(load_layers(checkpoint, voxel_shape), voxel_shape), output_path)
+
+def compare(checkpoint, frozen_path, pc, voxel_shape=(360, 400, 40), resolution=0.25, scale=8, x=(0, 90), y=(-50, 50), z=(-5.5, 4.5), repeat=5):
+    """Load time, per frame latency and max output difference of the checkpoint against the frozen graph"""
+    results = {}
+    outputs = {}
+    for name, path in (("checkpoint", checkpoint), ("frozen", frozen_path)):
+        start = time.time()
+        detector = Detector(path, resolution=resolution, scale=scale, voxel_shape=voxel_shape, x=x, y=y, z=z)
+        load_time = time.time() - start
+        with detector:
+            batch_voxel = detector.preprocess([pc])
+            outputs[name] = detector.run(batch_voxel)
+            durations = []
+            for _ in range(repeat):
+                start = time.time()
+                detector.run(batch_voxel)
+                durations.append(time.time() - start)
+        results[name] = (load_time, np.median(durations))
+    diff = max(float(np.abs(a - b).max()) for a, b in zip(outputs["checkpoint"], outputs["frozen"]))
+    return results, diff
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a voxel checkpoint to a frozen graph with batch norm folded into the convolutions")
+    parser.add_argument("--checkpoint", default="./velodyne_025_deconv_norm_valid40.ckpt")
+    parser.add_argument("--output", default="./velodyne_025_deconv_norm_valid40.pb")
+    parser.add_argument("--resolution", type=float, default=0.25)
+    parser.add_argument("--scale", type=int, default=8)
+    parser.add_argument("--compare", default=None, help="scan to compare the checkpoint and the frozen graph on")
+    args = parser.parse_args()
+
+    x, y, z = (0, 90), (-50, 50), (-5.5, 4.5)
+    voxel_shape = voxel_grid_shape(args.resolution, x, y, z)
+    graph_def = export(args.checkpoint, args.output, voxel_shape=voxel_shape)
+    print("wrote %s: %d nodes, %.1f MB" % (args.output, len(graph_def.node), os.path.getsize(args.output) / 1e6))
+    if args.compare:
+        results, diff = compare(args.checkpoint, args.output, load_pc_from_bin(args.compare), voxel_shape=voxel_shape, \
+            resolution=args.resolution, scale=args.scale, x=x, y=y, z=z)
+        for name, (load_time, latency) in sorted(results.items()):
+            print("%-10s load %.2f s, inference %.1f ms/frame" % (name, load_time, latency * 1000))
+        print("max output difference %.2e" % diff)
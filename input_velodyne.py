@@ -8,9 +8,15 @@ import pcl
 import glob
 import math
 import std_msgs.msg
-import sensor_msgs.point_cloud2 as pc2
-from sensor_msgs.msg import PointCloud2
-from parse_xml import parseXML
+from sensor_msgs.msg import PointCloud2, PointField
+from visualization_msgs.msg import Marker
+from geometry_msgs.msg import Point
+from parse_xml import parseXML, TrackletIndex
+import tracing
+try:
+    import numba
+except ImportError:
+    numba = None
 
 
 def load_pc_from_pcd(pcd_path):
@@ -25,7 +31,6 @@ def load_pc_from_bin(bin_path):
 
 def read_label_from_txt(label_path):
     """Read label from txt file."""
-    text = np.fromfile(label_path)
     bounding_box = []
     with open(label_path, "r") as f:
         labels = f.read().split("\n")
@@ -45,53 +50,61 @@ def read_label_from_txt(label_path):
     else:
         return None, None, None
 
+_tracklet_index = {}
+
 def read_label_from_xml(label_path):
     """Read label from xml file.
 
+    The tracklets of a drive are indexed once per process, read_labels then
+    slices the boxes of any frame out of it.
     # Returns:
-        label_dic (dictionary): labels for one sequence.
-        size (list): Bounding Box Size. [l, w. h]?
+        tracklet_index (TrackletIndex): labels for one sequence, sorted by frame.
     """
-    labels = parseXML(label_path)
-    label_dic = {}
-    for label in labels:
-        first_frame = label.firstFrame
-        nframes = label.nFrames
-        size = label.size
-        obj_type = label.objectType
-        for index, place, rotate in zip(range(first_frame, first_frame+nframes), label.trans, label.rots):
-            if index in label_dic.keys():
-                label_dic[index]["place"] = np.vstack((label_dic[index]["place"], place))
-                label_dic[index]["size"] = np.vstack((label_dic[index]["size"], np.array(size)))
-                label_dic[index]["rotate"] = np.vstack((label_dic[index]["rotate"], rotate))
-            else:
-                label_dic[index] = {}
-                label_dic[index]["place"] = place
-                label_dic[index]["rotate"] = rotate
-                label_dic[index]["size"] = np.array(size)
-    return label_dic, size
+    if label_path not in _tracklet_index:
+        _tracklet_index[label_path] = TrackletIndex(parseXML(label_path, cacheFile=label_path + ".npz"))
+    return _tracklet_index[label_path]
+
+def scan_frame(velodyne_path, default=30):
+    """Frame number of a raw drive scan such as 0000000030.bin, default when the name is not a number"""
+    name = os.path.splitext(os.path.basename(velodyne_path))[0]
+    return int(name) if name.isdigit() else default
 
 def read_calib_file(calib_path):
     """Read a calibration file."""
-    data = {}
     with open(calib_path, 'r') as f:
-        for line in f.readlines():
-            if not line or line == "\n":
-                continue
-            key, value = line.split(':', 1)
-            try:
-                data[key] = np.array([float(x) for x in value.split()])
-            except ValueError:
-                pass
+        return parse_calib(f.read())
+
+def parse_calib(text):
+    """Parse the text of a calibration file into a dict of float arrays."""
+    data = {}
+    for line in text.split("\n"):
+        if not line.strip():
+            continue
+        key, value = line.split(':', 1)
+        try:
+            data[key] = np.array(value.split(), dtype=np.float64)
+        except ValueError:
+            pass
     return data
 
+_proj_velo = {}
+
 def proj_to_velo(calib_data):
-    """Projection matrix to 3D axis for 3D Label"""
+    """Projection matrix to 3D axis for 3D Label
+
+    KiTTI shares one calibration across many frames, so the inverses are
+    memoized on the matrix values. The returned array is read only.
+    """
     rect = calib_data["R0_rect"].reshape(3, 3)
     velo_to_cam = calib_data["Tr_velo_to_cam"].reshape(3, 4)
-    inv_rect = np.linalg.inv(rect)
-    inv_velo_to_cam = np.linalg.pinv(velo_to_cam[:, :3])
-    return np.dot(inv_velo_to_cam, inv_rect)
+    key = (rect.tobytes(), velo_to_cam.tobytes())
+    if key not in _proj_velo:
+        inv_rect = np.linalg.inv(rect)
+        inv_velo_to_cam = np.linalg.pinv(velo_to_cam[:, :3])
+        proj_velo = np.dot(inv_velo_to_cam, inv_rect)
+        proj_velo.flags.writeable = False
+        _proj_velo[key] = proj_velo
+    return _proj_velo[key]
 
 
 def filter_camera_angle(places):
@@ -117,58 +130,143 @@ def create_publish_obj(obj, places, rotates, size):
                     obj.append((a, b, c))
     return obj
 
+# Corner order of get_boxcorners as signs of the (l / 2, w / 2, h) offset from the bottom center
+BOX_CORNER_SIGNS = np.array([
+    [-1, -1, 0],
+    [1, -1, 0],
+    [-1, 1, 0],
+    [-1, -1, 1],
+    [-1, 1, 1],
+    [1, 1, 0],
+    [1, -1, 1],
+    [1, 1, 1],
+], dtype=np.float64)
+
 def get_boxcorners(places, rotates, size):
-    """Create 8 corners of bounding box from bottom center."""
-    corners = []
-    for place, rotate, sz in zip(places, rotates, size):
-        x, y, z = place
-        h, w, l = sz
-        if l > 10:
-            continue
+    """Create 8 corners of bounding box from bottom center.
+
+    # Args:
+        places (np.ndarray): (N, 3) bottom centers.
+        rotates (np.ndarray): (N,) yaw around the z axis.
+        size (np.ndarray): (N, 3) [h, w, l], boxes longer than 10m are dropped.
+    # Returns:
+        corners (np.ndarray): (N, 8, 3)
+    """
+    places = np.asarray(places, dtype=np.float64).reshape(-1, 3)
+    rotates = np.asarray(rotates, dtype=np.float64).reshape(-1)
+    size = np.asarray(size, dtype=np.float64).reshape(-1, 3)
+    keep = size[:, 2] <= 10
+    places, rotates, size = places[keep], rotates[keep], size[keep]
+
+    half = np.stack((size[:, 2] / 2., size[:, 1] / 2., size[:, 0]), axis=1)
+    offset = BOX_CORNER_SIGNS[np.newaxis] * half[:, np.newaxis]
+    cos = np.cos(rotates)[:, np.newaxis]
+    sin = np.sin(rotates)[:, np.newaxis]
+    corners = np.empty_like(offset)
+    corners[:, :, 0] = offset[:, :, 0] * cos - offset[:, :, 1] * sin + places[:, np.newaxis, 0]
+    corners[:, :, 1] = offset[:, :, 0] * sin + offset[:, :, 1] * cos + places[:, np.newaxis, 1]
+    corners[:, :, 2] = offset[:, :, 2] + places[:, np.newaxis, 2]
+    return corners
+
+def boxcorners_to_center(corners):
+    """Inverse of get_boxcorners: bottom center, yaw and [h, w, l] of (N, 8, 3) corners.
+
+    Each edge direction is averaged over the parallel edges, so slightly
+    deformed boxes regressed by the network decode to the closest box.
+    """
+    corners = np.asarray(corners, dtype=np.float64).reshape(-1, 8, 3)
+    bottom = corners[:, [0, 1, 5, 2]]
+    top = corners[:, [3, 6, 7, 4]]
+    places = bottom.mean(axis=1)
+    length = ((bottom[:, 1] - bottom[:, 0]) + (bottom[:, 2] - bottom[:, 3])) / 2.
+    width = ((bottom[:, 3] - bottom[:, 0]) + (bottom[:, 2] - bottom[:, 1])) / 2.
+    size = np.stack((top[:, :, 2].mean(axis=1) - places[:, 2], np.hypot(width[:, 0], width[:, 1]), np.hypot(length[:, 0], length[:, 1])), axis=1)
+    rotates = np.arctan2(length[:, 1], length[:, 0])
+    return places, rotates, size
+
+# x, y, z, intensity float32 points, the memory layout of load_pc_from_bin
+POINT_DTYPE = np.dtype([("x", "<f4"), ("y", "<f4"), ("z", "<f4"), ("intensity", "<f4")])
+POINT_FIELDS = [PointField(name, POINT_DTYPE.fields[name][1], PointField.FLOAT32, 1) for name in POINT_DTYPE.names]
+# Corner pairs of the 12 edges of a get_boxcorners box: bottom, top, then the vertical edges
+BOX_EDGES = np.array([[0, 1], [1, 5], [5, 2], [2, 0], [3, 6], [6, 7], [7, 4], [4, 3], [0, 3], [1, 6], [5, 7], [2, 4]])
+
+def pointcloud2(pc, header):
+    """PointCloud2 of (N, 3) or (N, 4) points, serialized from the numpy buffer
+
+    A float32 (N, 4) scan already has the POINT_DTYPE layout and is copied
+    once into the message data, other points are packed into a structured
+    array (intensity 0 when missing); no per point Python packing.
+    """
+    pc = np.asarray(pc)
+    if pc.dtype == np.float32 and pc.ndim == 2 and pc.shape[1] == 4:
+        points = np.ascontiguousarray(pc)
+    else:
+        points = np.zeros(len(pc), dtype=POINT_DTYPE)
+        for i, name in enumerate(POINT_DTYPE.names[:pc.shape[1]]):
+            points[name] = pc[:, i]
+    return PointCloud2(header=header, height=1, width=len(pc), fields=POINT_FIELDS, is_bigendian=False, \
+        point_step=POINT_DTYPE.itemsize, row_step=POINT_DTYPE.itemsize * len(pc), data=points.tobytes(), is_dense=True)
+
+def box_marker(corners, header, color=(0., 1., 0., 1.), width=0.05):
+    """LINE_LIST Marker of the edges of (N, 8, 3) box corners"""
+    marker = Marker(header=header, ns="boxes", id=0, type=Marker.LINE_LIST, action=Marker.ADD)
+    marker.pose.orientation.w = 1.
+    marker.scale.x = width
+    marker.color.r, marker.color.g, marker.color.b, marker.color.a = color
+    marker.points = [Point(x, y, z) for x, y, z in np.asarray(corners).reshape(-1, 8, 3)[:, BOX_EDGES].reshape(-1, 3).tolist()]
+    return marker
+
+
+class PointCloudPublisher(object):
+    """ROS publishers of scans and box markers, created once and reused for every frame
+
+    The node is initialized on first use unless the process already is one.
+    Publishers keep queue_size messages, so a slow subscriber drops old
+    frames instead of buffering them.
+    """
+
+    def __init__(self, node_name="pc2_publisher", frame_id="velodyne", queue_size=1):
+        if not rospy.core.is_initialized():
+            rospy.init_node(node_name, anonymous=True)
+        self.frame_id = frame_id
+        self.queue_size = queue_size
+        self.publishers = {}
+
+    def publisher(self, topic, msg_type):
+        if topic not in self.publishers:
+            self.publishers[topic] = rospy.Publisher(topic, msg_type, queue_size=self.queue_size)
+        return self.publishers[topic]
+
+    def header(self, stamp=None):
+        header = std_msgs.msg.Header()
+        header.stamp = rospy.Time.now() if stamp is None else rospy.Time.from_sec(stamp)
+        header.frame_id = self.frame_id
+        return header
+
+    def publish_cloud(self, pc, topic="/points_raw", stamp=None):
+        self.publisher(topic, PointCloud2).publish(pointcloud2(pc, self.header(stamp)))
+
+    def publish_boxes(self, corners, topic="/boxes", stamp=None):
+        self.publisher(topic, Marker).publish(box_marker(corners, self.header(stamp)))
 
-        corner = np.array([
-            [x - l / 2., y - w / 2., z],
-            [x + l / 2., y - w / 2., z],
-            [x - l / 2., y + w / 2., z],
-            [x - l / 2., y - w / 2., z + h],
-            [x - l / 2., y + w / 2., z + h],
-            [x + l / 2., y + w / 2., z],
-            [x + l / 2., y - w / 2., z + h],
-            [x + l / 2., y + w / 2., z + h],
-        ])
-
-        corner -= np.array([x, y, z])
-
-        rotate_matrix = np.array([
-            [np.cos(rotate), -np.sin(rotate), 0],
-            [np.sin(rotate), np.cos(rotate), 0],
-            [0, 0, 1]
-        ])
-
-        a = np.dot(corner, rotate_matrix.transpose())
-        a += np.array([x, y, z])
-        corners.append(a)
-    return np.array(corners)
+_publisher = None
 
 def publish_pc2(pc, obj):
-    """Publisher of PointCloud data"""
-    pub = rospy.Publisher("/points_raw", PointCloud2, queue_size=1000000)
-    rospy.init_node("pc2_publisher")
-    header = std_msgs.msg.Header()
-    header.stamp = rospy.Time.now()
-    header.frame_id = "velodyne"
-    points = pc2.create_cloud_xyz32(header, pc[:, :3])
-
-    pub2 = rospy.Publisher("/points_raw1", PointCloud2, queue_size=1000000)
-    header = std_msgs.msg.Header()
-    header.stamp = rospy.Time.now()
-    header.frame_id = "velodyne"
-    points2 = pc2.create_cloud_xyz32(header, obj)
+    """Publisher of PointCloud data, obj (N * 8, 3) box corners are drawn on /boxes too"""
+    global _publisher
+    if _publisher is None:
+        _publisher = PointCloudPublisher()
+    header = _publisher.header()
+    points = pointcloud2(pc, header)
+    points2 = pointcloud2(obj, header)
+    boxes = box_marker(obj, header) if len(obj) % 8 == 0 else None
 
     r = rospy.Rate(0.1)
     while not rospy.is_shutdown():
-        pub.publish(points)
-        pub2.publish(points2)
+        _publisher.publisher("/points_raw", PointCloud2).publish(points)
+        _publisher.publisher("/points_raw1", PointCloud2).publish(points2)
+        if boxes is not None:
+            _publisher.publisher("/boxes", Marker).publish(boxes)
         r.sleep()
 
 def raw_to_voxel(pc, resolution=0.50, x=(0, 90), y=(-50, 50), z=(-4.5, 5.5)):
@@ -182,6 +280,146 @@ def raw_to_voxel(pc, resolution=0.50, x=(0, 90), y=(-50, 50), z=(-4.5, 5.5)):
     voxel[pc[:, 0], pc[:, 1], pc[:, 2]] = 1
     return voxel
 
+def voxel_grid_shape(resolution=0.50, x=(0, 90), y=(-50, 50), z=(-4.5, 5.5)):
+    """Shape of the dense grid that raw_to_voxel allocates for this ROI"""
+    return (int((x[1] - x[0]) / resolution), int((y[1] - y[0]) / resolution), int(round((z[1]-z[0]) / resolution)))
+
+def raw_to_sparse_voxel(pc, resolution=0.50, x=(0, 90), y=(-50, 50), z=(-4.5, 5.5), camera_angle=False):
+    """Convert PointCloud to occupied voxels without allocating the dense grid
+
+    # Returns:
+        coords (np.ndarray): int32 (M, 3) index of every occupied voxel, sorted in C order.
+        features (np.ndarray): float32 (M, 5) per voxel [count, mean x, mean y, mean z, max intensity].
+    """
+    index, keep = voxel_index(pc, resolution=resolution, x=x, y=y, z=z, camera_angle=camera_angle)
+    return index_to_sparse_voxel(index, pc[keep], voxel_grid_shape(resolution, x, y, z))
+
+def raw_to_bird_view(pc, resolution=0.50, x=(0, 90), y=(-50, 50), z=(-4.5, 5.5), slices=4, camera_angle=True):
+    """Bird's eye view maps of a scan on the x / y grid of raw_to_voxel
+
+    The z axis of the voxel grid is cut into slices equal slabs, each one
+    channel holding the max height above z[0] of its points.
+    # Returns:
+        bev (np.ndarray): float32 (X, Y, slices + 2) [max height of every slice, max intensity, density],
+            density being min(1, log(N + 1) / log(64)) of the N points in the cell.
+    """
+    shape = voxel_grid_shape(resolution, x, y, z)
+    index, keep = voxel_index(pc, resolution=resolution, x=x, y=y, z=z, camera_angle=camera_angle)
+    index = np.minimum(index, np.array(shape) - 1)
+    cell = index[:, 0].astype(np.int64) * shape[1] + index[:, 1]
+    layer = index[:, 2] * slices // shape[2]
+    height = pc[keep, 2] - z[0]
+    intensity = pc[keep, 3]
+    bev = np.zeros((shape[0] * shape[1], slices + 2), dtype=np.float32)
+
+    key = cell * slices + layer
+    order = np.lexsort((height, key))
+    top = order[np.append(key[order][1:] != key[order][:-1], True)] if len(order) else order
+    bev[cell[top], layer[top]] = height[top]
+    order = np.lexsort((intensity, cell))
+    top = order[np.append(cell[order][1:] != cell[order][:-1], True)] if len(order) else order
+    bev[cell[top], slices] = intensity[top]
+    bev[:, slices + 1] = np.minimum(1., np.log(np.bincount(cell, minlength=len(bev)) + 1) / np.log(64))
+    return bev.reshape(shape[0], shape[1], slices + 2)
+
+if numba is not None:
+    @numba.njit(cache=True, nogil=True)
+    def _voxel_index_kernel(pc, lower, upper, resolution, camera_angle, index, keep):
+        n = 0
+        for i in range(pc.shape[0]):
+            px = pc[i, 0]
+            py = pc[i, 1]
+            pz = pc[i, 2]
+            if px < lower[0] or px >= upper[0] or py < lower[1] or py >= upper[1] or pz < lower[2] or pz >= upper[2]:
+                continue
+            if camera_angle:
+                shifted = px - np.float32(0.27)
+                if py >= shifted or -py >= shifted:
+                    continue
+            index[n, 0] = int((px - lower[0]) / resolution)
+            index[n, 1] = int((py - lower[1]) / resolution)
+            index[n, 2] = int((pz - lower[2]) / resolution)
+            keep[n] = i
+            n += 1
+        return n
+
+def voxel_index(pc, resolution=0.50, x=(0, 90), y=(-50, 50), z=(-4.5, 5.5), camera_angle=True, out=None):
+    """Camera angle filter, ROI crop and voxel indexing in a single pass
+
+    Gives the same voxels as raw_to_voxel(filter_camera_angle(pc)) without the
+    full size temporaries. Compiled with numba when it is installed.
+
+    # Args:
+        out (tuple): optional preallocated (index, keep) buffers of at least len(pc) rows, reused across frames.
+    # Returns:
+        index (np.ndarray): int32 (M, 3) voxel index of every kept point.
+        keep (np.ndarray): row of every kept point in pc.
+    """
+    lower = np.array([x[0], y[0], z[0]], dtype=np.float64)
+    if numba is not None:
+        upper = np.array([x[1], y[1], z[1]], dtype=np.float64)
+        if out is None or len(out[0]) < len(pc):
+            out = (np.empty((len(pc), 3), dtype=np.int32), np.empty(len(pc), dtype=np.int64))
+        n = _voxel_index_kernel(pc, lower, upper, float(resolution), camera_angle, out[0], out[1])
+        return out[0][:n], out[1][:n]
+
+    xs, ys, zs = pc[:, 0], pc[:, 1], pc[:, 2]
+    mask = xs >= x[0]
+    mask &= xs < x[1]
+    mask &= ys >= y[0]
+    mask &= ys < y[1]
+    mask &= zs >= z[0]
+    mask &= zs < z[1]
+    if camera_angle:
+        shifted = xs - np.float32(0.27)
+        mask &= ys < shifted
+        mask &= ys > -shifted
+    keep = np.flatnonzero(mask)
+    if out is not None and len(out[0]) >= len(keep):
+        index = out[0][:len(keep)]
+    else:
+        index = np.empty((len(keep), 3), dtype=np.int32)
+    np.copyto(index, (pc[keep, :3] - lower) / resolution, casting="unsafe")
+    return index, keep
+
+def index_to_sparse_voxel(index, pc, shape):
+    """Reduce per point voxel indices to occupied voxels and their features"""
+    shape = np.array(shape, dtype=np.int64)
+    index = np.minimum(index, shape - 1)
+    keys = np.ravel_multi_index(index.T, shape)
+    intensity = pc[:, 3] if pc.shape[1] > 3 else np.zeros(len(pc), dtype=np.float32)
+    order = np.lexsort((intensity, keys))
+    keys = keys[order]
+    if not len(keys):
+        return np.zeros((0, 3), dtype=np.int32), np.zeros((0, 5), dtype=np.float32)
+    first = np.concatenate(([True], keys[1:] != keys[:-1]))
+    starts = np.flatnonzero(first)
+    last = np.append(starts[1:], len(keys)) - 1
+    group = np.cumsum(first) - 1
+
+    features = np.empty((len(starts), 5), dtype=np.float32)
+    count = np.bincount(group).astype(np.float32)
+    features[:, 0] = count
+    points = pc[order, :3]
+    for axis in range(3):
+        features[:, axis + 1] = np.bincount(group, weights=points[:, axis]) / count
+    features[:, 4] = intensity[order][last]
+    coords = np.array(np.unravel_index(keys[starts], shape), dtype=np.int32).T
+    return coords, features
+
+def sparse_to_voxel(coords, shape, values=None, dtype=np.float32):
+    """Densify occupied voxels into a grid, with 1 (or values) at each coordinate"""
+    voxel = np.zeros(shape, dtype=dtype)
+    voxel[coords[:, 0], coords[:, 1], coords[:, 2]] = 1 if values is None else values
+    return voxel
+
+def batch_sparse_to_voxel(batch_coords, shape, dtype=np.float32):
+    """Densify a list of occupied voxel sets straight into the network input (batch, x, y, z, 1)"""
+    voxel = np.zeros((len(batch_coords),) + tuple(shape) + (1,), dtype=dtype)
+    for index, coords in enumerate(batch_coords):
+        voxel[index, coords[:, 0], coords[:, 1], coords[:, 2], 0] = 1
+    return voxel
+
 def center_to_sphere(places, size, resolution=0.50, min_value=np.array([0., -50., -4.5]), scale=4, x=(0, 90), y=(-50, 50), z=(-4.5, 5.5)):
     """Convert object label to Training label for objectness loss"""
     x_logical = np.logical_and((places[:, 0] < x[1]), (places[:, 0] >= x[0]))
@@ -203,33 +441,36 @@ def voxel_to_corner(corner_vox, resolution, center):#TODO
     corners = center + corner_vox
     return corners
 
-def read_labels(label_path, label_type, calib_path=None, is_velo_cam=False, proj_velo=None):
+def read_labels(label_path, label_type, calib_path=None, is_velo_cam=False, proj_velo=None, frame=30):
     """Read labels from xml or txt file.
     Original Label value is shifted about 0.27m from object center.
     So need to revise the position of objects.
+    frame selects the frame of a raw drive xml.
     """
     if label_type == "txt": #TODO
         places, size, rotates = read_label_from_txt(label_path)
         if places is None:
             return None, None, None
-        rotates = np.pi / 2 - rotates
-        dummy = np.zeros_like(places)
-        dummy = places.copy()
-        if calib_path:
-            places = np.dot(dummy, proj_velo.transpose())[:, :3]
-        else:
-            places = dummy
-        if is_velo_cam:
-            places[:, 0] += 0.27
+        places, rotates = label_to_velo(places, rotates, proj_velo=proj_velo if calib_path else None, is_velo_cam=is_velo_cam)
 
     elif label_type == "xml":
-        bounding_boxes, size = read_label_from_xml(label_path)
-        places = bounding_boxes[30]["place"]
-        rotates = bounding_boxes[30]["rotate"][:, 2]
-        size = bounding_boxes[30]["size"]
+        places, rotates, size = read_label_from_xml(label_path).boxes(frame)
+        if not len(places):
+            return None, None, None
 
     return places, rotates, size
 
+def label_to_velo(places, rotates, proj_velo=None, is_velo_cam=False):
+    """Convert KiTTI camera coordinate label to velodyne coordinate"""
+    rotates = np.pi / 2 - rotates
+    if proj_velo is not None:
+        places = np.dot(places, proj_velo.transpose())[:, :3]
+    else:
+        places = places.copy()
+    if is_velo_cam:
+        places[:, 0] += 0.27
+    return places, rotates
+
 def create_label(places, size, corners, resolution=0.50, x=(0, 90), y=(-50, 50), z=(-4.5, 5.5), scale=4, min_value=np.array([0., -50., -4.5])):
     """Create training Labels which satisfy the range of experiment"""
     x_logical = np.logical_and((places[:, 0] < x[1]), (places[:, 0] >= x[0]))
@@ -241,10 +482,8 @@ def create_label(places, size, corners, resolution=0.50, x=(0, 90), y=(-50, 50),
     center[:, 2] = center[:, 2] + size[:, 0] / 2. # Move bottom to center
     sphere_center = ((center[xyz_logical] - min_value) / (resolution * scale)).astype(np.int32)
 
-    train_corners = corners[xyz_logical].copy()
     anchor_center = sphere_to_center(sphere_center, resolution=resolution, scale=scale, min_value=min_value) #sphere to center
-    for index, (corner, center) in enumerate(zip(corners[xyz_logical], anchor_center)):
-        train_corners[index] = corner - center
+    train_corners = (corners[xyz_logical] - anchor_center[:, np.newaxis]).astype(np.float32)
     return sphere_center, train_corners
 
 def corner_to_train(corners, sphere_center, resolution=0.50, x=(0, 90), y=(-50, 50), z=(-4.5, 5.5), scale=4, min_value=np.array([0., -50., -4.5])):
@@ -253,24 +492,138 @@ def corner_to_train(corners, sphere_center, resolution=0.50, x=(0, 90), y=(-50,
     y_logical = np.logical_and((corners[:, :, 1] < y[1]), (corners[:, :, 1] >= y[0]))
     z_logical = np.logical_and((corners[:, :, 2] < z[1]), (corners[:, :, 2] >= z[0]))
     xyz_logical = np.logical_and(x_logical, np.logical_and(y_logical, z_logical)).all(axis=1)
-    train_corners = corners[xyz_logical].copy()
     sphere_center = sphere_to_center(sphere_center, resolution=resolution, scale=scale, min_value=min_value) #sphere to center
-    for index, (corner, center) in enumerate(zip(corners[xyz_logical], sphere_center)):
-        train_corners[index] = corner - center
+    train_corners = (corners[xyz_logical] - sphere_center[:, np.newaxis]).astype(np.float32)
     return train_corners
 
 def corner_to_voxel(voxel_shape, corners, sphere_center, scale=4):
     """Create final regression label from corner"""
-    corner_voxel = np.zeros((voxel_shape[0] / scale, voxel_shape[1] / scale, voxel_shape[2] / scale, 24))
-    corner_voxel[sphere_center[:, 0], sphere_center[:, 1], sphere_center[:, 2]] = corners
+    corner_voxel = np.zeros((voxel_shape[0] // scale, voxel_shape[1] // scale, voxel_shape[2] // scale, 24), dtype=np.float32)
+    corner_voxel[sphere_center[:, 0], sphere_center[:, 1], sphere_center[:, 2]] = corners.reshape(-1, 24)
     return corner_voxel
 
+def corner_to_sparse(corners, sphere_center):
+    """Sparse regression label: the cells corner_to_voxel writes and their corner offsets
+
+    When two objects fall in the same cell the last one is kept, as in the dense label.
+    # Returns:
+        index (np.ndarray): int32 (K, 3) cells.
+        value (np.ndarray): float32 (K, 24) corner offsets.
+    """
+    _, last = np.unique(sphere_center[::-1], axis=0, return_index=True)
+    keep = np.sort(len(sphere_center) - 1 - last)
+    return sphere_center[keep].astype(np.int32), corners.reshape(-1, 24)[keep].astype(np.float32)
+
+def label_to_bird_view(center_sphere, g_cord, resolution=0.5, scale=4):
+    """Move objectness cells to z cell 0, the single z cell of the bird's eye view head
+
+    The z of the corner offsets grows by the anchor height removed, so the
+    decoded corners stay the same.
+    """
+    g_cord = g_cord.astype(np.float32)
+    g_cord[:, 2::3] += center_sphere[:, 2:3] * (resolution * scale)
+    center_sphere = center_sphere.copy()
+    center_sphere[:, 2] = 0
+    return center_sphere, g_cord
+
 def create_objectness_label(sphere_center, resolution=0.5, x=90, y=100, z=10, scale=4):
     """Create Objectness label"""
     obj_maps = np.zeros((int(x / (resolution * scale)), int(y / (resolution * scale)), int(round(z / (resolution * scale)))))
     obj_maps[sphere_center[:, 0], sphere_center[:, 1], sphere_center[:, 2]] = 1
     return obj_maps
 
+def load_frame(velodyne_path, label_path=None, calib_path=None, dataformat="pcd", label_type="txt", is_velo_cam=False, label_index=None):
+    """Load one scan and its labels in velodyne coordinates
+
+    label_index (a label_index.LabelIndex of the split) replaces parsing the
+    txt label and calibration of the frame.
+    # Returns:
+        pc, places, rotates, size (places is None when the frame has no usable label)
+    """
+    pc = None
+    places = None
+    rotates = None
+    size = None
+    proj_velo = None
+
+    if dataformat == "bin":
+        pc = load_pc_from_bin(velodyne_path)
+    elif dataformat == "pcd":
+        pc = load_pc_from_pcd(velodyne_path)
+
+    if label_index is not None and label_path:
+        places, rotates, size = label_index.labels_of(label_path, is_velo_cam=is_velo_cam)
+        return pc, places, rotates, size
+
+    if calib_path:
+        calib = read_calib_file(calib_path)
+        proj_velo = proj_to_velo(calib)[:, :3]
+
+    if label_path:
+        places, rotates, size = read_labels(label_path, label_type, calib_path=calib_path, is_velo_cam=is_velo_cam, proj_velo=proj_velo, \
+            frame=scan_frame(velodyne_path))
+    return pc, places, rotates, size
+
+def preprocess_frame(pc, places, rotates, size, resolution=0.2, scale=4, x=(0, 80), y=(-40, 40), z=(-2.5, 1.5), input_type="voxel", slices=4):
+    """Voxelize one scan and encode its labels for training
+
+    With input_type "bev" the scan is encoded by raw_to_bird_view and the
+    labels moved to z cell 0 by label_to_bird_view.
+    # Returns:
+        coords (np.ndarray): int32 (M, 3) occupied voxels, or the float32 (X, Y, slices + 2) bird's eye view.
+        center_sphere (np.ndarray): int32 (K, 3) objectness cells, empty when no object is inside the ROI.
+        g_cord (np.ndarray): float32 (K, 24) corner offsets from each objectness cell.
+    """
+    # the camera angle filter is fused into the voxelize span
+    with tracing.span("voxelize"):
+        if input_type == "bev":
+            coords = raw_to_bird_view(pc, resolution=resolution, x=x, y=y, z=z, slices=slices, camera_angle=True)
+        else:
+            coords, _ = raw_to_sparse_voxel(pc, resolution=resolution, x=x, y=y, z=z, camera_angle=True)
+    if places is None:
+        return coords, np.zeros((0, 3), dtype=np.int32), np.zeros((0, 24), dtype=np.float32)
+    with tracing.span("label"):
+        corners = get_boxcorners(places, rotates, size)
+        center_sphere, corner_label = create_label(places, size, corners, resolution=resolution, x=x, y=y, z=z, \
+            scale=scale, min_value=np.array([x[0], y[0], z[0]]))
+        g_cord = corner_label.reshape(corner_label.shape[0], -1).astype(np.float32)
+        if input_type == "bev":
+            center_sphere, g_cord = label_to_bird_view(center_sphere, g_cord, resolution=resolution, scale=scale)
+    return coords, center_sphere.astype(np.int32), g_cord
+
+def batch_to_train(frames, resolution=0.2, scale=4, x=(0, 80), y=(-40, 40), z=(-2.5, 1.5), sparse_cord=False, input_type="voxel"):
+    """Densify preprocessed frames into the voxel, g_map and g_cord network inputs
+
+    With sparse_cord, g_cord is the (index, value) pair of corner_to_sparse
+    with the batch position prepended to each index, (K, 4) and (K, 24).
+    With input_type "bev" the bird's eye views are stacked and the labels
+    are one z cell deep.
+    """
+    voxel_shape = voxel_grid_shape(resolution=resolution, x=x, y=y, z=z)
+    label_shape = voxel_shape
+    label_z = z[1] - z[0]
+    if input_type == "bev":
+        label_shape = (voxel_shape[0], voxel_shape[1], scale)
+        label_z = resolution * scale
+    batch_g_map = []
+    batch_g_cord = []
+    for i, (coords, center_sphere, g_cord) in enumerate(frames):
+        batch_g_map.append(create_objectness_label(center_sphere, resolution=resolution, x=(x[1] - x[0]), y=(y[1] - y[0]), z=label_z, scale=scale))
+        if sparse_cord:
+            index, value = corner_to_sparse(g_cord, center_sphere)
+            batch_g_cord.append((np.hstack((np.full((len(index), 1), i, dtype=np.int32), index)), value))
+        else:
+            batch_g_cord.append(corner_to_voxel(label_shape, g_cord, center_sphere, scale=scale))
+    if input_type == "bev":
+        batch_voxel = np.array([frame[0] for frame in frames], dtype=np.float32)
+    else:
+        batch_voxel = batch_sparse_to_voxel([frame[0] for frame in frames], voxel_shape)
+    if sparse_cord:
+        batch_g_cord = (np.concatenate([index for index, _ in batch_g_cord] + [np.zeros((0, 4), dtype=np.int32)]), \
+            np.concatenate([value for _, value in batch_g_cord] + [np.zeros((0, 24), dtype=np.float32)]))
+        return batch_voxel, np.array(batch_g_map, dtype=np.float32), batch_g_cord
+    return batch_voxel, np.array(batch_g_map, dtype=np.float32), np.array(batch_g_cord, dtype=np.float32)
+
 def process(velodyne_path, label_path=None, calib_path=None, dataformat="pcd", label_type="txt", is_velo_cam=False):
     p = []
     pc = None
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+import os
+import glob
+import numpy as np
+from input_velodyne import parse_calib, proj_to_velo, label_to_velo
+
+# Numeric KiTTI label columns, in file order after the type
+LABEL_COLUMNS = ("truncated", "occluded", "alpha", "bbox_left", "bbox_top", "bbox_right", "bbox_bottom", \
+                 "height", "width", "length", "x", "y", "z", "rotation_y")
+
+
+def frame_id_of(path):
+    """Frame id of a KiTTI file, e.g. "002397" for ".../label_2/002397.txt" """
+    return os.path.splitext(os.path.basename(path))[0]
+
+def parse_label_rows(text):
+    """Split KiTTI label text into (types, float32 (L, 14) columns), DontCare included"""
+    types = []
+    rows = []
+    for line in text.split("\n"):
+        if not line:
+            continue
+        label = line.split(" ")
+        types.append(label[0])
+        rows.append(label[1:15])
+    return types, np.array(rows, dtype=np.float32).reshape(-1, len(LABEL_COLUMNS))
+
+def car_labels(types, rows, proj_velo=None, is_velo_cam=False):
+    """Car labels of one frame in velodyne coordinate, as read_labels returns them"""
+    rows = rows[types == "Car"]
+    if not len(rows):
+        return None, None, None
+    places, rotates = label_to_velo(rows[:, 10:13], rows[:, 13], proj_velo=proj_velo, is_velo_cam=is_velo_cam)
+    return places, rotates, rows[:, 7:10]
+
+
+class LabelIndex(object):
+    """Labels and calibrations of a whole split, parsed once into columnar arrays
+
+    types (L,) and rows (L, 14) hold every object of the split in file order,
+    DontCare included for evaluation, and label_offsets[i]:label_offsets[i + 1]
+    are the objects of frame i. The label to velodyne projection is computed
+    once per distinct calibration and stored per frame in proj_velo, NaN when
+    the frame has no calibration. A single calib file calibrates every frame,
+    as in frame_sources.
+    """
+
+    def __init__(self, label_path, calib_path=None):
+        labels_path = sorted(glob.glob(label_path))
+        calibs_path = glob.glob(calib_path) if calib_path else []
+        single_calib = calibs_path[0] if len(calibs_path) == 1 else None
+        calibs_path = dict((frame_id_of(path), path) for path in calibs_path)
+
+        frame_ids = []
+        label_offsets = [0]
+        types = []
+        rows = []
+        proj_velo = []
+        projections = {}
+        for labels in labels_path:
+            frame_id = frame_id_of(labels)
+            with open(labels, "r") as f:
+                frame_types, frame_rows = parse_label_rows(f.read())
+            frame_ids.append(frame_id)
+            types.extend(frame_types)
+            rows.append(frame_rows)
+            label_offsets.append(label_offsets[-1] + len(frame_rows))
+
+            calib = single_calib or calibs_path.get(frame_id)
+            if calib:
+                with open(calib, "r") as f:
+                    text = f.read()
+                if text not in projections:
+                    projections[text] = proj_to_velo(parse_calib(text))[:, :3]
+                proj_velo.append(projections[text])
+            else:
+                proj_velo.append(np.full((3, 3), np.nan))
+
+        self.frame_ids = np.array(frame_ids)
+        self.label_offsets = np.array(label_offsets, dtype=np.int64)
+        self.types = np.array(types)
+        self.rows = np.concatenate(rows) if rows else np.zeros((0, len(LABEL_COLUMNS)), dtype=np.float32)
+        self.proj_velo = np.array(proj_velo).reshape(-1, 3, 3)
+        self._frame_index = dict((frame_id, i) for i, frame_id in enumerate(frame_ids))
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    def index(self, frame_id):
+        """Position of a frame id such as "002397" """
+        return self._frame_index[str(frame_id)]
+
+    def column(self, name):
+        """One LABEL_COLUMNS column for every object of the split"""
+        return self.rows[:, LABEL_COLUMNS.index(name)]
+
+    def frame_rows(self, i):
+        """(types, rows) of every object of frame i"""
+        start, end = self.label_offsets[i], self.label_offsets[i + 1]
+        return self.types[start:end], self.rows[start:end]
+
+    def labels(self, i, is_velo_cam=False):
+        """Car labels of frame i in velodyne coordinate"""
+        types, rows = self.frame_rows(i)
+        proj_velo = self.proj_velo[i]
+        return car_labels(types, rows, proj_velo=None if np.isnan(proj_velo).any() else proj_velo, is_velo_cam=is_velo_cam)
+
+    def labels_of(self, label_path, is_velo_cam=False):
+        """Car labels of the frame a label file belongs to"""
+        return self.labels(self.index(frame_id_of(label_path)), is_velo_cam=is_velo_cam)
+
+
+_opened = {}
+
+def open_labels(label_path, calib_path=None):
+    """Parse a split once per process"""
+    if (label_path, calib_path) not in _opened:
+        _opened[(label_path, calib_path)] = LabelIndex(label_path, calib_path)
+    return _opened[(label_path, calib_path)]
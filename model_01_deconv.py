@@ -3,6 +3,11 @@ import sys
 import numpy as np
 import tensorflow as tf
 from input_velodyne import *
+from packed_dataset import open_packed
+from data_pipeline import BatchPipeline, lidar_generator, frame_sources
+from postprocess import decode_boxes, nms
+import tracing
+from checkpointing import AsyncCheckpointer
 import glob
 import time
 
@@ -65,6 +70,49 @@ def fully_connected(input_layer, shape, name="", is_training=True):
         fully = batch_norm(fully, is_training)
         return fully
 
+def conv2DLayer(input_layer, input_dim, output_dim, height, width, stride, activation=tf.nn.relu, padding="SAME", name="", is_training=True):
+    with tf.variable_scope("conv2D" + name):
+        kernel = tf.get_variable("weights", shape=[height, width, input_dim, output_dim], \
+            dtype=tf.float32, initializer=tf.truncated_normal_initializer(stddev=0.01))
+        b = tf.get_variable("bias", shape=[output_dim], dtype=tf.float32, initializer=tf.constant_initializer(0.0))
+        conv = tf.nn.conv2d(input_layer, kernel, stride, padding=padding)
+        bias = tf.nn.bias_add(conv, b)
+        if activation:
+            bias = activation(bias, name="activation")
+        bias = batch_norm(bias, is_training)
+    return bias
+
+def conv2D_to_output(input_layer, input_dim, output_dim, height, width, stride, padding="SAME", name=""):
+    with tf.variable_scope("conv2D" + name):
+        kernel = tf.get_variable("weights", shape=[height, width, input_dim, output_dim], \
+            dtype=tf.float32, initializer=tf.constant_initializer(0.01))
+        conv = tf.nn.conv2d(input_layer, kernel, stride, padding=padding)
+    return conv
+
+def deconv2DLayer(input_layer, input_dim, output_dim, height, width, stride, like_layer, activation=tf.nn.relu, name="", is_training=True):
+    """Transposed convolution back to the spatial size of like_layer"""
+    with tf.variable_scope("deconv2D" + name):
+        kernel = tf.get_variable("weights", shape=[height, width, output_dim, input_dim], \
+            dtype=tf.float32, initializer=tf.truncated_normal_initializer(stddev=0.01))
+        b = tf.get_variable("bias", shape=[output_dim], dtype=tf.float32, initializer=tf.constant_initializer(0.0))
+        deconv = tf.nn.conv2d_transpose(input_layer, kernel, _output_shape(like_layer, output_dim), stride, padding="SAME")
+        bias = tf.nn.bias_add(deconv, b)
+        if activation:
+            bias = activation(bias, name="activation")
+        bias = batch_norm(bias, is_training)
+    return bias
+
+def deconv2D_to_output(input_layer, input_dim, output_dim, height, width, stride, like_layer, name=""):
+    with tf.variable_scope("deconv2D" + name):
+        kernel = tf.get_variable("weights", shape=[height, width, output_dim, input_dim], \
+            dtype=tf.float32, initializer=tf.truncated_normal_initializer(stddev=0.01))
+        deconv = tf.nn.conv2d_transpose(input_layer, kernel, _output_shape(like_layer, output_dim), stride, padding="SAME")
+    return deconv
+
+def _output_shape(like_layer, channels):
+    height, width = like_layer.get_shape().as_list()[1:3]
+    return tf.stack([tf.shape(like_layer)[0], height, width, channels])
+
 class BNBLayer(object):
     def __init__(self):
         pass
@@ -82,6 +130,20 @@ class BNBLayer(object):
         # self.objectness = deconv3D_to_output(self.layer4, 32, 2, 3, 3, 3, [1, 2, 2, 2, 1], obj_output_shape, name="objectness", activation=None)
         # self.cordinate = deconv3D_to_output(self.layer4, 32, 24, 3, 3, 3, [1, 2, 2, 2, 1], cord_output_shape, name="cordinate", activation=None)
         self.y = tf.nn.softmax(self.objectness, dim=-1)
+
+    def build_bev_graph(self, bev, channels, activation=tf.nn.relu, is_training=True):
+        """2D detection head on the bird's eye view, the z axis folded into channels
+
+        Same strides and receptive field in x / y as build_graph; the outputs
+        get a z axis of 1 so the losses and decoding of the voxel model apply.
+        """
+        self.layer1 = conv2DLayer(bev, channels, 32, 5, 5, [1, 2, 2, 1], name="layer1", activation=activation, is_training=is_training)
+        self.layer2 = conv2DLayer(self.layer1, 32, 64, 5, 5, [1, 2, 2, 1], name="layer2", activation=activation, is_training=is_training)
+        self.layer3 = conv2DLayer(self.layer2, 64, 128, 3, 3, [1, 2, 2, 1], name="layer3", activation=activation, is_training=is_training)
+        self.layer4 = conv2DLayer(self.layer3, 128, 128, 3, 3, [1, 1, 1, 1], name="layer4", activation=activation, is_training=is_training)
+        self.objectness = tf.expand_dims(conv2D_to_output(self.layer4, 128, 2, 3, 3, [1, 1, 1, 1], name="objectness"), 3)
+        self.cordinate = tf.expand_dims(conv2D_to_output(self.layer4, 128, 24, 3, 3, [1, 1, 1, 1], name="cordinate"), 3)
+        self.y = tf.nn.softmax(self.objectness, dim=-1)
     # #original
     # def build_graph(self, voxel, activation=tf.nn.relu, is_training=True):
     #     self.layer1 = conv3DLayer(voxel, 1, 10, 5, 5, 5, [1, 2, 2, 2, 1], name="layer1", activation=activation, is_training=is_training)
@@ -94,18 +156,239 @@ class BNBLayer(object):
     #     self.cordinate = deconv3D_to_output(self.layer3, 30, 24, 3, 3, 3, [1, 2, 2, 2, 1], cord_output_shape, name="cordinate", activation=None)
     #     self.y = tf.nn.softmax(self.objectness, dim=-1)
 
-def ssd_model(sess, voxel_shape=(300, 300, 300),activation=tf.nn.relu, is_training=True):
-    voxel = tf.placeholder(tf.float32, [None, voxel_shape[0], voxel_shape[1], voxel_shape[2], 1])
+class RangeFCN(object):
+    """2D fully convolutional network on the (d, z) range map
+
+    Three strided convolutions, then transposed convolutions back to the
+    range map resolution, each concatenated with the encoder layer of the
+    same size. objectness (2) and cordinate (24) are predicted for every cell.
+    """
+    def __init__(self):
+        pass
+
+    def build_graph(self, range_map, activation=tf.nn.relu, is_training=True):
+        self.layer1 = conv2DLayer(range_map, 2, 32, 4, 4, [1, 1, 2, 1], name="layer1", activation=activation, is_training=is_training)
+        self.layer2 = conv2DLayer(self.layer1, 32, 64, 4, 4, [1, 2, 2, 1], name="layer2", activation=activation, is_training=is_training)
+        self.layer3 = conv2DLayer(self.layer2, 64, 96, 4, 4, [1, 2, 2, 1], name="layer3", activation=activation, is_training=is_training)
+        self.layer4 = deconv2DLayer(self.layer3, 96, 64, 4, 4, [1, 2, 2, 1], self.layer2, name="layer4", activation=activation, is_training=is_training)
+        self.layer4 = tf.concat([self.layer4, self.layer2], axis=3)
+        self.layer5 = deconv2DLayer(self.layer4, 128, 32, 4, 4, [1, 2, 2, 1], self.layer1, name="layer5", activation=activation, is_training=is_training)
+        self.layer5 = tf.concat([self.layer5, self.layer1], axis=3)
+        self.objectness = deconv2D_to_output(self.layer5, 64, 2, 4, 4, [1, 1, 2, 1], range_map, name="objectness")
+        self.cordinate = deconv2D_to_output(self.layer5, 64, 24, 4, 4, [1, 1, 2, 1], range_map, name="cordinate")
+        self.y = tf.nn.softmax(self.objectness, dim=-1)
+
+def range_model(sess, range_shape=(64, 1125), activation=tf.nn.relu, is_training=True):
+    range_map = tf.placeholder(tf.float32, [None, range_shape[0], range_shape[1], 2])
+    phase_train = tf.placeholder(tf.bool, name='phase_train') if is_training else None
+    with tf.variable_scope("range_FCN_model") as scope:
+        fcn_model = RangeFCN()
+        fcn_model.build_graph(range_map, activation=activation, is_training=phase_train)
+
+    if is_training:
+        initialized_var = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope="range_FCN_model")
+        sess.run(tf.variables_initializer(initialized_var))
+    return fcn_model, range_map, phase_train
+
+def ssd_model(sess, voxel_shape=(300, 300, 300),activation=tf.nn.relu, is_training=True, input_type="voxel", slices=4):
+    """input_type "bev" feeds (x, y, slices + 2) bird's eye view maps to BNBLayer.build_bev_graph"""
+    if input_type == "bev":
+        voxel = tf.placeholder(tf.float32, [None, voxel_shape[0], voxel_shape[1], slices + 2])
+    else:
+        voxel = tf.placeholder(tf.float32, [None, voxel_shape[0], voxel_shape[1], voxel_shape[2], 1])
     phase_train = tf.placeholder(tf.bool, name='phase_train') if is_training else None
     with tf.variable_scope("3D_CNN_model") as scope:
         bnb_model = BNBLayer()
-        bnb_model.build_graph(voxel, activation=activation, is_training=phase_train)
+        if input_type == "bev":
+            bnb_model.build_bev_graph(voxel, slices + 2, activation=activation, is_training=phase_train)
+        else:
+            bnb_model.build_graph(voxel, activation=activation, is_training=phase_train)
 
     if is_training:
         initialized_var = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope="3D_CNN_model")
         sess.run(tf.variables_initializer(initialized_var))
     return bnb_model, voxel, phase_train
 
+def load_frozen_graph(path, output_names=("objectness", "cordinate", "y")):
+    """Graph of an export_graph.py .pb with its voxel input and output tensors"""
+    graph_def = tf.GraphDef()
+    with open(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+    return graph, graph.get_tensor_by_name("voxel:0"), [graph.get_tensor_by_name(name + ":0") for name in output_names]
+
+# (kernel size, stride) of the BNBLayer voxel stack, layer1 to the objectness / cordinate heads
+BNB_KERNELS = ((5, 2), (5, 2), (3, 2), (3, 1), (3, 1))
+# Input voxels per output cell of BNBLayer along each axis
+BNB_STRIDE = int(np.prod([stride for _, stride in BNB_KERNELS]))
+
+def receptive_halo(kernels=BNB_KERNELS):
+    """Input voxels on each side that reach an output cell, rounded up to whole output cells"""
+    halo, jump = 0, 1
+    for size, stride in kernels:
+        halo += size // 2 * jump
+        jump *= stride
+    return -(-halo // jump) * jump
+
+def tile_windows(length, tile, halo):
+    """(core start, core end, window start) of the tiles of one axis, windows of tile + 2 * halo clamped inside length
+
+    Every core has halo voxels of real input on the sides that are not the
+    scene border, so tiled inference is exact when length, tile and halo are
+    multiples of the output stride (the SAME padding and strides then line up).
+    """
+    window = min(tile + 2 * halo, length)
+    return [(start, min(start + tile, length), min(max(start - halo, 0), length - window)) for start in range(0, length, tile)]
+
+class Detector(object):
+    """Resident inference model: restores the checkpoint once, then every call
+    runs objectness, cordinate and softmax in one graph execution for a batch.
+
+    A checkpoint ending in .pb is a frozen graph from export_graph.py, batch
+    norm folded and without variables to restore. sparse=True runs the same
+    checkpoint through sparse_conv.SparseBNBLayer on the occupied voxels only.
+    tile=n builds the model on n x n voxel x / y tiles plus receptive_halo on
+    each side and runs a scene as a batch of tile_batch tiles at a time, so
+    activation memory is bounded by the tile instead of the scene; the
+    stitched outputs are those of full frame inference.
+
+    detect() returns per frame (corners (N, 8, 3), scores (N,)) after non
+    maximum suppression and records the preprocess / inference / decode / nms
+    latency of every frame in latencies. nms_threshold=None skips suppression.
+    """
+
+    def __init__(self, checkpoint, resolution=0.25, scale=BNB_STRIDE, voxel_shape=(360, 400, 40), x=(0, 90), y=(-50, 50), z=(-5.5, 4.5), \
+                 threshold=0.995, activation=tf.nn.relu, input_type="voxel", slices=4, nms_threshold=0.5, top_k=None, use_3d_nms=False, \
+                 sparse=False, tile=None, tile_batch=4):
+        self.resolution = resolution
+        self.nms_threshold = nms_threshold
+        self.top_k = top_k
+        self.use_3d_nms = use_3d_nms
+        self.input_type = input_type
+        self.slices = slices
+        self.sparse = sparse
+        self.scale = scale
+        self.voxel_shape = voxel_shape
+        self.x = x
+        self.y = y
+        self.z = z
+        self.threshold = threshold
+        self.min_value = np.array([x[0], y[0], z[0]])
+        self.latencies = []
+        self.tiles = None
+        self.tile_batch = tile_batch
+        model_shape = voxel_shape
+        if tile is not None:
+            if checkpoint.endswith(".pb") or sparse or input_type != "voxel":
+                raise ValueError("tiled inference needs the dense voxel checkpoint")
+            halo = receptive_halo()
+            if tile % BNB_STRIDE or voxel_shape[0] % BNB_STRIDE or voxel_shape[1] % BNB_STRIDE:
+                raise ValueError("tile %d and voxel_shape %s must be multiples of the output stride %d" % (tile, voxel_shape, BNB_STRIDE))
+            self.tiles = [tile_windows(voxel_shape[0], tile, halo), tile_windows(voxel_shape[1], tile, halo)]
+            model_shape = (min(tile + 2 * halo, voxel_shape[0]), min(tile + 2 * halo, voxel_shape[1]), voxel_shape[2])
+        if checkpoint.endswith(".pb"):
+            self.graph, self.voxel, self.fetches = load_frozen_graph(checkpoint)
+            self.sess = tf.Session(graph=self.graph)
+            return
+        self.graph = tf.Graph()
+        self.sess = tf.Session(graph=self.graph)
+        if sparse:
+            from sparse_conv import sparse_model
+            with self.graph.as_default():
+                self.model = sparse_model(voxel_shape=voxel_shape, activation=activation)
+                tf.train.Saver(tf.global_variables()).restore(self.sess, checkpoint)
+                self.sess.run(self.model.cache_background)
+            self.fetches = [self.model.objectness, self.model.cordinate, self.model.y]
+            return
+        with self.graph.as_default():
+            self.model, self.voxel, _ = ssd_model(self.sess, voxel_shape=model_shape, activation=activation, is_training=None, \
+                input_type=input_type, slices=slices)
+            tf.train.Saver().restore(self.sess, checkpoint)
+        self.fetches = [self.model.objectness, self.model.cordinate, self.model.y]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.sess.close()
+
+    def preprocess(self, pcs):
+        """Camera angle filter and voxelize a list of scans into one input batch"""
+        if self.input_type == "bev":
+            return np.array([raw_to_bird_view(pc, resolution=self.resolution, x=self.x, y=self.y, z=self.z, slices=self.slices) for pc in pcs])
+        batch_coords = [raw_to_sparse_voxel(pc, resolution=self.resolution, x=self.x, y=self.y, z=self.z, camera_angle=True)[0] for pc in pcs]
+        if self.sparse:
+            return self.model.feed_dict(batch_coords)
+        # a quantized graph takes the occupancy as uint8
+        return batch_sparse_to_voxel(batch_coords, self.voxel_shape, dtype=self.voxel.dtype.as_numpy_dtype)
+
+    def run(self, batch_voxel):
+        """objectness, cordinate and softmax of a voxel batch (the feed dict when sparse) in one sess.run"""
+        if self.sparse:
+            return self.sess.run(self.fetches, feed_dict=batch_voxel)
+        if self.tiles is not None:
+            return self.run_tiles(batch_voxel)
+        return self.sess.run(self.fetches, feed_dict={self.voxel: batch_voxel})
+
+    def run_tiles(self, batch_voxel):
+        """run of a scene batch as tile_batch windows per sess.run, the core of every tile stitched back"""
+        s = BNB_STRIDE
+        window = self.voxel.get_shape().as_list()[1:3]
+        tiles = [(b, x, y) for b in range(len(batch_voxel)) for x in self.tiles[0] for y in self.tiles[1]]
+        outputs = None
+        for start in range(0, len(tiles), self.tile_batch):
+            chunk = tiles[start:start + self.tile_batch]
+            windows = np.array([batch_voxel[b, x[2]:x[2] + window[0], y[2]:y[2] + window[1]] for b, x, y in chunk])
+            results = self.sess.run(self.fetches, feed_dict={self.voxel: windows})
+            if outputs is None:
+                outputs = [np.zeros((len(batch_voxel), self.voxel_shape[0] // s, self.voxel_shape[1] // s) + r.shape[3:], dtype=r.dtype) \
+                    for r in results]
+            for i, (b, x, y) in enumerate(chunk):
+                for output, result in zip(outputs, results):
+                    output[b, x[0] // s:x[1] // s, y[0] // s:y[1] // s] = \
+                        result[i, (x[0] - x[2]) // s:(x[1] - x[2]) // s, (y[0] - y[2]) // s:(y[1] - y[2]) // s]
+        return outputs
+
+    def decode(self, y_pred, cordinate, threshold=None):
+        """Boxes of every cell whose objectness probability reaches threshold, for one frame"""
+        threshold = self.threshold if threshold is None else threshold
+        return decode_boxes(y_pred, cordinate, resolution=self.resolution, scale=self.scale, min_value=self.min_value, threshold=threshold)
+
+    def suppress(self, corners, scores):
+        """Non maximum suppression of the decoded boxes of one frame"""
+        if self.nms_threshold is None:
+            return corners, scores
+        keep = nms(corners, scores, iou_threshold=self.nms_threshold, top_k=self.top_k, use_3d=self.use_3d_nms)
+        return corners[keep], scores[keep]
+
+    def detect(self, pcs, threshold=None):
+        start = time.time()
+        batch_voxel = self.preprocess(pcs)
+        preprocessed = time.time()
+        objectness, cordinate, y_pred = self.run(batch_voxel)
+        inferred = time.time()
+        detections = [self.decode(y_pred[i], cordinate[i], threshold) for i in range(len(pcs))]
+        decoded = time.time()
+        detections = [self.suppress(corners, scores) for corners, scores in detections]
+        suppressed = time.time()
+        num = float(max(len(pcs), 1))
+        self.latencies.append(((preprocessed - start) / num, (inferred - preprocessed) / num, (decoded - inferred) / num, \
+            (suppressed - decoded) / num))
+        return detections
+
+    def latency_summary(self):
+        """Mean per frame latency in ms of preprocess, inference, decode and nms"""
+        if not self.latencies:
+            return "no frames"
+        mean = np.mean(self.latencies, axis=0) * 1000
+        return "per frame: preprocess %.1f ms, inference %.1f ms, decode %.1f ms, nms %.1f ms, total %.1f ms" % \
+            (mean[0], mean[1], mean[2], mean[3], mean.sum())
+
 def loss_func(model):
     g_map = tf.placeholder(tf.float32, model.cordinate.get_shape().as_list()[:4])
     g_cord = tf.placeholder(tf.float32, model.cordinate.get_shape().as_list())
@@ -131,9 +414,12 @@ def loss_func2(model):
     cord_loss = tf.reduce_sum(cord_diff) * 0.1
     return tf.add(obj_loss, cord_loss), g_map, g_cord
 
-def loss_func3(model):
+def loss_func3(model, sparse_cord=False):
+    """With sparse_cord, g_cord is an (index, value) pair of placeholders fed
+    from batch_to_train(sparse_cord=True) and the regression loss only
+    gathers the positive cells instead of masking the whole grid.
+    """
     g_map = tf.placeholder(tf.float32, model.cordinate.get_shape().as_list()[:4])
-    g_cord = tf.placeholder(tf.float32, model.cordinate.get_shape().as_list())
     non_gmap = tf.subtract(tf.ones_like(g_map, dtype=tf.float32), g_map)
 
     elosion = 0.00001
@@ -143,8 +429,28 @@ def loss_func3(model):
     cross_entropy = tf.add(is_obj_loss, non_obj_loss)
     obj_loss = cross_entropy
 
+    if sparse_cord:
+        g_cord = (tf.placeholder(tf.int32, [None, 4]), tf.placeholder(tf.float32, [None, 24]))
+        cord_diff = tf.square(tf.subtract(tf.gather_nd(model.cordinate, g_cord[0]), g_cord[1]))
+    else:
+        g_cord = tf.placeholder(tf.float32, model.cordinate.get_shape().as_list())
+        cord_diff = tf.multiply(g_map, tf.reduce_sum(tf.square(tf.subtract(model.cordinate, g_cord)), 4))
+    cord_loss = tf.multiply(tf.reduce_sum(cord_diff), 0.02)
+    return tf.add(obj_loss, cord_loss), obj_loss, cord_loss, is_obj_loss, non_obj_loss, g_map, g_cord, y
+
+def range_loss_func(model):
+    """loss_func3 on the 2D range map outputs"""
+    g_map = tf.placeholder(tf.float32, model.cordinate.get_shape().as_list()[:3])
     g_cord = tf.placeholder(tf.float32, model.cordinate.get_shape().as_list())
-    cord_diff = tf.multiply(g_map, tf.reduce_sum(tf.square(tf.subtract(model.cordinate, g_cord)), 4))
+    non_gmap = tf.subtract(tf.ones_like(g_map, dtype=tf.float32), g_map)
+
+    elosion = 0.00001
+    y = model.y
+    is_obj_loss = -tf.reduce_sum(tf.multiply(g_map,  tf.log(y[:, :, :, 0] + elosion)))
+    non_obj_loss = tf.multiply(-tf.reduce_sum(tf.multiply(non_gmap, tf.log(y[:, :, :, 1] + elosion))), 0.0008)
+    obj_loss = tf.add(is_obj_loss, non_obj_loss)
+
+    cord_diff = tf.multiply(g_map, tf.reduce_sum(tf.square(tf.subtract(model.cordinate, g_cord)), 3))
     cord_loss = tf.multiply(tf.reduce_sum(cord_diff), 0.02)
     return tf.add(obj_loss, cord_loss), obj_loss, cord_loss, is_obj_loss, non_obj_loss, g_map, g_cord, y
 
@@ -155,235 +461,166 @@ def create_optimizer(all_loss, lr=0.001):
 
 def train(batch_num, velodyne_path, label_path=None, calib_path=None, resolution=0.2, \
         dataformat="pcd", label_type="txt", is_velo_cam=False, scale=4, lr=0.01, \
-        voxel_shape=(800, 800, 40), x=(0, 80), y=(-40, 40), z=(-2.5, 1.5), epoch=101):
+        voxel_shape=(800, 800, 40), x=(0, 80), y=(-40, 40), z=(-2.5, 1.5), epoch=101, cache_dir=None, num_workers=0, prefetch=2, log_every=1, sparse_cord=False, \
+        input_type="voxel", slices=4, trace_path=None, trace_summary_every=0, trace_tf_steps=(), checkpoint_dir="./checkpoints", \
+        save_every_epochs=10, save_every_steps=None, save_every_secs=None, max_to_keep=5, resume=True):
+    """trace_path saves a Chrome trace of the input and training stages, trace_summary_every
+    prints their mean durations every that many steps, and each step of trace_tf_steps is
+    also traced op by op with tf.RunMetadata into trace_path + ".step<N>.json". The losses are
+    fetched and printed every log_every steps, never with log_every=0.
+
+    Checkpoints are written in the background into checkpoint_dir every save_every_epochs
+    epochs, save_every_steps steps or save_every_secs seconds, keeping the max_to_keep
+    latest; with resume training continues from the latest one where it stopped, epoch, step and
+    position in the epoch included (the batches already trained on are loaded again and skipped)."""
     # tf Graph input
     batch_size = batch_num
     training_epochs = epoch
-
+    if trace_path or trace_summary_every:
+        tracing.enable(trace_path, summary_every=trace_summary_every)
+
+    # Fork the input workers before TensorFlow starts its own threads
+    pipeline = BatchPipeline(batch_num, velodyne_path, label_path=label_path, calib_path=calib_path, resolution=resolution, \
+        dataformat=dataformat, label_type=label_type, is_velo_cam=is_velo_cam, scale=scale, x=x, y=y, z=z, \
+        cache_dir=cache_dir, num_workers=num_workers, prefetch=prefetch, sparse_cord=sparse_cord, \
+        input_type=input_type, slices=slices)
+
+    try:
+        with tf.Session() as sess:
+            model, voxel, phase_train = ssd_model(sess, voxel_shape=voxel_shape, activation=tf.nn.relu, is_training=True, \
+                input_type=input_type, slices=slices)
+            total_loss, obj_loss, cord_loss, is_obj_loss, non_obj_loss, g_map, g_cord, y_pred = loss_func3(model, sparse_cord=sparse_cord)
+            optimizer = create_optimizer(total_loss, lr=lr)
+            init = tf.global_variables_initializer()
+            sess.run(init)
+
+            checkpointer = AsyncCheckpointer(sess, checkpoint_dir, prefix="velodyne_025_deconv_norm_valid.ckpt", max_to_keep=max_to_keep, \
+                every_steps=save_every_steps, every_secs=save_every_secs)
+            start_epoch, start_batch, step = checkpointer.restore(sess) if resume else (0, 0, 0)
+            if step:
+                print("Resumed at epoch %d, batch %d, step %d from %s" % (start_epoch + 1, start_batch, step, checkpointer.latest()))
+            try:
+                for epoch in range(start_epoch, training_epochs):
+                    for batch, (batch_x, batch_g_map, batch_g_cord) in enumerate(pipeline):
+                        if epoch == start_epoch and batch < start_batch:
+                            continue
+                        with tracing.span("feed"):
+                            feed_dict = {voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True}
+                        step += 1
+                        run_kwargs = {}
+                        if step in trace_tf_steps:
+                            run_kwargs = dict(options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=tf.RunMetadata())
+                        if not log_every or step % log_every:
+                            with tracing.span("sess.run"):
+                                sess.run(optimizer, feed_dict=feed_dict, **run_kwargs)
+                        else:
+                            # One graph execution for the update and the logged losses (computed before the update)
+                            with tracing.span("sess.run"):
+                                _, cc, iol, nol = sess.run([optimizer, cord_loss, is_obj_loss, non_obj_loss], feed_dict=feed_dict, **run_kwargs)
+                        if run_kwargs:
+                            tracing.save_run_metadata(run_kwargs["run_metadata"], "%s.step%d.json" % (trace_path or "trace", step))
+                        tracing.report(step)
+                        checkpointer.maybe_save(epoch, batch + 1, step)
+                        if not log_every or step % log_every:
+                            continue
+                        print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(cc))
+                        print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(iol))
+                        print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(nol))
+                    print("Epoch: %04d %s" % (epoch + 1, pipeline.summary()))
+                    pipeline.reset_stats()
+                    tracing.save()
+                    if save_every_epochs and (epoch + 1) % save_every_epochs == 0:
+                        print "Save epoch " + str(epoch + 1)
+                        checkpointer.save(epoch + 1, 0, step)
+                checkpointer.save(training_epochs, 0, step)
+            finally:
+                checkpointer.close()
+            print("Optimization Finished!")
+    finally:
+        pipeline.close()
+
+def train_range(batch_num, velodyne_path, label_path=None, calib_path=None, dataformat="bin", label_type="txt", is_velo_cam=False, \
+        lr=0.01, theta=(-45., 45.), epoch=101):
+    """Train the 2D range map FCN, the low latency alternative to the 3D voxel model"""
+    # multiview_2d imports matplotlib, only needed for the range map model
+    from multiview_2d import range_image_shape, range_frame
+    sources = frame_sources(velodyne_path, label_path, calib_path, dataformat)
+    if not sources:
+        raise ValueError("no frames found for %s" % velodyne_path)
     with tf.Session() as sess:
-        model, voxel, phase_train = ssd_model(sess, voxel_shape=voxel_shape, activation=tf.nn.relu, is_training=True)
+        model, range_map, phase_train = range_model(sess, range_shape=range_image_shape(theta=theta), activation=tf.nn.relu, is_training=True)
         saver = tf.train.Saver()
-        total_loss, obj_loss, cord_loss, is_obj_loss, non_obj_loss, g_map, g_cord, y_pred = loss_func3(model)
+        total_loss, obj_loss, cord_loss, is_obj_loss, non_obj_loss, g_map, g_cord, y_pred = range_loss_func(model)
         optimizer = create_optimizer(total_loss, lr=lr)
         init = tf.global_variables_initializer()
         sess.run(init)
 
-        for epoch in range(training_epochs):
-            for (batch_x, batch_g_map, batch_g_cord) in lidar_generator(batch_num, velodyne_path, label_path=label_path, \
-               calib_path=calib_path,resolution=resolution, dataformat=dataformat, label_type=label_type, is_velo_cam=is_velo_cam, \
-               scale=scale, x=x, y=y, z=z):
-                # print batch_x.shape, batch_g_map.shape, batch_g_cord.shape, batch_num
-                # print batch_x.shape
-                # print batch_g_map.shape
-                # print batch_g_cord.shape
-                sess.run(optimizer, feed_dict={voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True})
-                # ct = sess.run(total_loss, feed_dict={voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True})
-                # co = sess.run(obj_loss, feed_dict={voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True})
-                cc = sess.run(cord_loss, feed_dict={voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True})
-                iol = sess.run(is_obj_loss, feed_dict={voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True})
-                nol = sess.run(non_obj_loss, feed_dict={voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True})
-                # print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(ct))
-                # print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(co))
-                print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(cc))
-                print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(iol))
-                print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(nol))
-            if (epoch != 0) and (epoch % 10 == 0):
-                print "Save epoch " + str(epoch)
-                saver.save(sess, "velodyne_025_deconv_norm_valid" + str(epoch) + ".ckpt")
+        for itn in range(epoch):
+            # the last batch is smaller when batch_num does not divide the split
+            for start in range(0, len(sources), batch_num):
+                batch = [range_frame(velodynes, labels, calibs, dataformat=dataformat, label_type=label_type, \
+                    is_velo_cam=is_velo_cam, theta=theta) for velodynes, labels, calibs in sources[start:start + batch_num]]
+                batch_x, batch_g_map, batch_g_cord = [np.array(item) for item in zip(*batch)]
+                feed_dict = {range_map: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True}
+                _, oc, cc = sess.run([optimizer, obj_loss, cord_loss], feed_dict=feed_dict)
+            print("Epoch:", '%04d' % (itn+1), "obj cost=", "{:.9f}".format(oc), "cord cost=", "{:.9f}".format(cc))
+            if (itn != 0) and (itn % 10 == 0):
+                print("Save epoch " + str(itn))
+                saver.save(sess, "velodyne_range_fcn" + str(itn) + ".ckpt")
         print("Optimization Finished!")
 
-def train_test(batch_num, velodyne_path, label_path=None, calib_path=None, resolution=0.2, dataformat="pcd", label_type="txt", is_velo_cam=False, \
-             scale=4, voxel_shape=(800, 800, 40), x=(0, 80), y=(-40, 40), z=(-2.5, 1.5)):
-    batch_size = batch_num
-    p = []
-    pc = None
-    bounding_boxes = None
-    places = None
-    rotates = None
-    size = None
-    proj_velo = None
-
-    if dataformat == "bin":
-        pc = load_pc_from_bin(velodyne_path)
-    elif dataformat == "pcd":
-        pc = load_pc_from_pcd(velodyne_path)
-
-    if calib_path:
-        calib = read_calib_file(calib_path)
-        proj_velo = proj_to_velo(calib)[:, :3]
-
-    if label_path:
-        places, rotates, size = read_labels(label_path, label_type, calib_path=calib_path, is_velo_cam=is_velo_cam, proj_velo=proj_velo)
-
-    corners = get_boxcorners(places, rotates, size)
-    filter_car_data(corners)
-    pc = filter_camera_angle(pc)
-
-    voxel =  raw_to_voxel(pc, resolution=resolution, x=x, y=y, z=z)
-    center_sphere = center_to_sphere(places, size, resolution=resolution)
-    corner_label = corner_to_train(corners, center_sphere, resolution=resolution)
-    g_map = create_objectness_label(center_sphere, resolution=resolution)
-    g_cord = corner_label.reshape(corner_label.shape[0], -1)
+def test_range(velodyne_path, checkpoint, dataformat="bin", theta=(-45., 45.), threshold=0.995):
+    """Detect with a RangeFCN checkpoint on one scan"""
+    from multiview_2d import range_image, range_image_shape, range_to_corners
+    pc = load_pc_from_bin(velodyne_path) if dataformat == "bin" else load_pc_from_pcd(velodyne_path)
+    with tf.Session() as sess:
+        model, range_map, _ = range_model(sess, range_shape=range_image_shape(theta=theta), activation=tf.nn.relu, is_training=None)
+        tf.train.Saver().restore(sess, checkpoint)
+        image, points = range_image(pc, theta=theta, return_points=True)
+        start = time.time()
+        y_pred, cordinate = sess.run([model.y, model.cordinate], feed_dict={range_map: image[np.newaxis]})
+        print("inference %.1f ms" % ((time.time() - start) * 1000))
+        corners, scores = range_to_corners(y_pred[0], cordinate[0], points, threshold=threshold)
+        corners = corners[nms(corners, scores)]
+        print(corners.shape)
+        publish_pc2(pc, corners.reshape(-1, 3))
 
-    voxel_x = voxel.reshape(1, voxel.shape[0], voxel.shape[1], voxel.shape[2], 1)
+def train_test(batch_num, velodyne_path, label_path=None, calib_path=None, resolution=0.2, dataformat="pcd", label_type="txt", is_velo_cam=False, \
+             scale=4, voxel_shape=(800, 800, 40), x=(0, 80), y=(-40, 40), z=(-2.5, 1.5), checkpoint="./velodyne_025_deconv_norm_valid40.ckpt"):
+    pc, places, rotates, size = load_frame(velodyne_path, label_path=label_path, calib_path=calib_path, \
+        dataformat=dataformat, label_type=label_type, is_velo_cam=is_velo_cam)
 
-    with tf.Session() as sess:
-        is_training=None
-        model, voxel, phase_train = ssd_model(sess, voxel_shape=voxel_shape, activation=tf.nn.relu, is_training=is_training)
-        saver = tf.train.Saver()
-        new_saver = tf.train.import_meta_graph("velodyne_025_deconv_norm_valid40.ckpt.meta")
-        last_model = "./velodyne_025_deconv_norm_valid40.ckpt"
-        saver.restore(sess, last_model)
-
-        objectness = model.objectness
-        cordinate = model.cordinate
-        y_pred = model.y
-        objectness = sess.run(objectness, feed_dict={voxel: voxel_x})[0, :, :, :, 0]
-        cordinate = sess.run(cordinate, feed_dict={voxel: voxel_x})[0]
-        y_pred = sess.run(y_pred, feed_dict={voxel: voxel_x})[0, :, :, :, 0]
+    with Detector(checkpoint, resolution=resolution, scale=scale, voxel_shape=voxel_shape, x=x, y=y, z=z) as detector:
+        objectness, cordinate, y_pred = detector.run(detector.preprocess([pc]))
+        objectness = objectness[0, :, :, :, 0]
         print objectness.shape, objectness.max(), objectness.min()
-        print y_pred.shape, y_pred.max(), y_pred.min()
-
-        # print np.where(objectness >= 0.55)
-        index = np.where(y_pred >= 0.995)
-        print np.vstack((index[0], np.vstack((index[1], index[2])))).transpose()
-        print np.vstack((index[0], np.vstack((index[1], index[2])))).transpose().shape
+        print("%s %f %f" % (y_pred.shape, y_pred[..., 0].max(), y_pred[..., 0].min()))
 
+        corners, scores = detector.decode(y_pred[0], cordinate[0])
         a = center_to_sphere(places, size, resolution=resolution, x=x, y=y, z=z, \
             scale=scale, min_value=np.array([x[0], y[0], z[0]]))
-        label_center = sphere_to_center(a, resolution=resolution, \
-            scale=scale, min_value=np.array([x[0], y[0], z[0]]))
-        label_corners = get_boxcorners(label_center, rotates, size)
         print a[a[:, 0].argsort()]
-        # center = np.array([20, 57, 3])
-        #
-        # pred_center = sphere_to_center(center, resolution=resolution)
-        # print pred_center
-        # print cordinate.shape
-        # corners = cordinate[center[0], center[1], center[2]].reshape(-1, 3)
-        centers = np.vstack((index[0], np.vstack((index[1], index[2])))).transpose()
-        centers = sphere_to_center(centers, resolution=resolution, \
-            scale=scale, min_value=np.array([x[0], y[0], z[0]]))
-        corners = cordinate[index].reshape(-1, 8, 3) + centers[:, np.newaxis]
         print corners.shape
-        print voxel.shape
-        # publish_pc2(pc, corners.reshape(-1, 3))
-        publish_pc2(pc, corners.reshape(-1, 3))
-        # pred_corners = corners + pred_center
-        # print pred_corners
+        publish_pc2(filter_camera_angle(pc), corners.reshape(-1, 3))
 
 def test(batch_num, velodyne_path, label_path=None, calib_path=None, resolution=0.2, dataformat="pcd", label_type="txt", is_velo_cam=False, \
-             scale=4, voxel_shape=(800, 800, 40), x=(0, 80), y=(-40, 40), z=(-2.5, 1.5)):
-    batch_size = batch_num
-    p = []
+             scale=4, voxel_shape=(800, 800, 40), x=(0, 80), y=(-40, 40), z=(-2.5, 1.5), frame_id=None, checkpoint="./velodyne_025_deconv_norm_valid40.ckpt", \
+             tile=None):
     pc = None
-    bounding_boxes = None
-    places = None
-    rotates = None
-    size = None
-    proj_velo = None
 
     if dataformat == "bin":
         pc = load_pc_from_bin(velodyne_path)
     elif dataformat == "pcd":
         pc = load_pc_from_pcd(velodyne_path)
-
-    pc = filter_camera_angle(pc)
-    voxel =  raw_to_voxel(pc, resolution=resolution, x=x, y=y, z=z)
-    voxel_x = voxel.reshape(1, voxel.shape[0], voxel.shape[1], voxel.shape[2], 1)
-
-    with tf.Session() as sess:
-        is_training=None
-        model, voxel, phase_train = ssd_model(sess, voxel_shape=voxel_shape, activation=tf.nn.relu, is_training=is_training)
-        saver = tf.train.Saver()
-        new_saver = tf.train.import_meta_graph("velodyne_025_deconv_norm_valid40.ckpt.meta")
-        last_model = "./velodyne_025_deconv_norm_valid40.ckpt"
-        saver.restore(sess, last_model)
-
-        objectness = model.objectness
-        cordinate = model.cordinate
-        y_pred = model.y
-        objectness = sess.run(objectness, feed_dict={voxel: voxel_x})[0, :, :, :, 0]
-        cordinate = sess.run(cordinate, feed_dict={voxel: voxel_x})[0]
-        start_time = time.time()
-        y_pred = sess.run(y_pred, feed_dict={voxel: voxel_x})[0, :, :, :, 0]
-        end_time = time.time()
-        print("--- %s ms ---" % ((end_time - start_time) * 1000))
-        print objectness.shape, objectness.max(), objectness.min()
-        print y_pred.shape, y_pred.max(), y_pred.min()
-
-        index = np.where(y_pred >= 0.995)
-        print np.vstack((index[0], np.vstack((index[1], index[2])))).transpose()
-        print np.vstack((index[0], np.vstack((index[1], index[2])))).transpose().shape
-
-        centers = np.vstack((index[0], np.vstack((index[1], index[2])))).transpose()
-        centers = sphere_to_center(centers, resolution=resolution, \
-            scale=scale, min_value=np.array([x[0], y[0], z[0]]))
-        corners = cordinate[index].reshape(-1, 8, 3) + centers[:, np.newaxis]
-        print corners.shape
-        print voxel.shape
-        # publish_pc2(pc, corners.reshape(-1, 3))
-        publish_pc2(pc, corners.reshape(-1, 3))
-        # pred_corners = corners + pred_center
-        # print pred_corners
-
-def lidar_generator(batch_num, velodyne_path, label_path=None, calib_path=None, resolution=0.2, dataformat="pcd", label_type="txt", is_velo_cam=False, \
-                        scale=4, x=(0, 80), y=(-40, 40), z=(-2.5, 1.5)):
-    velodynes_path = glob.glob(velodyne_path)
-    labels_path = glob.glob(label_path)
-    calibs_path = glob.glob(calib_path)
-    velodynes_path.sort()
-    labels_path.sort()
-    calibs_path.sort()
-    iter_num = len(velodynes_path) // batch_num
-
-    for itn in range(iter_num):
-        batch_voxel = []
-        batch_g_map = []
-        batch_g_cord = []
-
-        for velodynes, labels, calibs in zip(velodynes_path[itn*batch_num:(itn+1)*batch_num], \
-            labels_path[itn*batch_num:(itn+1)*batch_num], calibs_path[itn*batch_num:(itn+1)*batch_num]):
-            p = []
-            pc = None
-            bounding_boxes = None
-            places = None
-            rotates = None
-            size = None
-            proj_velo = None
-
-            if dataformat == "bin":
-                pc = load_pc_from_bin(velodynes)
-            elif dataformat == "pcd":
-                pc = load_pc_from_pcd(velodynes)
-
-            if calib_path:
-                calib = read_calib_file(calibs)
-                proj_velo = proj_to_velo(calib)[:, :3]
-
-            if label_path:
-                places, rotates, size = read_labels(labels, label_type, calib_path=calib_path, is_velo_cam=is_velo_cam, proj_velo=proj_velo)
-                if places is None:
-                    continue
-
-            corners = get_boxcorners(places, rotates, size)
-            pc = filter_camera_angle(pc)
-
-            voxel =  raw_to_voxel(pc, resolution=resolution, x=x, y=y, z=z)
-            center_sphere, corner_label = create_label(places, size, corners, resolution=resolution, x=x, y=y, z=z, \
-                scale=scale, min_value=np.array([x[0], y[0], z[0]]))
-
-            if not center_sphere.shape[0]:
-                print 1
-                continue
-            g_map = create_objectness_label(center_sphere, resolution=resolution, x=(x[1] - x[0]), y=(y[1] - y[0]), z=(z[1] - z[0]), scale=scale)
-            g_cord = corner_label.reshape(corner_label.shape[0], -1)
-            g_cord = corner_to_voxel(voxel.shape, g_cord, center_sphere, scale=scale)
-
-            batch_voxel.append(voxel)
-            batch_g_map.append(g_map)
-            batch_g_cord.append(g_cord)
-        yield np.array(batch_voxel, dtype=np.float32)[:, :, :, :, np.newaxis], np.array(batch_g_map, dtype=np.float32), np.array(batch_g_cord, dtype=np.float32)
+    elif dataformat == "packed":
+        dataset = open_packed(velodyne_path)
+        pc = dataset.scan(dataset.index(frame_id))
+
+    with Detector(checkpoint, resolution=resolution, scale=scale, voxel_shape=voxel_shape, x=x, y=y, z=z, tile=tile) as detector:
+        corners, scores = detector.detect([pc])[0]
+        print(detector.latency_summary())
+        print("%s %s" % (corners.shape, scores.shape))
+        publish_pc2(filter_camera_angle(pc), corners.reshape(-1, 3))
 
 
 if __name__ == '__main__':
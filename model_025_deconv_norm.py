@@ -3,6 +3,7 @@ import sys
 import numpy as np
 import tensorflow as tf
 from input_velodyne import *
+from data_pipeline import BatchPipeline, lidar_generator
 import glob
 
 def batch_norm(inputs, is_training, decay=0.9, eps=1e-5):
@@ -162,47 +163,46 @@ def create_optimizer(all_loss, lr=0.001):
     return optimizer
 
 def train(batch_num, velodyne_path, label_path=None, calib_path=None, resolution=0.2, dataformat="pcd", label_type="txt", is_velo_cam=False, \
-        scale=4, voxel_shape=(800, 800, 40), x=(0, 80), y=(-40, 40), z=(-2.5, 1.5)):
+        scale=4, voxel_shape=(800, 800, 40), x=(0, 80), y=(-40, 40), z=(-2.5, 1.5), cache_dir=None, num_workers=0, prefetch=2, log_every=1):
     # tf Graph input
     batch_size = batch_num
     training_epochs = 101
 
-    with tf.Session() as sess:
-        model, voxel, phase_train = ssd_model(sess, voxel_shape=voxel_shape, activation=tf.nn.relu)
-        saver = tf.train.Saver()
-        total_loss, obj_loss, cord_loss, is_obj_loss, non_obj_loss, g_map, g_cord, y_pred = loss_func3(model)
-        optimizer = create_optimizer(total_loss, lr=0.01)
-        init = tf.global_variables_initializer()
-        sess.run(init)
-
-        for epoch in range(training_epochs):
-            for (batch_x, batch_g_map, batch_g_cord) in lidar_generator(batch_num, velodyne_path, label_path=label_path, \
-               calib_path=calib_path,resolution=resolution, dataformat=dataformat, label_type=label_type, is_velo_cam=is_velo_cam, \
-               scale=scale, x=x, y=y, z=z):
-                # print batch_x.shape, batch_g_map.shape, batch_g_cord.shape, batch_num
-                # print batch_x.shape
-                # print batch_g_map.shape
-                # print batch_g_cord.shape
-                sess.run(optimizer, feed_dict={voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True})
-
-                # ct = sess.run(total_loss, feed_dict={voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True})
-                # co = sess.run(obj_loss, feed_dict={voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True})
-                cc = sess.run(cord_loss, feed_dict={voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True})
-                iol = sess.run(is_obj_loss, feed_dict={voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True})
-                nol = sess.run(non_obj_loss, feed_dict={voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True})
-                # soft = sess.run(y, feed_dict={voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord})
-                # print soft[0, 0, 0, 0, :]
-                # print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(ct))
-                # print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(co))
-                print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(cc))
-                print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(iol))
-                print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(nol))
-                # print ""
-
-            if (epoch != 0) and (epoch % 1 == 0):
-                print "Save epoch " + str(epoch)
-                saver.save(sess, "velodyne_025_deconv_norm" + str(epoch) + ".ckpt")
-        print("Optimization Finished!")
+    # Fork the input workers before TensorFlow starts its own threads
+    pipeline = BatchPipeline(batch_num, velodyne_path, label_path=label_path, calib_path=calib_path, resolution=resolution, \
+        dataformat=dataformat, label_type=label_type, is_velo_cam=is_velo_cam, scale=scale, x=x, y=y, z=z, \
+        cache_dir=cache_dir, num_workers=num_workers, prefetch=prefetch)
+
+    try:
+        with tf.Session() as sess:
+            model, voxel, phase_train = ssd_model(sess, voxel_shape=voxel_shape, activation=tf.nn.relu)
+            saver = tf.train.Saver()
+            total_loss, obj_loss, cord_loss, is_obj_loss, non_obj_loss, g_map, g_cord, y_pred = loss_func3(model)
+            optimizer = create_optimizer(total_loss, lr=0.01)
+            init = tf.global_variables_initializer()
+            sess.run(init)
+
+            step = 0
+            for epoch in range(training_epochs):
+                for (batch_x, batch_g_map, batch_g_cord) in pipeline:
+                    feed_dict = {voxel: batch_x, g_map: batch_g_map, g_cord: batch_g_cord, phase_train:True}
+                    step += 1
+                    if not log_every or step % log_every:
+                        sess.run(optimizer, feed_dict=feed_dict)
+                        continue
+                    # One graph execution for the update and the logged losses (computed before the update)
+                    _, cc, iol, nol = sess.run([optimizer, cord_loss, is_obj_loss, non_obj_loss], feed_dict=feed_dict)
+                    print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(cc))
+                    print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(iol))
+                    print("Epoch:", '%04d' % (epoch+1), "cost=", "{:.9f}".format(nol))
+                print("Epoch: %04d %s" % (epoch + 1, pipeline.summary()))
+                pipeline.reset_stats()
+                if (epoch != 0) and (epoch % 1 == 0):
+                    print "Save epoch " + str(epoch)
+                    saver.save(sess, "velodyne_025_deconv_norm" + str(epoch) + ".ckpt")
+            print("Optimization Finished!")
+    finally:
+        pipeline.close()
 
 def test(batch_num, velodyne_path, label_path=None, calib_path=None, resolution=0.2, dataformat="pcd", label_type="txt", is_velo_cam=False, \
              scale=4, voxel_shape=(800, 800, 40), x=(0, 80), y=(-40, 40), z=(-2.5, 1.5)):
@@ -253,9 +253,10 @@ def test(batch_num, velodyne_path, label_path=None, calib_path=None, resolution=
         objectness = model.objectness
         cordinate = model.cordinate
         y_pred = model.y
-        objectness = sess.run(objectness, feed_dict={voxel: voxel_x, phase_train:False})[0, :, :, :, 0]
-        cordinate = sess.run(cordinate, feed_dict={voxel: voxel_x, phase_train:False})[0]
-        y_pred = sess.run(y_pred, feed_dict={voxel: voxel_x, phase_train:False})[0, :, :, :, 0]
+        objectness, cordinate, y_pred = sess.run([objectness, cordinate, y_pred], feed_dict={voxel: voxel_x, phase_train:False})
+        objectness = objectness[0, :, :, :, 0]
+        cordinate = cordinate[0]
+        y_pred = y_pred[0, :, :, :, 0]
         print objectness.shape, objectness.max(), objectness.min()
         print y_pred.shape, y_pred.max(), y_pred.min()
 
@@ -287,68 +288,6 @@ def test(batch_num, velodyne_path, label_path=None, calib_path=None, resolution=
         # pred_corners = corners + pred_center
         # print pred_corners
 
-def lidar_generator(batch_num, velodyne_path, label_path=None, calib_path=None, resolution=0.2, dataformat="pcd", label_type="txt", is_velo_cam=False, \
-                        scale=4, x=(0, 80), y=(-40, 40), z=(-2.5, 1.5)):
-    velodynes_path = glob.glob(velodyne_path)
-    labels_path = glob.glob(label_path)
-    calibs_path = glob.glob(calib_path)
-    velodynes_path.sort()
-    labels_path.sort()
-    calibs_path.sort()
-    iter_num = len(velodynes_path) // batch_num
-
-    for itn in range(iter_num):
-        batch_voxel = []
-        batch_g_map = []
-        batch_g_cord = []
-
-        for velodynes, labels, calibs in zip(velodynes_path[itn*batch_num:(itn+1)*batch_num], \
-            labels_path[itn*batch_num:(itn+1)*batch_num], calibs_path[itn*batch_num:(itn+1)*batch_num]):
-            p = []
-            pc = None
-            bounding_boxes = None
-            places = None
-            rotates = None
-            size = None
-            proj_velo = None
-
-            if dataformat == "bin":
-                pc = load_pc_from_bin(velodynes)
-            elif dataformat == "pcd":
-                pc = load_pc_from_pcd(velodynes)
-
-            if calib_path:
-                calib = read_calib_file(calibs)
-                proj_velo = proj_to_velo(calib)[:, :3]
-
-            if label_path:
-                places, rotates, size = read_labels(labels, label_type, calib_path=calib_path, is_velo_cam=is_velo_cam, proj_velo=proj_velo)
-                if places is None:
-                    continue
-
-            corners = get_boxcorners(places, rotates, size)
-            filter_car_data(corners)
-            pc = filter_camera_angle(pc)
-
-            voxel =  raw_to_voxel(pc, resolution=resolution, x=x, y=y, z=z)
-            # center_sphere = center_to_sphere(places, size, resolution=resolution, min_value=np.array([0., -40, -2.5]), scale=scale, x=x, y=y, z=(-2.5, 2.3))
-            # corner_label = corner_to_train(corners, center_sphere, resolution=resolution, x=x, y=y, z=(-2.5, 2.3), scale=scale, min_value=np.array([0., -40, -2.5]))
-            center_sphere, corner_label = create_label(places, size, corners, resolution=resolution, x=x, y=y, z=z, \
-                scale=scale, min_value=np.array([x[0], y[0], z[0]]))
-
-            # print center_sphere
-            if not center_sphere.shape[0]:
-                print 1
-                continue
-            g_map = create_objectness_label(center_sphere, resolution=resolution, x=(x[1] - x[0]), y=(y[1] - y[0]), z=(z[1] - z[0]), scale=scale)
-            g_cord = corner_label.reshape(corner_label.shape[0], -1)
-            g_cord = corner_to_voxel(voxel.shape, g_cord, center_sphere, scale=scale)
-
-            batch_voxel.append(voxel)
-            batch_g_map.append(g_map)
-            batch_g_cord.append(g_cord)
-        yield np.array(batch_voxel, dtype=np.float32)[:, :, :, :, np.newaxis], np.array(batch_g_map, dtype=np.float32), np.array(batch_g_cord, dtype=np.float32)
-
 
 if __name__ == '__main__':
     # pcd_path = "../data/training/velodyne/*.bin"
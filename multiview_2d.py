@@ -36,8 +36,101 @@ def convert_xyz_to_2d(places):
     plt.hist(phi)
     plt.show()
 
-def bird_view(places):
-    pass
+# HDL-64E angular resolution of the 2D range map (thesis.txt), in degree
+RANGE_D_THETA = 0.08
+RANGE_D_PHI = 0.4
+RANGE_ROWS = 64
+
+def range_image_shape(d_theta=RANGE_D_THETA, rows=RANGE_ROWS, theta=(-45., 45.)):
+    """(rows, columns) of the range map covering the azimuth range theta"""
+    return rows, int(np.ceil((theta[1] - theta[0]) / d_theta))
+
+def range_image_index(pc, d_theta=RANGE_D_THETA, d_phi=RANGE_D_PHI, rows=RANGE_ROWS, theta=(-45., 45.), phi_max=2.):
+    """Project a scan onto the range map, keeping the nearest return of every cell
+
+    r = int((phi_max - φ) / ⊿φ) and c = int((theta[1] - θ) / ⊿θ), so row 0 is
+    the top beam and column 0 the left edge of the view.
+    # Returns:
+        cells (np.ndarray): int64 (M,) flat r * columns + c of every occupied cell.
+        points (np.ndarray): int64 (M,) row in pc of the nearest return of the cell.
+    """
+    shape = range_image_shape(d_theta=d_theta, rows=rows, theta=theta)
+    d = np.hypot(pc[:, 0], pc[:, 1])
+    theta_deg = np.degrees(np.arctan2(pc[:, 1], pc[:, 0]))
+    phi_deg = np.degrees(np.arctan2(pc[:, 2], d))
+    r = np.floor((phi_max - phi_deg) / d_phi).astype(np.int64)
+    c = np.floor((theta[1] - theta_deg) / d_theta).astype(np.int64)
+    keep = np.flatnonzero((r >= 0) & (r < shape[0]) & (c >= 0) & (c < shape[1]) & (d > 0))
+    cells = r[keep] * shape[1] + c[keep]
+    order = np.lexsort((d[keep], cells))
+    cells = cells[order]
+    first = np.ones(len(cells), dtype=bool)
+    first[1:] = cells[1:] != cells[:-1]
+    return cells[first], keep[order][first]
+
+def range_image(pc, d_theta=RANGE_D_THETA, d_phi=RANGE_D_PHI, rows=RANGE_ROWS, theta=(-45., 45.), phi_max=2., return_points=False):
+    """Dense float32 (rows, columns, 2) range map with the (d, z) of the nearest return, 0 when empty
+
+    With return_points the (rows, columns, 3) xyz of the kept returns is also
+    returned, the anchors range_label and range_to_corners work from.
+    """
+    shape = range_image_shape(d_theta=d_theta, rows=rows, theta=theta)
+    cells, points = range_image_index(pc, d_theta=d_theta, d_phi=d_phi, rows=rows, theta=theta, phi_max=phi_max)
+    image = np.zeros((shape[0] * shape[1], 2), dtype=np.float32)
+    image[cells, 0] = np.hypot(pc[points, 0], pc[points, 1])
+    image[cells, 1] = pc[points, 2]
+    image = image.reshape(shape[0], shape[1], 2)
+    if not return_points:
+        return image
+    xyz = np.zeros((shape[0] * shape[1], 3), dtype=np.float32)
+    xyz[cells] = pc[points, :3]
+    return image, xyz.reshape(shape[0], shape[1], 3)
+
+def range_label(pc, places, rotates, size, d_theta=RANGE_D_THETA, d_phi=RANGE_D_PHI, rows=RANGE_ROWS, theta=(-45., 45.), phi_max=2.):
+    """Objectness and corner regression labels on the range map
+
+    A cell is positive when its return lies inside a box, its target is the
+    offset of the 8 box corners from that return.
+    # Returns:
+        g_map (np.ndarray): float32 (rows, columns).
+        g_cord (np.ndarray): float32 (rows, columns, 24).
+    """
+    shape = range_image_shape(d_theta=d_theta, rows=rows, theta=theta)
+    g_map = np.zeros(shape[0] * shape[1], dtype=np.float32)
+    g_cord = np.zeros((shape[0] * shape[1], 24), dtype=np.float32)
+    if places is not None:
+        corners = get_boxcorners(places, rotates, size)
+        places, rotates, size = boxcorners_to_center(corners)
+        cells, points = range_image_index(pc, d_theta=d_theta, d_phi=d_phi, rows=rows, theta=theta, phi_max=phi_max)
+        xyz = pc[points, :3].astype(np.float64)
+        offset = xyz[:, np.newaxis] - places[np.newaxis]
+        cos, sin = np.cos(rotates), np.sin(rotates)
+        local_x = offset[:, :, 0] * cos + offset[:, :, 1] * sin
+        local_y = -offset[:, :, 0] * sin + offset[:, :, 1] * cos
+        inside = (np.abs(local_x) <= size[:, 2] / 2.) & (np.abs(local_y) <= size[:, 1] / 2.) & \
+            (offset[:, :, 2] >= 0) & (offset[:, :, 2] <= size[:, 0])
+        positive = inside.any(axis=1)
+        box = inside[positive].argmax(axis=1)
+        g_map[cells[positive]] = 1
+        g_cord[cells[positive]] = (corners[box] - xyz[positive, np.newaxis]).reshape(-1, 24)
+    return g_map.reshape(shape), g_cord.reshape(shape[0], shape[1], 24)
+
+def range_to_corners(y_pred, cordinate, points, threshold=0.995):
+    """Decode one range map prediction into corners (N, 8, 3) and scores (N,)"""
+    mask = (y_pred[..., 0] >= threshold) & np.any(points != 0, axis=-1)
+    corners = cordinate[mask].reshape(-1, 8, 3) + points[mask][:, np.newaxis]
+    return corners, y_pred[..., 0][mask]
+
+def range_frame(velodyne_path, label_path=None, calib_path=None, dataformat="bin", label_type="txt", is_velo_cam=False, theta=(-45., 45.)):
+    """Range map, objectness and corner labels of one frame for the 2D FCN"""
+    pc, places, rotates, size = load_frame(velodyne_path, label_path=label_path, calib_path=calib_path, \
+        dataformat=dataformat, label_type=label_type, is_velo_cam=is_velo_cam)
+    g_map, g_cord = range_label(pc, places, rotates, size, theta=theta)
+    return range_image(pc, theta=theta), g_map, g_cord
+
+def bird_view(places, resolution=0.50, x=(0, 90), y=(-50, 50), z=(-4.5, 5.5), slices=4):
+    """Bird's eye view height, intensity and density maps, see raw_to_bird_view"""
+    return raw_to_bird_view(places, resolution=resolution, x=x, y=y, z=z, slices=slices, camera_angle=True)
 
 def process(velodyne_path, label_path=None, calib_path=None, dataformat="pcd", label_type="txt", is_velo_cam=False):
     p = []
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+import glob
+import hashlib
+import argparse
+import numpy as np
+from input_velodyne import *
+from label_index import LABEL_COLUMNS, parse_label_rows, frame_id_of, car_labels
+
+
+def _sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+def pack_dataset(velodyne_path, out_path, label_path=None, calib_path=None):
+    """Pack every velodyne scan of a split into one memory mappable file
+
+    Writes out_path + ".points" (all scans as one float32 (N, 4) array) and
+    out_path + ".index.npz" holding per frame offsets, labels, the label to
+    velodyne projection and the sha1 of every source file.
+    """
+    velodynes_path = sorted(glob.glob(velodyne_path))
+    labels_path = sorted(glob.glob(label_path)) if label_path else [None] * len(velodynes_path)
+    calibs_path = sorted(glob.glob(calib_path)) if calib_path else [None] * len(velodynes_path)
+
+    frame_ids = []
+    offsets = [0]
+    label_offsets = [0]
+    label_types = []
+    label_rows = []
+    proj_velo = []
+    digests = []
+    with open(out_path + ".points", "wb") as f:
+        for velodynes, labels, calibs in zip(velodynes_path, labels_path, calibs_path):
+            with open(velodynes, "rb") as bin_file:
+                data = bin_file.read()
+            f.write(data)
+            frame_ids.append(frame_id_of(velodynes))
+            offsets.append(offsets[-1] + len(data) // 16)
+            digest = [_sha1(data)]
+
+            if labels:
+                with open(labels, "rb") as label_file:
+                    text = label_file.read()
+                types, rows = parse_label_rows(text.decode("utf-8"))
+                label_types.extend(types)
+                label_rows.append(rows)
+                digest.append(_sha1(text))
+            else:
+                digest.append("-")
+            label_offsets.append(label_offsets[-1] + (len(label_rows[-1]) if labels else 0))
+
+            if calibs:
+                with open(calibs, "rb") as calib_file:
+                    digest.append(_sha1(calib_file.read()))
+                proj_velo.append(proj_to_velo(read_calib_file(calibs))[:, :3])
+            else:
+                digest.append("-")
+                proj_velo.append(np.full((3, 3), np.nan))
+            digests.append(digest)
+
+    np.savez(out_path + ".index.npz", frame_ids=np.array(frame_ids), offsets=np.array(offsets, dtype=np.int64), \
+        label_offsets=np.array(label_offsets, dtype=np.int64), label_types=np.array(label_types), \
+        label_rows=np.concatenate(label_rows) if label_rows else np.zeros((0, len(LABEL_COLUMNS)), dtype=np.float32), \
+        proj_velo=np.array(proj_velo).reshape(-1, 3, 3), digests=np.array(digests).reshape(-1, 3))
+    return len(frame_ids)
+
+
+class PackedDataset(object):
+    """Read only view of a split written by pack_dataset
+
+    Scans are zero copy slices of one np.memmap, so random access is O(1)
+    and every worker opening the same pack shares the page cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.points = np.memmap(path + ".points", dtype=np.float32, mode="r").reshape(-1, 4)
+        with np.load(path + ".index.npz") as index:
+            self.frame_ids = index["frame_ids"]
+            self.offsets = index["offsets"]
+            self.label_offsets = index["label_offsets"]
+            self.label_types = index["label_types"]
+            self.label_rows = index["label_rows"]
+            self.proj_velo = index["proj_velo"]
+            self.digests = index["digests"]
+        self._frame_index = dict((str(frame_id), i) for i, frame_id in enumerate(self.frame_ids))
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    def index(self, frame_id):
+        """Position of a frame id such as "002397" """
+        return self._frame_index[str(frame_id)]
+
+    def scan(self, i):
+        """(N, 4) float32 memmap slice of scan i"""
+        return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+    def label_rows_of(self, i):
+        start, end = self.label_offsets[i], self.label_offsets[i + 1]
+        return self.label_types[start:end], self.label_rows[start:end]
+
+    def labels(self, i, is_velo_cam=False):
+        """Car labels of frame i in velodyne coordinate, as read_labels returns them"""
+        types, rows = self.label_rows_of(i)
+        proj_velo = self.proj_velo[i]
+        return car_labels(types, rows, proj_velo=None if np.isnan(proj_velo).any() else proj_velo, is_velo_cam=is_velo_cam)
+
+    def frame(self, i, is_velo_cam=False):
+        """pc, places, rotates, size of frame i, like load_frame"""
+        places, rotates, size = self.labels(i, is_velo_cam=is_velo_cam)
+        return self.scan(i), places, rotates, size
+
+
+_opened = {}
+
+def open_packed(path):
+    """Open a pack once per process and share the mapping"""
+    if path not in _opened:
+        _opened[path] = PackedDataset(path)
+    return _opened[path]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack KiTTI velodyne scans, labels and calibration into one memory mappable file")
+    parser.add_argument("velodyne", help='glob of scans, e.g. "../data/training/velodyne/*.bin"')
+    parser.add_argument("out", help="output prefix, writes <out>.points and <out>.index.npz")
+    parser.add_argument("--label", default=None, help="glob of label txt files")
+    parser.add_argument("--calib", default=None, help="glob of calibration files")
+    args = parser.parse_args()
+    num = pack_dataset(args.velodyne, args.out, label_path=args.label, calib_path=args.calib)
+    print("packed %d frames into %s.points" % (num, args.out))
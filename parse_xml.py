@@ -27,7 +27,10 @@ or simply on command line:
 # 30/1/14 ch: create example function from example code
 
 from sys import argv as cmdLineArgs
-from xml.etree.ElementTree import ElementTree
+from xml.etree.ElementTree import iterparse
+import os
+import zipfile
+import tempfile
 import numpy as np
 import itertools
 from warnings import warn
@@ -116,147 +119,131 @@ class Tracklet(object):
 #end: class Tracklet
 
 
-def parseXML(trackletFile):
-  r""" parse tracklet xml file and convert results to list of Tracklet objects
+# pose fields in the order of the columns of the per tracklet pose array
+POSE_FIELDS = ('tx', 'ty', 'tz', 'rx', 'ry', 'rz', 'state', 'occlusion', 'occlusion_kf', 'truncation', \
+    'amt_occlusion', 'amt_occlusion_kf', 'amt_border_l', 'amt_border_r', 'amt_border_kf')
+poseFieldIdx = dict((tag, idx) for idx, tag in enumerate(POSE_FIELDS))
 
-  :param trackletFile: name of a tracklet xml file
-  :returns: list of Tracklet objects read from xml file
-  """
+# bump when the layout of the npz cache changes
+CACHE_VERSION = 1
 
-  # convert tracklet XML data to a tree structure
-  eTree = ElementTree()
-  print 'parsing tracklet file', trackletFile
-  with open(trackletFile) as f:
-    eTree.parse(f)
 
-  # now convert output to list of Tracklet objects
-  trackletsElem = eTree.find('tracklets')
+def _enumFromColumn(column, fromText, unset, name):
+  """ map a float column of enum codes to uint8 with a text->value table like stateFromText """
+  keys = sorted(fromText.keys(), key=int)
+  codes = np.array(keys, dtype=float)
+  values = np.array([fromText[key] for key in keys], dtype='uint8')
+  missing = np.isnan(column)
+  idx = np.searchsorted(codes, np.where(missing, codes[0], column)).clip(0, len(codes) - 1)
+  invalid = (codes[idx] != column) & ~missing
+  if invalid.any():
+    raise ValueError('unexpected {0} value in poses: {1}!'.format(name, column[invalid][0]))
+  return np.where(missing, unset, values[idx]).astype('uint8')
+
+
+def _finishTracklet(newTrack, poses, hasAmt):
+  """ split the (nFrames x 15) pose array of a tracklet into its fields """
+  newTrack.trans = poses[:, 0:3]
+  newTrack.rots = poses[:, 3:6]
+  newTrack.states = _enumFromColumn(poses[:, 6], stateFromText, STATE_UNSET, 'state')
+  newTrack.occs = np.stack((_enumFromColumn(poses[:, 7], occFromText, OCC_UNSET, 'occlusion'), \
+      _enumFromColumn(poses[:, 8], occFromText, OCC_UNSET, 'occlusion_kf')), axis=1)
+  newTrack.truncs = _enumFromColumn(poses[:, 9], truncFromText, TRUNC_UNSET, 'truncation')
+  if hasAmt:
+    newTrack.amtOccs = poses[:, 10:12]
+    newTrack.amtBorders = poses[:, 12:15]
+
+
+def _parseXMLStream(trackletFile):
+  """ parse tracklet xml file incrementally with iterparse
+
+  every element is cleared as soon as it is consumed, so memory stays bounded by one
+  tracklet; pose values are collected as text and converted once per tracklet into a
+  preallocated (nFrames x 15) array
+  """
   tracklets = []
   trackletIdx = 0
   nTracklets = None
-  for trackletElem in trackletsElem:
-    #print 'track:', trackletElem.tag
-    if trackletElem.tag == 'count':
-      nTracklets = int(trackletElem.text)
-      print 'file contains', nTracklets, 'tracklets'
-    elif trackletElem.tag == 'item_version':
+  newTrack = Tracklet()
+  isFinished = False
+  hasAmt = False
+  inPoses = False
+  frameIdx = None
+  poses = None
+  poseIdx = []
+  poseText = []
+  for event, elem in iterparse(trackletFile):
+    tag = elem.tag
+    fieldIdx = poseFieldIdx.get(tag)
+    if fieldIdx is not None:
+      # pose field in one frame
+      if not inPoses:
+        raise ValueError('pose item came before number of poses!')
+      poseIdx.append(frameIdx * len(POSE_FIELDS) + fieldIdx)
+      poseText.append(elem.text)
+      hasAmt = hasAmt or fieldIdx >= 10
+    elif tag == 'item' and inPoses:
+      frameIdx += 1
+    elif tag == 'count':
+      if nTracklets is None:
+        nTracklets = int(elem.text)
+        print 'file contains', nTracklets, 'tracklets'
+      else:   # this should come before the poses
+        if newTrack.nFrames is not None:
+          raise ValueError('there are several pose lists for a single track!')
+        newTrack.nFrames = int(elem.text)
+        poses = np.nan * np.ones((newTrack.nFrames, len(POSE_FIELDS)), dtype=float)
+        frameIdx = 0
+        inPoses = True
+    elif tag in ('item_version', 'tracklets', 'boost_serialization'):
       pass
-    elif trackletElem.tag == 'item':
-      #print 'tracklet {0} of {1}'.format(trackletIdx, nTracklets)
-      # a tracklet
-      newTrack = Tracklet()
-      isFinished = False
-      hasAmt = False
-      frameIdx = None
-      for info in trackletElem:
-        #print 'trackInfo:', info.tag
-        if isFinished:
-          raise ValueError('more info on element after finished!')
-        if info.tag == 'objectType':
-          newTrack.objectType = info.text
-        elif info.tag == 'h':
-          newTrack.size[0] = float(info.text)
-        elif info.tag == 'w':
-          newTrack.size[1] = float(info.text)
-        elif info.tag == 'l':
-          newTrack.size[2] = float(info.text)
-        elif info.tag == 'first_frame':
-          newTrack.firstFrame = int(info.text)
-        elif info.tag == 'poses':
-          # this info is the possibly long list of poses
-          for pose in info:
-            #print 'trackInfoPose:', pose.tag
-            if pose.tag == 'count':   # this should come before the others
-              if newTrack.nFrames is not None:
-                raise ValueError('there are several pose lists for a single track!')
-              elif frameIdx is not None:
-                raise ValueError('?!')
-              newTrack.nFrames = int(pose.text)
-              newTrack.trans  = np.nan * np.ones((newTrack.nFrames, 3), dtype=float)
-              newTrack.rots   = np.nan * np.ones((newTrack.nFrames, 3), dtype=float)
-              newTrack.states = np.nan * np.ones(newTrack.nFrames, dtype='uint8')
-              newTrack.occs   = np.nan * np.ones((newTrack.nFrames, 2), dtype='uint8')
-              newTrack.truncs = np.nan * np.ones(newTrack.nFrames, dtype='uint8')
-              newTrack.amtOccs = np.nan * np.ones((newTrack.nFrames, 2), dtype=float)
-              newTrack.amtBorders = np.nan * np.ones((newTrack.nFrames, 3), dtype=float)
-              frameIdx = 0
-            elif pose.tag == 'item_version':
-              pass
-            elif pose.tag == 'item':
-              # pose in one frame
-              if frameIdx is None:
-                raise ValueError('pose item came before number of poses!')
-              for poseInfo in pose:
-                #print 'trackInfoPoseInfo:', poseInfo.tag
-                if poseInfo.tag == 'tx':
-                  newTrack.trans[frameIdx, 0] = float(poseInfo.text)
-                elif poseInfo.tag == 'ty':
-                  newTrack.trans[frameIdx, 1] = float(poseInfo.text)
-                elif poseInfo.tag == 'tz':
-                  newTrack.trans[frameIdx, 2] = float(poseInfo.text)
-                elif poseInfo.tag == 'rx':
-                  newTrack.rots[frameIdx, 0] = float(poseInfo.text)
-                elif poseInfo.tag == 'ry':
-                  newTrack.rots[frameIdx, 1] = float(poseInfo.text)
-                elif poseInfo.tag == 'rz':
-                  newTrack.rots[frameIdx, 2] = float(poseInfo.text)
-                elif poseInfo.tag == 'state':
-                  newTrack.states[frameIdx] = stateFromText[poseInfo.text]
-                elif poseInfo.tag == 'occlusion':
-                  newTrack.occs[frameIdx, 0] = occFromText[poseInfo.text]
-                elif poseInfo.tag == 'occlusion_kf':
-                  newTrack.occs[frameIdx, 1] = occFromText[poseInfo.text]
-                elif poseInfo.tag == 'truncation':
-                  newTrack.truncs[frameIdx] = truncFromText[poseInfo.text]
-                elif poseInfo.tag == 'amt_occlusion':
-                  newTrack.amtOccs[frameIdx,0] = float(poseInfo.text)
-                  hasAmt = True
-                elif poseInfo.tag == 'amt_occlusion_kf':
-                  newTrack.amtOccs[frameIdx,1] = float(poseInfo.text)
-                  hasAmt = True
-                elif poseInfo.tag == 'amt_border_l':
-                  newTrack.amtBorders[frameIdx,0] = float(poseInfo.text)
-                  hasAmt = True
-                elif poseInfo.tag == 'amt_border_r':
-                  newTrack.amtBorders[frameIdx,1] = float(poseInfo.text)
-                  hasAmt = True
-                elif poseInfo.tag == 'amt_border_kf':
-                  newTrack.amtBorders[frameIdx,2] = float(poseInfo.text)
-                  hasAmt = True
-                else:
-                  raise ValueError('unexpected tag in poses item: {0}!'.format(poseInfo.tag))
-              frameIdx += 1
-            else:
-              raise ValueError('unexpected pose info: {0}!'.format(pose.tag))
-        elif info.tag == 'finished':
-          isFinished = True
-        else:
-          raise ValueError('unexpected tag in tracklets: {0}!'.format(info.tag))
-      #end: for all fields in current tracklet
-
-      # some final consistency checks on new tracklet
+    elif isFinished and tag != 'item':
+      raise ValueError('more info on element after finished!')
+    elif tag == 'objectType':
+      newTrack.objectType = elem.text
+    elif tag == 'h':
+      newTrack.size[0] = float(elem.text)
+    elif tag == 'w':
+      newTrack.size[1] = float(elem.text)
+    elif tag == 'l':
+      newTrack.size[2] = float(elem.text)
+    elif tag == 'first_frame':
+      newTrack.firstFrame = int(elem.text)
+    elif tag == 'poses':
+      inPoses = False
+    elif tag == 'finished':
+      isFinished = True
+    elif tag == 'item':
+      # end of a tracklet, some final consistency checks on it
       if not isFinished:
         warn('tracklet {0} was not finished!'.format(trackletIdx))
       if newTrack.nFrames is None:
         warn('tracklet {0} contains no information!'.format(trackletIdx))
-      elif frameIdx != newTrack.nFrames:
-        warn('tracklet {0} is supposed to have {1} frames, but perser found {1}!'.format(\
-            trackletIdx, newTrack.nFrames, frameIdx))
-      if np.abs(newTrack.rots[:,:2]).sum() > 1e-16:
-        warn('track contains rotation other than yaw!')
-
-      # if amtOccs / amtBorders are not set, set them to None
-      if not hasAmt:
-        newTrack.amtOccs = None
-        newTrack.amtBorders = None
+      else:
+        if frameIdx != newTrack.nFrames:
+          warn('tracklet {0} is supposed to have {1} frames, but perser found {1}!'.format(\
+              trackletIdx, newTrack.nFrames, frameIdx))
+        poseIdx = np.array(poseIdx, dtype=np.int64)
+        if len(poseIdx) and poseIdx.max() >= poses.size:
+          raise ValueError('tracklet {0} has more poses than its count!'.format(trackletIdx))
+        poses.flat[poseIdx] = np.array(poseText, dtype=float)
+        _finishTracklet(newTrack, poses, hasAmt)
+        if np.abs(newTrack.rots[:,:2]).sum() > 1e-16:
+          warn('track contains rotation other than yaw!')
 
       # add new tracklet to list
       tracklets.append(newTrack)
       trackletIdx += 1
-
+      newTrack = Tracklet()
+      isFinished = False
+      hasAmt = False
+      frameIdx = None
+      poses = None
+      poseIdx = []
+      poseText = []
     else:
-      raise ValueError('unexpected tracklet info')
-  #end: for tracklet list items
+      raise ValueError('unexpected tag in tracklets: {0}!'.format(tag))
+    elem.clear()
 
   print 'loaded', trackletIdx, 'tracklets'
 
@@ -265,9 +252,155 @@ def parseXML(trackletFile):
     warn('according to xml information the file has {0} tracklets, but parser found {1}!'.format(nTracklets, trackletIdx))
 
   return tracklets
+
+
+def _xmlSignature(trackletFile):
+  stat = os.stat(trackletFile)
+  return np.array([CACHE_VERSION, stat.st_size, stat.st_mtime], dtype=float)
+
+
+def saveTracklets(tracklets, cacheFile, signature=None):
+  """ write tracklets to an npz file, all poses concatenated along the first axis """
+  nFrames = np.array([t.nFrames or 0 for t in tracklets], dtype=np.int64)
+  total = nFrames.sum()
+
+  def column(name, shape, dtype, fill):
+    parts = [getattr(t, name) if getattr(t, name) is not None else np.full((t.nFrames or 0,) + shape, fill, dtype=dtype) \
+        for t in tracklets]
+    return np.concatenate(parts).astype(dtype) if parts else np.zeros((total,) + shape, dtype=dtype)
+
+  # unique temp name, the pool workers parsing the same xml may write the cache at once
+  fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cacheFile)), suffix='.npz')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      np.savez(f, signature=signature if signature is not None else np.zeros(3), \
+          objectTypes=np.array([t.objectType or '' for t in tracklets]), \
+          sizes=np.array([t.size for t in tracklets], dtype=float).reshape(-1, 3), \
+          firstFrames=np.array([t.firstFrame if t.firstFrame is not None else -1 for t in tracklets], dtype=np.int64), \
+          nFrames=np.array([t.nFrames if t.nFrames is not None else -1 for t in tracklets], dtype=np.int64), \
+          hasAmt=np.array([t.amtOccs is not None for t in tracklets], dtype=bool), \
+          trans=column('trans', (3,), float, np.nan), rots=column('rots', (3,), float, np.nan), \
+          states=column('states', (), 'uint8', STATE_UNSET), occs=column('occs', (2,), 'uint8', OCC_UNSET), \
+          truncs=column('truncs', (), 'uint8', TRUNC_UNSET), amtOccs=column('amtOccs', (2,), float, np.nan), \
+          amtBorders=column('amtBorders', (3,), float, np.nan))
+    os.rename(tmpFile, cacheFile)
+  except Exception:
+    if os.path.exists(tmpFile):
+      os.remove(tmpFile)
+    raise
+
+
+def loadTracklets(cacheFile, signature=None):
+  """ read tracklets written by saveTracklets, None if the signature of the source xml changed """
+  with np.load(cacheFile) as npz:
+    if signature is not None and not np.array_equal(npz['signature'], signature):
+      return None
+    data = dict((name, npz[name]) for name in npz.files)
+  offsets = np.concatenate(([0], np.cumsum(data['nFrames'].clip(0))))
+  tracklets = []
+  for idx in range(len(data['nFrames'])):
+    newTrack = Tracklet()
+    newTrack.objectType = str(data['objectTypes'][idx]) or None
+    newTrack.size = data['sizes'][idx]
+    newTrack.firstFrame = int(data['firstFrames'][idx]) if data['firstFrames'][idx] >= 0 else None
+    if data['nFrames'][idx] >= 0:
+      newTrack.nFrames = int(data['nFrames'][idx])
+      frames = slice(offsets[idx], offsets[idx + 1])
+      for name in ('trans', 'rots', 'states', 'occs', 'truncs'):
+        setattr(newTrack, name, data[name][frames])
+      if data['hasAmt'][idx]:
+        newTrack.amtOccs = data['amtOccs'][frames]
+        newTrack.amtBorders = data['amtBorders'][frames]
+    tracklets.append(newTrack)
+  return tracklets
+
+
+def parseXML(trackletFile, cacheFile=None):
+  r""" parse tracklet xml file and convert results to list of Tracklet objects
+
+  :param trackletFile: name of a tracklet xml file
+  :param cacheFile: optional npz sidecar (e.g. trackletFile + '.npz'); loaded instead of the xml
+                    while the xml keeps its size and mtime, written after parsing otherwise
+  :returns: list of Tracklet objects read from xml file
+  """
+  signature = _xmlSignature(trackletFile)
+  if cacheFile is not None and os.path.exists(cacheFile):
+    try:
+      tracklets = loadTracklets(cacheFile, signature)
+    except (IOError, ValueError, KeyError, EOFError, zipfile.BadZipfile):
+      tracklets = None
+    if tracklets is not None:
+      return tracklets
+
+  print 'parsing tracklet file', trackletFile
+  tracklets = _parseXMLStream(trackletFile)
+
+  if cacheFile is not None:
+    try:
+      saveTracklets(tracklets, cacheFile, signature)
+    except (IOError, OSError) as e:
+      warn('could not write tracklet cache {0}: {1}'.format(cacheFile, e))
+  return tracklets
 #end: function parseXML
 
 
+class TrackletIndex(object):
+  """ every pose of a list of tracklets as flat arrays sorted by frame
+
+  frames, trackIds, places (x,y,z), yaws, sizes (h,w,l), objectTypes, occlusions and truncations
+  have one entry per pose; the poses of frame f are rows frameOffsets[f]:frameOffsets[f+1],
+  so the boxes of any frame are array slices:
+
+  index = TrackletIndex(parseXML(trackletFile))
+  places, yaws, sizes = index.boxes(frameIdx)
+  """
+
+  def __init__(self, tracklets):
+    tracklets = [t for t in tracklets if t.nFrames]
+    nFrames = np.array([t.nFrames for t in tracklets], dtype=np.int64)
+    trackIds = np.repeat(np.arange(len(tracklets)), nFrames)
+    frames = np.concatenate([np.arange(t.firstFrame, t.firstFrame + t.nFrames) for t in tracklets]) \
+        if tracklets else np.zeros(0, dtype=np.int64)
+    # stable, so poses of a frame stay in tracklet order
+    order = np.argsort(frames, kind='mergesort')
+
+    def column(name, shape, dtype):
+      if not tracklets:
+        return np.zeros((0,) + shape, dtype=dtype)
+      return np.concatenate([getattr(t, name) for t in tracklets]).astype(dtype)[order]
+
+    self.frames = frames[order]
+    self.trackIds = trackIds[order]
+    self.places = column('trans', (3,), float)
+    self.yaws = column('rots', (3,), float)[:, 2]
+    self.sizes = np.repeat(np.array([t.size for t in tracklets], dtype=float).reshape(-1, 3), nFrames, axis=0)[order]
+    self.objectTypes = np.repeat(np.array([t.objectType for t in tracklets]), nFrames)[order]
+    self.occlusions = column('occs', (2,), 'uint8')[:, 0]
+    self.truncations = column('truncs', (), 'uint8')
+    nFramesTotal = self.frames[-1] + 1 if len(self.frames) else 0
+    self.frameOffsets = np.searchsorted(self.frames, np.arange(nFramesTotal + 1))
+
+  def __len__(self):
+    """ number of frames up to the last labeled one """
+    return len(self.frameOffsets) - 1
+
+  def frame(self, frameIdx):
+    """ slice of the poses of one frame, empty for frames without labels """
+    if frameIdx < 0 or frameIdx >= len(self):
+      return slice(0, 0)
+    return slice(self.frameOffsets[frameIdx], self.frameOffsets[frameIdx + 1])
+
+  def boxes(self, frameIdx, objectTypes=None):
+    """ places, yaws and sizes of the objects in one frame, optionally only some object types """
+    poses = self.frame(frameIdx)
+    places, yaws, sizes = self.places[poses], self.yaws[poses], self.sizes[poses]
+    if objectTypes is not None:
+      keep = np.isin(self.objectTypes[poses], objectTypes)
+      places, yaws, sizes = places[keep], yaws[keep], sizes[keep]
+    return places, yaws, sizes
+#end: class TrackletIndex
+
+
 def example(kittiDir=None, drive=None):
 
   from os.path import join, expanduser
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+import numpy as np
+from input_velodyne import sphere_to_center, get_boxcorners, boxcorners_to_center
+
+# Bottom corners of get_boxcorners in counter clockwise order
+BEV_CORNERS = [0, 1, 5, 2]
+
+
+def decode_boxes(y_pred, cordinate, resolution=0.5, scale=4, min_value=np.array([0., -50., -4.5]), threshold=0.995):
+    """Corners (N, 8, 3) and scores (N,) of every cell whose objectness reaches threshold, for one frame"""
+    index = np.where(y_pred[..., 0] >= threshold)
+    centers = sphere_to_center(np.vstack(index).transpose(), resolution=resolution, scale=scale, min_value=min_value)
+    corners = cordinate[index].reshape(-1, 8, 3) + centers[:, np.newaxis]
+    return corners, y_pred[index][:, 0]
+
+def rectify_boxes(corners):
+    """Closest boxes to regressed corners, as (footprint (N, 4, 2) counter clockwise, bottom (N,), top (N,))"""
+    places, rotates, size = boxcorners_to_center(corners)
+    rectified = get_boxcorners(places, rotates, np.hstack((size[:, :2], np.minimum(size[:, 2:], 10))))
+    return rectified[:, BEV_CORNERS, :2], places[:, 2], places[:, 2] + size[:, 0]
+
+def _cross(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+def _inside(points, polygon):
+    """(P, K) whether each of K points lies in the counter clockwise convex polygon (P, 4, 2)"""
+    edge = np.roll(polygon, -1, axis=1) - polygon
+    rel = points[:, :, np.newaxis] - polygon[:, np.newaxis]
+    return (_cross(edge[:, np.newaxis], rel) >= -1e-9).all(axis=2)
+
+def polygon_area(polygon):
+    """Shoelace area of (..., K, 2) polygons"""
+    return 0.5 * np.abs(_cross(polygon, np.roll(polygon, -1, axis=-2)).sum(axis=-1))
+
+def intersection_area(a, b):
+    """Intersection area of pairs of convex quadrilaterals a[i], b[i] (P, 4, 2), counter clockwise
+
+    The intersection polygon is made of the vertices of each box inside the
+    other and of the edge crossings: 4 + 4 + 16 candidates per pair, sorted
+    by angle around their centroid, then the shoelace formula.
+    """
+    pairs = len(a)
+    p, r = a, np.roll(a, -1, axis=1) - a
+    q, s = b, np.roll(b, -1, axis=1) - b
+    rxs = _cross(r[:, :, np.newaxis], s[:, np.newaxis])
+    qp = q[:, np.newaxis] - p[:, :, np.newaxis]
+    parallel = np.abs(rxs) < 1e-12
+    rxs = np.where(parallel, 1., rxs)
+    t = _cross(qp, s[:, np.newaxis]) / rxs
+    u = _cross(qp, r[:, :, np.newaxis]) / rxs
+    crossing = ~parallel & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    crossings = p[:, :, np.newaxis] + t[..., np.newaxis] * r[:, :, np.newaxis]
+
+    points = np.concatenate((a, b, crossings.reshape(pairs, 16, 2)), axis=1)
+    valid = np.concatenate((_inside(a, b), _inside(b, a), crossing.reshape(pairs, 16)), axis=1)
+    count = valid.sum(axis=1)
+    center = (points * valid[..., np.newaxis]).sum(axis=1) / np.maximum(count, 1)[:, np.newaxis]
+    angle = np.arctan2(points[..., 1] - center[:, 1:2], points[..., 0] - center[:, 0:1])
+    angle[~valid] = np.inf
+    order = np.argsort(angle, axis=1)
+    points = np.take_along_axis(points, order[..., np.newaxis], axis=1)
+    valid = np.take_along_axis(valid, order, axis=1)
+    # collapse the invalid tail onto the first vertex, its edges have no area
+    points = np.where(valid[..., np.newaxis], points, points[:, :1])
+    area = polygon_area(points)
+    area[count < 3] = 0.
+    return area
+
+def pairwise_iou(footprint_a, footprint_b, bottom_a=None, top_a=None, bottom_b=None, top_b=None):
+    """IoU of pairs of rotated boxes: bird's eye view, or 3D when the z extents are given"""
+    inter = intersection_area(footprint_a, footprint_b)
+    area_a = polygon_area(footprint_a)
+    area_b = polygon_area(footprint_b)
+    if bottom_a is None:
+        return inter / np.maximum(area_a + area_b - inter, 1e-9)
+    overlap = np.maximum(0., np.minimum(top_a, top_b) - np.maximum(bottom_a, bottom_b))
+    inter = inter * overlap
+    union = area_a * (top_a - bottom_a) + area_b * (top_b - bottom_b) - inter
+    return inter / np.maximum(union, 1e-9)
+
+def iou_matrix(footprint_a, footprint_b, bottom_a=None, top_a=None, bottom_b=None, top_b=None):
+    """(N, M) IoU of every box of a against every box of b"""
+    i, j = np.meshgrid(np.arange(len(footprint_a)), np.arange(len(footprint_b)), indexing="ij")
+    i, j = i.ravel(), j.ravel()
+    if bottom_a is None:
+        iou = pairwise_iou(footprint_a[i], footprint_b[j])
+    else:
+        iou = pairwise_iou(footprint_a[i], footprint_b[j], bottom_a[i], top_a[i], bottom_b[j], top_b[j])
+    return iou.reshape(len(footprint_a), len(footprint_b))
+
+def overlap_pairs(footprint):
+    """Pairs (i, j), i < j, whose bird's eye view extents and bounding circles overlap
+
+    Sorted sweep over the x extents, so only boxes that can intersect reach
+    the IoU kernel instead of all N * N pairs.
+    """
+    lower = footprint.min(axis=1)
+    upper = footprint.max(axis=1)
+    order = np.argsort(lower[:, 0], kind="mergesort")
+    x_lower = lower[order, 0]
+    end = np.searchsorted(x_lower, upper[order, 0], side="right")
+    count = np.maximum(end - np.arange(len(order)) - 1, 0)
+    first = np.repeat(np.arange(len(order)), count)
+    second = first + 1 + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    first, second = order[first], order[second]
+    keep = (lower[first, 1] <= upper[second, 1]) & (lower[second, 1] <= upper[first, 1])
+    first, second = first[keep], second[keep]
+    center = footprint.mean(axis=1)
+    radius = np.hypot(*(footprint[:, 0] - footprint[:, 2]).T) / 2.
+    keep = np.hypot(*(center[first] - center[second]).T) <= radius[first] + radius[second]
+    first, second = first[keep], second[keep]
+    return np.minimum(first, second), np.maximum(first, second)
+
+def nms(corners, scores, iou_threshold=0.5, top_k=None, score_threshold=None, use_3d=False):
+    """Greedy non maximum suppression of rotated boxes
+
+    # Args:
+        corners (np.ndarray): (N, 8, 3) candidate boxes.
+        scores (np.ndarray): (N,) objectness probability.
+        top_k (int): keep at most top_k highest scores before suppression.
+        use_3d (bool): 3D IoU instead of bird's eye view IoU.
+    # Returns:
+        keep (np.ndarray): indices of the kept boxes, highest score first.
+    """
+    order = np.argsort(-scores, kind="mergesort")
+    if score_threshold is not None:
+        order = order[scores[order] >= score_threshold]
+    if top_k is not None:
+        order = order[:top_k]
+    if len(order) == 0:
+        return order
+
+    footprint, bottom, top = rectify_boxes(corners[order])
+    first, second = overlap_pairs(footprint)
+    if use_3d:
+        iou = pairwise_iou(footprint[first], footprint[second], bottom[first], top[first], bottom[second], top[second])
+    else:
+        iou = pairwise_iou(footprint[first], footprint[second])
+    # boxes are in score order, so first always outranks second
+    first, second = first[iou > iou_threshold], second[iou > iou_threshold]
+    edges = np.argsort(first, kind="mergesort")
+    first, second = first[edges], second[edges]
+    offsets = np.searchsorted(first, np.arange(len(order) + 1))
+
+    suppressed = np.zeros(len(order), dtype=bool)
+    for i in range(len(order)):
+        if not suppressed[i]:
+            suppressed[second[offsets[i]:offsets[i + 1]]] = True
+    return order[~suppressed]
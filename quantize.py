@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import os
+import glob
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from input_velodyne import *
+from export_graph import load_layers, build_folded_graph, write_graph
+from model_01_deconv import Detector
+
+PRECISIONS = ("float16", "int8_weights", "int8")
+
+
+def occupancy_batches(velodyne_path, voxel_shape, resolution=0.25, x=(0, 90), y=(-50, 50), z=(-5.5, 4.5), num_frames=32, batch_num=1):
+    """uint8 occupancy batches of the first num_frames scans of a split"""
+    velodynes_path = sorted(glob.glob(velodyne_path))[:num_frames]
+    for start in range(0, len(velodynes_path), batch_num):
+        batch_coords = [raw_to_sparse_voxel(load_pc_from_bin(path), resolution=resolution, x=x, y=y, z=z, camera_angle=True)[0] \
+            for path in velodynes_path[start:start + batch_num]]
+        yield batch_sparse_to_voxel(batch_coords, voxel_shape, dtype=np.uint8)
+
+def calibrate(layers, voxel_shape, batches):
+    """Per channel (min, max) of every folded layer output over the calibration batches
+
+    Ranges are per channel: a per tensor range spans the batch norm shift of
+    every channel and leaves too few levels for the occupied voxels.
+    """
+    graph = build_folded_graph(layers, voxel_shape, input_dtype=tf.uint8)
+    voxel = graph.get_tensor_by_name("voxel:0")
+    outputs = [graph.get_tensor_by_name("layer%d/output:0" % i) for i in range(len(layers))]
+    ranges = [None] * len(layers)
+    with tf.Session(graph=graph) as sess:
+        for batch in batches:
+            for i, value in enumerate(sess.run(outputs, feed_dict={voxel: batch})):
+                value = value.reshape(-1, value.shape[-1])
+                lower, upper = value.min(axis=0), value.max(axis=0)
+                if ranges[i] is not None:
+                    lower, upper = np.minimum(lower, ranges[i][0]), np.maximum(upper, ranges[i][1])
+                ranges[i] = (lower, upper)
+    return ranges
+
+def quantize(checkpoint, output_path, precision="int8", velodyne_path=None, voxel_shape=(360, 400, 40), resolution=0.25, \
+             x=(0, 90), y=(-50, 50), z=(-5.5, 4.5), num_frames=32):
+    """Write a batch norm folded float16 / int8_weights / int8 graph with a uint8 occupancy input
+
+    int8 calibrates the activation ranges on the first num_frames scans of velodyne_path.
+    """
+    layers = load_layers(checkpoint, voxel_shape)
+    ranges = None
+    if precision == "int8":
+        ranges = calibrate(layers, voxel_shape, occupancy_batches(velodyne_path, voxel_shape, resolution=resolution, \
+            x=x, y=y, z=z, num_frames=num_frames))
+    graph = build_folded_graph(layers, voxel_shape, precision=precision, ranges=ranges, input_dtype=tf.uint8)
+    return write_graph(graph, output_path)
+
+def report(models, pcs, voxel_shape=(360, 400, 40), resolution=0.25, scale=8, x=(0, 90), y=(-50, 50), z=(-5.5, 4.5), \
+           threshold=0.995, repeat=5):
+    """Accuracy against the first model and latency of every (name, checkpoint or .pb) model
+
+    # Returns:
+        rows (list): (name, load s, inference ms/frame, graph MB, max objectness probability
+            difference, Jaccard of the cells over threshold, mean cordinate error on the reference cells)
+    """
+    rows = []
+    reference = None
+    for name, path in models:
+        start = time.time()
+        detector = Detector(path, resolution=resolution, scale=scale, voxel_shape=voxel_shape, x=x, y=y, z=z)
+        load_time = time.time() - start
+        with detector:
+            batch_voxel = detector.preprocess(pcs)
+            _, cordinate, y_pred = detector.run(batch_voxel)
+            durations = []
+            for _ in range(repeat):
+                start = time.time()
+                detector.run(batch_voxel)
+                durations.append(time.time() - start)
+        size = sum(os.path.getsize(f) for f in glob.glob(path + "*")) / 1e6
+        if reference is None:
+            reference = (cordinate, y_pred)
+        cells = y_pred[..., 0] >= threshold
+        reference_cells = reference[1][..., 0] >= threshold
+        jaccard = (cells & reference_cells).sum() / float(max((cells | reference_cells).sum(), 1))
+        error = np.abs(cordinate - reference[0])[reference_cells].mean() if reference_cells.any() else 0.
+        rows.append((name, load_time, np.median(durations) / len(pcs) * 1000, size, \
+            float(np.abs(y_pred - reference[1]).max()), jaccard, float(error)))
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="float16 / int8 export of a voxel checkpoint with an accuracy vs latency report")
+    parser.add_argument("--checkpoint", default="./velodyne_025_deconv_norm_valid40.ckpt")
+    parser.add_argument("--velodyne", default="../data/training/velodyne/*.bin", help="calibration and report scans")
+    parser.add_argument("--precision", nargs="+", default=list(PRECISIONS), choices=PRECISIONS)
+    parser.add_argument("--calibration-frames", type=int, default=32)
+    parser.add_argument("--report-frames", type=int, default=4)
+    parser.add_argument("--resolution", type=float, default=0.25)
+    parser.add_argument("--scale", type=int, default=8)
+    args = parser.parse_args()
+
+    x, y, z = (0, 90), (-50, 50), (-5.5, 4.5)
+    voxel_shape = voxel_grid_shape(args.resolution, x, y, z)
+    prefix = os.path.splitext(args.checkpoint)[0]
+    models = [("float32", args.checkpoint)]
+    for precision in args.precision:
+        output_path = "%s_%s.pb" % (prefix, precision)
+        quantize(args.checkpoint, output_path, precision=precision, velodyne_path=args.velodyne, voxel_shape=voxel_shape, \
+            resolution=args.resolution, x=x, y=y, z=z, num_frames=args.calibration_frames)
+        models.append((precision, output_path))
+
+    pcs = [load_pc_from_bin(path) for path in sorted(glob.glob(args.velodyne))[:args.report_frames]]
+    print("%-12s %7s %10s %9s %10s %8s %10s" % ("model", "load s", "ms/frame", "size MB", "max dprob", "jaccard", "cord err"))
+    for row in report(models, pcs, voxel_shape=voxel_shape, resolution=args.resolution, scale=args.scale, x=x, y=y, z=z):
+        print("%-12s %7.2f %10.1f %9.2f %10.2e %8.3f %10.2e" % row)
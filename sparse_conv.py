@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+import numpy as np
+import tensorflow as tf
+from model_01_deconv import conv3DLayer, conv3D_to_output, batch_norm
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# (name, input_dim, output_dim, kernel size, stride) of the strided BNBLayer layers run on active sites only
+SPARSE_LAYERS = (("layer1", 1, 16, 5, 2), ("layer2", 16, 32, 5, 2), ("layer3", 32, 64, 3, 2))
+
+
+def same_padding(shape, size, stride):
+    """Output shape and leading padding of a SAME padded convolution, as tf.nn.conv3d computes them"""
+    out_shape = tuple(-(-s // stride) for s in shape)
+    pad = np.array([max((o - 1) * stride + size - s, 0) // 2 for s, o in zip(shape, out_shape)], dtype=np.int32)
+    return out_shape, pad
+
+def kernel_offsets(size):
+    """(size ** 3, 3) kernel positions in the C order of a [length, height, width, in, out] kernel"""
+    return np.indices((size, size, size)).reshape(3, -1).transpose().astype(np.int32)
+
+if numba is not None:
+    @numba.njit(cache=True, nogil=True)
+    def _rulebook_kernel(coords, pad, out_shape, size, stride, row, table):
+        """Mark the reached sites of the flat output grid row (-1 unreached), or fill table once they are numbered"""
+        for i in range(coords.shape[0]):
+            for kx in range(size):
+                px = coords[i, 1] + pad[0] - kx
+                if px < 0 or px % stride != 0 or px // stride >= out_shape[0]:
+                    continue
+                for ky in range(size):
+                    py = coords[i, 2] + pad[1] - ky
+                    if py < 0 or py % stride != 0 or py // stride >= out_shape[1]:
+                        continue
+                    for kz in range(size):
+                        pz = coords[i, 3] + pad[2] - kz
+                        if pz < 0 or pz % stride != 0 or pz // stride >= out_shape[2]:
+                            continue
+                        key = ((coords[i, 0] * out_shape[0] + px // stride) * out_shape[1] + py // stride) * out_shape[2] + pz // stride
+                        if table.shape[0] == 0:
+                            row[key] = 0
+                        else:
+                            table[row[key], (kx * size + ky) * size + kz] = i
+
+def rulebook(coords, shape, size, stride):
+    """Neighbor table of a SAME padded strided 3D convolution over the active sites
+
+    An output site is active when an active input lies in its receptive
+    field, so every output that differs from the empty scan is computed.
+    Compiled with numba when it is installed.
+    # Args:
+        coords (np.ndarray): int32 (N, 4) [batch, x, y, z] active input sites.
+        shape (tuple): input grid shape.
+    # Returns:
+        out_coords (np.ndarray): int32 (M, 4) active output sites, sorted.
+        out_shape (tuple): output grid shape.
+        table (np.ndarray): int32 (M, size ** 3) input row under each kernel
+            position of each output, N (a zero row) where the input is empty.
+    """
+    out_shape, pad = same_padding(shape, size, stride)
+    offsets = kernel_offsets(size)
+    batch_size = int(coords[:, 0].max()) + 1 if len(coords) else 0
+    if numba is not None:
+        coords64, pad64, shape64 = coords.astype(np.int64), pad.astype(np.int64), np.array(out_shape, dtype=np.int64)
+        row = np.full(batch_size * int(np.prod(out_shape)), -1, dtype=np.int64)
+        _rulebook_kernel(coords64, pad64, shape64, size, stride, row, np.zeros((0, len(offsets)), dtype=np.int32))
+        active = np.flatnonzero(row == 0)
+        row[active] = np.arange(len(active))
+        table = np.full((len(active), len(offsets)), len(coords), dtype=np.int32)
+        _rulebook_kernel(coords64, pad64, shape64, size, stride, row, table)
+        out_coords = np.column_stack(np.unravel_index(active, (batch_size,) + tuple(out_shape))).astype(np.int32).reshape(-1, 4)
+        return out_coords, out_shape, table
+
+    # inputs of one parity class reach outputs through the same kernel positions only
+    residue = (coords[:, 1:] + pad) % stride
+    residue_class = np.ravel_multi_index(residue.transpose(), (stride, stride, stride)) if len(coords) else np.zeros(0, dtype=np.int64)
+    pairs_in, pairs_k, out = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros((0, 3), dtype=np.int64)]
+    for r in np.unique(residue_class):
+        rows = np.where(residue_class == r)[0]
+        ks = np.where(((residue[rows[0]] - offsets) % stride == 0).all(axis=1))[0]
+        position = (coords[rows, np.newaxis, 1:] + pad - offsets[ks]) // stride
+        valid = ((position >= 0) & (position < np.array(out_shape))).all(axis=2)
+        i, k = np.nonzero(valid)
+        pairs_in.append(rows[i])
+        pairs_k.append(ks[k])
+        out.append(position[i, k])
+    pairs_in, pairs_k, out = np.concatenate(pairs_in), np.concatenate(pairs_k), np.concatenate(out)
+
+    # mark the reached output sites on a flat grid, sorted and numbered by a cumulative sum
+    key = np.ravel_multi_index((coords[pairs_in, 0],) + tuple(out.transpose()), (batch_size,) + tuple(out_shape))
+    occupied = np.zeros(batch_size * int(np.prod(out_shape)), dtype=bool)
+    occupied[key] = True
+    active = np.flatnonzero(occupied)
+    row = np.cumsum(occupied) - 1
+    out_coords = np.column_stack(np.unravel_index(active, (batch_size,) + tuple(out_shape))).astype(np.int32).reshape(-1, 4)
+    table = np.full((len(active), len(offsets)), len(coords), dtype=np.int32)
+    table[row[key], pairs_k] = pairs_in
+    return out_coords, out_shape, table
+
+def batch_coords(coords_list):
+    """(N, 4) active sites of a batch of raw_to_sparse_voxel coords, the batch position prepended"""
+    return np.concatenate([np.hstack((np.full((len(coords), 1), i, dtype=np.int32), coords)) \
+        for i, coords in enumerate(coords_list)] + [np.zeros((0, 4), dtype=np.int32)])
+
+
+class SparseBNBLayer(object):
+    """BNBLayer inference on the occupied voxels, loading the dense checkpoint as is
+
+    Empty space is not zero in the dense network: every layer adds its
+    bias, ReLU and batch norm shift, and SAME padding makes the grid border
+    differ again. So the layers run on the difference from the empty scan:
+    pre = empty_pre + sum_k W_k (x - empty) over the active inputs, which
+    is exact everywhere. The empty scan pre-activations and outputs depend on
+    the weights only; cache_background computes them once after restoring.
+
+    layer1 to layer3 gather the inputs of every active output through the
+    rulebook neighbor table and run one matmul (im2col). layer3 is scattered
+    back onto its 45x50x5 grid, where layer4 and the objectness / cordinate
+    heads run dense as in BNBLayer.
+    """
+
+    def build_graph(self, voxel_shape, activation=tf.nn.relu):
+        self.voxel_shape = tuple(voxel_shape)
+        self.coords = tf.placeholder(tf.int32, [None, 4], name="coords")
+        self.batch_size = tf.placeholder(tf.int32, [], name="batch_size")
+        self.rules = []
+        self.background = []
+        assigns = []
+
+        empty = tf.zeros([1] + list(voxel_shape) + [1])
+        shape = self.voxel_shape
+        background = None
+        for name, input_dim, output_dim, size, stride in SPARSE_LAYERS:
+            out_shape, _ = same_padding(shape, size, stride)
+            rule = dict(out_coords=tf.placeholder(tf.int32, [None, 4]), table=tf.placeholder(tf.int32, [None, size ** 3]))
+            with tf.variable_scope("conv3D" + name) as scope:
+                kernel = tf.get_variable("weights", shape=[size, size, size, input_dim, output_dim], dtype=tf.float32)
+                b = tf.get_variable("bias", shape=[output_dim], dtype=tf.float32)
+                stride_5d = [1, stride, stride, stride, 1]
+                empty_pre = tf.nn.bias_add(tf.nn.conv3d(empty, kernel, stride_5d, padding="SAME"), b)
+                empty = batch_norm(activation(empty_pre), None)
+                cached_pre = tf.Variable(tf.zeros(list(out_shape) + [output_dim]), trainable=False, \
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES], name="empty_pre")
+                cached = tf.Variable(tf.zeros(list(out_shape) + [output_dim]), trainable=False, \
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES], name="empty")
+                assigns += [tf.assign(cached_pre, empty_pre[0]), tf.assign(cached, empty[0])]
+
+                # im2col over the neighbor table, one matmul per layer
+                if background is None:
+                    # occupancy input: the columns are whether the neighbor is occupied
+                    columns = tf.cast(tf.less(rule["table"], tf.shape(self.coords)[0]), tf.float32)
+                else:
+                    features = tf.concat([features - background, tf.zeros([1, input_dim])], 0)
+                    columns = tf.reshape(tf.gather(features, rule["table"]), [-1, size ** 3 * input_dim])
+                conv = tf.matmul(columns, tf.reshape(kernel, [size ** 3 * input_dim, output_dim]))
+                pre = conv + tf.gather_nd(cached_pre, rule["out_coords"][:, 1:])
+                with tf.variable_scope(scope, reuse=True):
+                    features = batch_norm(activation(pre), None)
+                background = tf.gather_nd(cached, rule["out_coords"][:, 1:])
+            self.rules.append(rule)
+            self.background.append(cached)
+            shape = out_shape
+        self.cache_background = tf.group(*assigns)
+
+        out_coords = self.rules[-1]["out_coords"]
+        dense = tf.tile(self.background[-1][tf.newaxis], [self.batch_size, 1, 1, 1, 1]) + \
+            tf.scatter_nd(out_coords, features - background, tf.concat([[self.batch_size], list(shape) + [output_dim]], 0))
+        self.layer3 = tf.reshape(dense, [-1] + list(shape) + [output_dim])
+        self.layer4 = conv3DLayer(self.layer3, 64, 64, 3, 3, 3, [1, 1, 1, 1, 1], name="layer4", activation=activation, is_training=None)
+        self.objectness = conv3D_to_output(self.layer4, 64, 2, 3, 3, 3, [1, 1, 1, 1, 1], name="objectness", activation=None)
+        self.cordinate = conv3D_to_output(self.layer4, 64, 24, 3, 3, 3, [1, 1, 1, 1, 1], name="cordinate", activation=None)
+        self.y = tf.nn.softmax(self.objectness, axis=-1)
+
+    def feed_dict(self, coords_list):
+        """Placeholders of a batch of raw_to_sparse_voxel coords, the rulebooks built in numpy"""
+        coords = batch_coords(coords_list)
+        feed = {self.coords: coords, self.batch_size: len(coords_list)}
+        shape = self.voxel_shape
+        for (name, input_dim, output_dim, size, stride), rule in zip(SPARSE_LAYERS, self.rules):
+            coords, shape, table = rulebook(coords, shape, size, stride)
+            feed.update({rule["out_coords"]: coords, rule["table"]: table})
+        return feed
+
+
+def sparse_model(voxel_shape=(360, 400, 40), activation=tf.nn.relu):
+    """Inference only SparseBNBLayer under the variable names of ssd_model, restore then run cache_background"""
+    with tf.variable_scope("3D_CNN_model"):
+        model = SparseBNBLayer()
+        model.build_graph(voxel_shape, activation=activation)
+    return model
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+import os
+import glob
+import time
+import struct
+import socket
+import argparse
+import threading
+import contextlib
+import numpy as np
+from input_velodyne import *
+from model_01_deconv import Detector
+import tracing
+
+# socket frame header: sensor stamp (s), number of points; followed by (N, 4) float32 x, y, z, intensity
+HEADER = struct.Struct("<dI")
+
+
+class Frame(object):
+    __slots__ = ("frame_id", "stamp", "pc", "batch", "outputs", "detections", "times")
+
+    def __init__(self, frame_id, stamp, pc):
+        self.frame_id = frame_id
+        self.stamp = stamp
+        self.pc = pc
+        self.batch = None
+        self.outputs = None
+        self.detections = None
+        self.times = []
+
+
+class LatestSlot(object):
+    """One frame hand-off between two stages that keeps the newest frame only
+
+    put() replaces a frame the next stage has not taken yet, so a slow stage
+    always works on the latest scan instead of a growing backlog.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.frame = None
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, frame):
+        with self.cond:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def get(self):
+        """Newest frame, None once closed and empty"""
+        with self.cond:
+            while self.frame is None and not self.closed:
+                self.cond.wait(0.1)
+            frame, self.frame = self.frame, None
+            return frame
+
+
+class DirectorySource(object):
+    """Scans appearing in a directory, e.g. "/dev/shm/velodyne/*.bin", in name order
+
+    Writers must rename complete files into place, a partially written scan
+    matching pattern would be read. The stamp is the file modification time.
+    """
+
+    def __init__(self, pattern, poll=0.01, existing=False):
+        self.pattern = pattern
+        self.poll = poll
+        self.seen = set() if existing else set(glob.glob(pattern))
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def __iter__(self):
+        while not self.stopped.is_set():
+            paths = sorted(set(glob.glob(self.pattern)) - self.seen)
+            if not paths:
+                time.sleep(self.poll)
+                continue
+            for path in paths:
+                self.seen.add(path)
+                try:
+                    stamp = os.path.getmtime(path)
+                    pc = load_pc_from_bin(path)
+                except (IOError, OSError, ValueError):
+                    continue
+                yield Frame(os.path.splitext(os.path.basename(path))[0], stamp, pc)
+
+
+def _recv_exact(conn, size, stopped):
+    """size bytes from conn, None when the peer closes or stopped is set"""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while size:
+        try:
+            n = conn.recv_into(view[len(buf) - size:], size)
+        except socket.timeout:
+            if stopped.is_set():
+                return None
+            continue
+        if not n:
+            return None
+        size -= n
+    return buf
+
+def send_scan(conn, pc, stamp=None):
+    """Send one (N, 4) scan to a SocketSource"""
+    pc = np.ascontiguousarray(pc[:, :4], dtype=np.float32)
+    conn.sendall(HEADER.pack(time.time() if stamp is None else stamp, len(pc)) + pc.tobytes())
+
+class SocketSource(object):
+    """Scans sent with send_scan by one sensor connection at a time on a local TCP port"""
+
+    def __init__(self, host="127.0.0.1", port=5555):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.server.settimeout(0.1)
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def __iter__(self):
+        count = 0
+        try:
+            while not self.stopped.is_set():
+                try:
+                    conn, _ = self.server.accept()
+                except socket.timeout:
+                    continue
+                # short timeouts so an idle sensor does not hold up stop()
+                conn.settimeout(0.1)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with contextlib.closing(conn):
+                    while not self.stopped.is_set():
+                        header = _recv_exact(conn, HEADER.size, self.stopped)
+                        if header is None:
+                            break
+                        stamp, num = HEADER.unpack(bytes(header))
+                        data = _recv_exact(conn, num * 16, self.stopped)
+                        if data is None:
+                            break
+                        yield Frame("%06d" % count, stamp, np.frombuffer(data, dtype=np.float32).reshape(-1, 4))
+                        count += 1
+        finally:
+            self.server.close()
+
+def log_detections(frame):
+    corners, scores = frame.detections
+    print("%s: %d boxes, %.1f ms" % (frame.frame_id, len(scores), (time.time() - frame.stamp) * 1000))
+
+def ros_publisher(publisher=None):
+    """publish callback drawing the scan and its boxes with one reused PointCloudPublisher"""
+    publisher = publisher or PointCloudPublisher(node_name="stream_detector")
+
+    def publish(frame):
+        publisher.publish_cloud(frame.pc, stamp=frame.stamp)
+        publisher.publish_boxes(frame.detections[0], stamp=frame.stamp)
+    return publish
+
+
+class StreamDetector(object):
+    """Resident detector over a live scan source, preprocess / inference / postprocess each on its own thread
+
+    Stages hand frames over through LatestSlot, so under backpressure the
+    stale frames are dropped at the slowest stage and the end to end latency
+    stays one frame per stage. Frames older than max_age seconds when a stage
+    takes them are dropped too. publish(frame) gets every detected frame,
+    frame.detections being (corners (N, 8, 3), scores (N,)).
+
+    Latencies are from the sensor stamp of the scan: receive (stamp to the
+    frame read), preprocess, inference, postprocess (decode, nms and publish)
+    and end to end.
+    """
+
+    STAGES = ("receive", "preprocess", "inference", "postprocess")
+
+    def __init__(self, detector, source, publish=log_detections, max_age=None):
+        self.detector = detector
+        self.source = source
+        self.publish = publish
+        self.max_age = max_age
+        self.slots = [LatestSlot() for _ in range(3)]
+        self.latencies = []
+        self.received = 0
+        self.stale = 0
+        self.error = None
+
+    def warm_up(self):
+        """First sess.run allocates and autotunes, keep it out of the stream"""
+        self.detector.run(self.detector.preprocess([np.array([[10., 0., 0., 0.]], dtype=np.float32)]))
+
+    def _receive(self):
+        try:
+            for frame in self.source:
+                self.received += 1
+                frame.times.append(time.time())
+                self.slots[0].put(frame)
+        except Exception as e:
+            self.error = self.error or e
+        finally:
+            self.slots[0].close()
+
+    def _stage(self, inbox, outbox, name, work):
+        try:
+            while True:
+                frame = inbox.get()
+                if frame is None:
+                    return
+                if self.max_age is not None and time.time() - frame.stamp > self.max_age:
+                    self.stale += 1
+                    continue
+                with tracing.span(name):
+                    work(frame)
+                frame.times.append(time.time())
+                if outbox is not None:
+                    outbox.put(frame)
+                else:
+                    self.latencies.append(np.diff([frame.stamp] + frame.times))
+        except Exception as e:
+            self.error = self.error or e
+            self.source.stop()
+        finally:
+            if outbox is not None:
+                outbox.close()
+
+    def _preprocess(self, frame):
+        frame.batch = self.detector.preprocess([frame.pc])
+
+    def _infer(self, frame):
+        frame.outputs = self.detector.run(frame.batch)
+        frame.batch = None
+
+    def _postprocess(self, frame):
+        _, cordinate, y_pred = frame.outputs
+        frame.outputs = None
+        frame.detections = self.detector.suppress(*self.detector.decode(y_pred[0], cordinate[0]))
+        self.publish(frame)
+
+    def run(self):
+        """Process the source until it ends or stop() is called"""
+        threads = [threading.Thread(target=self._receive)]
+        stages = ((self._preprocess, "preprocess"), (self._infer, "inference"), (self._postprocess, "postprocess"))
+        for i, (work, name) in enumerate(stages):
+            outbox = self.slots[i + 1] if i + 1 < len(self.slots) else None
+            threads.append(threading.Thread(target=self._stage, args=(self.slots[i], outbox, name, work)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(0.1)
+        except KeyboardInterrupt:
+            self.stop()
+            for slot in self.slots:
+                slot.close()
+            for thread in threads:
+                thread.join(1.)
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        self.source.stop()
+
+    @property
+    def dropped(self):
+        return sum(slot.dropped for slot in self.slots)
+
+    def summary(self):
+        """Frame counts and mean / p50 / p99 / max ms of every stage and end to end"""
+        lines = ["received %d, published %d, dropped %d, stale %d" % (self.received, len(self.latencies), self.dropped, self.stale)]
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000
+            latencies = np.hstack((latencies, latencies.sum(axis=1, keepdims=True)))
+            for name, values in zip(self.STAGES + ("end to end",), latencies.transpose()):
+                lines.append("%-12s mean %7.1f  p50 %7.1f  p99 %7.1f  max %7.1f ms" % \
+                    (name, values.mean(), np.percentile(values, 50), np.percentile(values, 99), values.max()))
+        return "\n".join(lines)
+
+
+def replay(velodyne_path, host="127.0.0.1", port=5555, rate=10.):
+    """Sensor stand-in: send the scans of a split to a SocketSource at rate Hz"""
+    conn = socket.create_connection((host, port))
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    with contextlib.closing(conn):
+        start = time.time()
+        for i, path in enumerate(sorted(glob.glob(velodyne_path))):
+            time.sleep(max(start + i / rate - time.time(), 0))
+            send_scan(conn, load_pc_from_bin(path))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Streaming detector over scans from a directory or a local socket")
+    parser.add_argument("--checkpoint", default="./velodyne_025_deconv_norm_valid40.ckpt")
+    parser.add_argument("--watch", default=None, help="glob of the scans written (renamed) into a directory, e.g. /dev/shm/velodyne/*.bin")
+    parser.add_argument("--listen", default="127.0.0.1:5555", help="host:port to receive scans on when not watching a directory")
+    parser.add_argument("--replay", default=None, help="send the scans of this glob to --listen at --rate Hz instead of detecting")
+    parser.add_argument("--rate", type=float, default=10.)
+    parser.add_argument("--max-age", type=float, default=None, help="drop frames older than this many seconds")
+    parser.add_argument("--resolution", type=float, default=0.25)
+    parser.add_argument("--scale", type=int, default=8)
+    parser.add_argument("--threshold", type=float, default=0.995)
+    parser.add_argument("--sparse", action="store_true")
+    parser.add_argument("--ros", action="store_true", help="publish the scans and box markers instead of logging them")
+    args = parser.parse_args()
+
+    host, port = args.listen.rsplit(":", 1)
+    if args.replay:
+        replay(args.replay, host, int(port), rate=args.rate)
+    else:
+        source = DirectorySource(args.watch) if args.watch else SocketSource(host, int(port))
+        x, y, z = (0, 90), (-50, 50), (-5.5, 4.5)
+        with Detector(args.checkpoint, resolution=args.resolution, scale=args.scale, voxel_shape=voxel_grid_shape(args.resolution, x, y, z), \
+                      x=x, y=y, z=z, threshold=args.threshold, sparse=args.sparse) as detector:
+            stream = StreamDetector(detector, source, publish=ros_publisher() if args.ros else log_detections, max_age=args.max_age)
+            stream.warm_up()
+            stream.run()
+            print(stream.summary())
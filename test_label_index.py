@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+try:
+    from label_index import LabelIndex
+    from data_pipeline import frame_sources
+except ImportError:
+    LabelIndex = None
+
+CALIB = "R0_rect: 1 0 0 0 1 0 0 0 1\nTr_velo_to_cam: 0 -1 0 0 0 0 -1 0 1 0 0 0\n"
+# Car at x=1, y=1.5, z=10 in camera coordinate, x=10, y=-1, z=-1.5 in velodyne coordinate
+LABEL = "Car 0.00 0 -1.57 100 100 200 200 1.5 1.6 3.9 1 1.5 10 0\n"
+
+
+@unittest.skipIf(LabelIndex is None, "input_velodyne needs ROS and python-pcl")
+class SingleCalibTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name in ("velodyne", "label", "calib"):
+            os.makedirs(os.path.join(self.root, name))
+        for frame_id in ("000000", "000001"):
+            np.zeros((1, 4), dtype=np.float32).tofile(os.path.join(self.root, "velodyne", frame_id + ".bin"))
+            with open(os.path.join(self.root, "label", frame_id + ".txt"), "w") as f:
+                f.write(LABEL)
+        with open(os.path.join(self.root, "calib", "000000.txt"), "w") as f:
+            f.write(CALIB)
+        self.label_path = os.path.join(self.root, "label", "*.txt")
+        self.calib_path = os.path.join(self.root, "calib", "*.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_every_frame_projected(self):
+        index = LabelIndex(self.label_path, self.calib_path)
+        self.assertFalse(np.isnan(index.proj_velo).any())
+        for i in range(len(index)):
+            places, _, _ = index.labels(i)
+            np.testing.assert_allclose(places, [[10., -1., -1.5]], atol=1e-6)
+
+    def test_index_matches_frame_sources(self):
+        sources = frame_sources(os.path.join(self.root, "velodyne", "*.bin"), self.label_path, self.calib_path, dataformat="bin")
+        index = LabelIndex(self.label_path, self.calib_path)
+        for _, label, calib in sources:
+            places, _, _ = index.labels_of(label)
+            self.assertTrue(calib.endswith("000000.txt"))
+            np.testing.assert_allclose(places, [[10., -1., -1.5]], atol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
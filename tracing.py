@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+import os
+import json
+import time
+import threading
+import collections
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ("tracer", "name", "start")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer.record(self.name, self.start, time.time() - self.start)
+        return False
+
+
+class Tracer(object):
+    """Per stage spans and counters of the input pipeline and the training loop
+
+    Tracing is off unless enable() is called: span() then returns a shared
+    no-op context manager, so the instrumented hot paths cost one function call.
+
+        tracing.enable("trace.json")
+        with tracing.span("load"):
+            ...
+        tracing.counter("batch_queue", batches.qsize())
+        tracing.save()
+
+    The file is a Chrome trace event array (chrome://tracing or
+    https://ui.perfetto.dev), appended every flush_every events and on save(),
+    so memory holds at most flush_every events; without a path only the last
+    max_events are kept. Pool workers trace into their own Tracer, whose
+    events are drained with each frame and merged into the parent's.
+    """
+
+    def __init__(self, path=None, summary_every=0, flush_every=10000, max_events=100000):
+        self.path = path
+        self.summary_every = summary_every
+        self.flush_every = flush_every
+        self.events = collections.deque(maxlen=max_events)
+        self.written = 0
+        self.totals = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def record(self, name, start, duration):
+        event = dict(name=name, ph="X", ts=start * 1e6, dur=duration * 1e6, pid=self.pid, tid=threading.current_thread().ident)
+        with self.lock:
+            self.events.append(event)
+            count, total, longest = self.totals.get(name, (0, 0., 0.))
+            self.totals[name] = (count + 1, total + duration, max(longest, duration))
+            full = len(self.events) >= self.flush_every
+        if full and self.path:
+            self.save()
+
+    def counter(self, name, value):
+        with self.lock:
+            self.events.append(dict(name=name, ph="C", ts=time.time() * 1e6, pid=self.pid, args={name: value}))
+
+    def drain(self):
+        """Events recorded since the last drain, to be merged by the parent process"""
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+            self.totals = collections.OrderedDict()
+        return events
+
+    def merge(self, events):
+        with self.lock:
+            self.events.extend(events)
+            for event in events:
+                if event["ph"] == "X":
+                    count, total, longest = self.totals.get(event["name"], (0, 0., 0.))
+                    duration = event["dur"] / 1e6
+                    self.totals[event["name"]] = (count + 1, total + duration, max(longest, duration))
+            full = len(self.events) >= self.flush_every
+        if full and self.path:
+            self.save()
+
+    def summary(self, reset=True):
+        """One line of mean / max ms per span name since the last reset"""
+        with self.lock:
+            totals = self.totals
+            if reset:
+                self.totals = collections.OrderedDict()
+        return ", ".join("%s %.1f ms (max %.1f, n=%d)" % (name, total / count * 1000, longest * 1000, count) \
+            for name, (count, total, longest) in totals.items())
+
+    def save(self, path=None):
+        """Append the buffered events to the trace file, which stays a complete JSON array"""
+        self.path = self.path or path
+        if not self.path:
+            return
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+        with self.file_lock:
+            chunk = ",\n".join(json.dumps(event) for event in events)
+            with open(self.path, "r+b" if self.written else "wb") as f:
+                if self.written:
+                    # overwrite the closing "\n]" of the previous save
+                    f.seek(-2, os.SEEK_END)
+                    chunk = ",\n" + chunk if events else ""
+                else:
+                    chunk = "[\n" + chunk
+                f.write((chunk + "\n]").encode("utf-8"))
+            self.written += len(events)
+
+
+_tracer = None
+
+def enable(path=None, summary_every=0):
+    """Start tracing in this process, saving to path and summarizing every summary_every steps"""
+    global _tracer
+    _tracer = Tracer(path, summary_every=summary_every)
+    return _tracer
+
+def disable():
+    global _tracer
+    _tracer = None
+
+def enabled():
+    return _tracer is not None
+
+def span(name):
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.span(name)
+
+def counter(name, value):
+    if _tracer is not None:
+        _tracer.counter(name, value)
+
+def drain():
+    return _tracer.drain() if _tracer is not None else []
+
+def merge(events):
+    if _tracer is not None and events:
+        _tracer.merge(events)
+
+def report(step):
+    """Print the span summary every summary_every steps"""
+    if _tracer is not None and _tracer.summary_every and step % _tracer.summary_every == 0:
+        print("Step %d: %s" % (step, _tracer.summary()))
+
+def save(path=None):
+    if _tracer is not None:
+        _tracer.save(path)
+
+def save_run_metadata(run_metadata, path):
+    """Chrome trace of the ops of one sess.run traced with tf.RunOptions.FULL_TRACE"""
+    from tensorflow.python.client import timeline
+    with open(path, "w") as f:
+        f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
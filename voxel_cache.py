@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+CACHE_VERSION = 1
+MANIFEST_NAME = "manifest.txt"
+
+
+class VoxelCache(object):
+    """Content addressed on disk cache of preprocessed frames
+
+    Entries are keyed by the sha1 of the source files and of the voxel
+    parameters, so changing the resolution, ROI or scale (or editing a label)
+    simply misses the cache instead of returning stale tensors.
+    The source digests are remembered across runs and processes in a
+    manifest of (path, size, mtime) signatures, so a hit reads no source
+    file; a file is hashed only when its signature is new.
+    Frames are stored sparse: uint16 occupied voxel indices (or the float32
+    bird's eye view maps), the objectness cells and their float32 corner
+    offsets, in a compressed npz.
+    """
+
+    def __init__(self, cache_dir, **params):
+        self.cache_dir = cache_dir
+        self.params_key = repr((CACHE_VERSION, sorted(params.items())))
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+        self.manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+        self._digests = self.read_manifest()
+
+    def read_manifest(self):
+        """{signature: sha1} of the manifest, one "sha1 size mtime path" line per source file"""
+        digests = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) == 4:
+                        digests["\t".join(fields[1:])] = fields[0]
+        return digests
+
+    def file_digest(self, path):
+        """sha1 of a source file, looked up by (path, size, mtime) in the manifest before hashing"""
+        stat = os.stat(path)
+        signature = "%d\t%r\t%s" % (stat.st_size, stat.st_mtime, os.path.abspath(path))
+        if signature not in self._digests:
+            sha = hashlib.sha1()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(chunk)
+            self._digests[signature] = sha.hexdigest()
+            # one short line per append, so the pool workers never interleave their writes
+            with open(self.manifest_path, "a") as f:
+                f.write("%s\t%s\n" % (self._digests[signature], signature))
+        return self._digests[signature]
+
+    def key(self, *paths):
+        return self.digest_key([self.file_digest(path) if path else "-" for path in paths])
+
+    def digest_key(self, digests):
+        """Key from source file digests already known, e.g. the ones stored in a pack"""
+        sha = hashlib.sha1(self.params_key.encode("utf-8"))
+        for digest in digests:
+            sha.update(str(digest).encode("utf-8"))
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npz")
+
+    def load(self, key):
+        """Return (coords, center_sphere, g_cord) or None on a miss"""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                coords = data["coords"]
+                return coords.astype(np.int32) if coords.dtype == np.uint16 else coords, data["center_sphere"], data["g_cord"]
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def save(self, key, frame):
+        """Write atomically so concurrent readers never see a half written entry"""
+        coords, center_sphere, g_cord = frame
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(suffix=".npz", dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, coords=coords.astype(np.uint16) if coords.dtype.kind in "iu" else coords, center_sphere=center_sphere, g_cord=g_cord)
+        os.rename(tmp_path, path)